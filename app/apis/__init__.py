@@ -1,7 +1,9 @@
-from flask import make_response
+from flask import Response, current_app, request
 from flask_restx import Api
 
-from core.transformer import XmlTransformer
+from core.encoding import dumps
+from core.transformer import XmlStream
+from settings import JSON_ENCODER
 from .cognito import api as cognito
 from .expense import api as expense
 from .user import api as user
@@ -13,9 +15,19 @@ api = Api(
 )
 
 
+@api.representation('application/json')
+def json(data, code, headers):
+    # Indented in debug mode, like the default flask-restx representation
+    resp = Response(dumps(data, JSON_ENCODER, current_app.debug), code)
+    resp.headers.extend(headers)
+    return resp
+
+
 @api.representation('application/xml')
 def xml(data, code, headers):
-    resp = make_response(str(XmlTransformer(data)), code)
+    # Streamed in chunks; ?pretty=true indents the elements
+    pretty = request.args.get('pretty', 'false').lower() == 'true'
+    resp = Response(iter(XmlStream(data, pretty)), code)
     resp.headers.extend(headers)
     return resp
 
@@ -1,13 +1,20 @@
+import logging
+
 from botocore.errorfactory import ClientError
-from flask import request
+from flask import g, request
 from flask_restx import Namespace, Resource, fields
-from warrant import Cognito
 
+from core.cognito import CognitoPool, TokenVerificationError
 from core.data import ReturnDocument
-from settings import awsRegion, cognitoUserPoolId, cognitoUserPoolClientId
+from settings import awsRegion, cognitoUserPoolId, cognitoUserPoolClientId, cognitoJwksFile
 
 api = Namespace('cognito', description='AWS cognito services')
 
+logger = logging.getLogger(__name__)
+
+# Shared boto3 client and signing keys of the user pool
+cognito = CognitoPool(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion, cognitoJwksFile)
+
 
 @api.route('/register/')
 class RegisterUser(Resource):
@@ -26,7 +33,7 @@ class RegisterUser(Resource):
         family_name = json_data['family_name']
         pwd = json_data['password']
         try:
-            u = Cognito(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion)
+            u = cognito.user()
             u.add_base_attributes(name=name, family_name=family_name)
             u.register(email, password=pwd)
 
@@ -50,7 +57,7 @@ class ConfirmUser(Resource):
         code = json_data['code']
 
         try:
-            u = Cognito(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion)
+            u = cognito.user()
             u.confirm_sign_up(code, username=email)
 
             return ReturnDocument(email, "success").asdict()
@@ -80,11 +87,14 @@ class ConfirmUser(Resource):
         access_token = json_data['access_token']
 
         try:
-            u = Cognito(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion, id_token=id_token,
-                        refresh_token=refresh_token, access_token=access_token)
+            # Forged or expired tokens are rejected without calling Cognito
+            cognito.verify_token(access_token, 'access')
+            u = cognito.user(id_token=id_token, refresh_token=refresh_token, access_token=access_token)
             u.logout()
 
             return ReturnDocument(email, "success").asdict()
+        except TokenVerificationError as err:
+            return ReturnDocument(err.__str__(), "error").asdict()
         except ClientError as err:
             return ReturnDocument(err.__str__(), "error").asdict()
 
@@ -99,11 +109,11 @@ class InitiateForgetPassword(Resource):
     def post(self):
         """Sends a verification code to the user to use to change their password."""
         json_data = request.get_json(force=True)
-        print(json_data)
         email = json_data['email']
+        logger.debug("Password reset requested")
 
         try:
-            u = Cognito(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion, username=email)
+            u = cognito.user(username=email)
             u.initiate_forgot_password()
             return ReturnDocument(email, "success").asdict()
         except ClientError as err:
@@ -120,12 +130,12 @@ class ForgetPassword(Resource):
     def post(self):
         """Allows a user to enter a code provided when they reset their password to update their password."""
         json_data = request.get_json(force=True)
-        print(f"Reset pwd code: {json_data}")
         email = json_data['email']
+        logger.debug("Password reset confirmed")
         code = json_data['code']
         password = json_data['password']
         try:
-            u = Cognito(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion, username=email)
+            u = cognito.user(username=email)
             u.confirm_forgot_password(code, password=password)
 
             return ReturnDocument(email, "success").asdict()
@@ -148,7 +158,7 @@ class LoginUser(Resource):
         password = json_data['password']
 
         try:
-            u = Cognito(cognitoUserPoolId, cognitoUserPoolClientId, awsRegion, username=email)
+            u = cognito.user(username=email)
             u.authenticate(password)
             data = {
                 # "email":email,
@@ -157,7 +167,17 @@ class LoginUser(Resource):
                 "access_token": u.access_token,
                 "token_type": u.token_type,
             }
-            print(ReturnDocument(data, "success").asdict())
             return ReturnDocument(data, "success").asdict()
+        except TokenVerificationError as err:
+            return ReturnDocument(err.__str__(), "error").asdict()
         except ClientError as err:
             return ReturnDocument(err.__str__(), "error").asdict()
+
+
+@api.route('/token/verify/')
+class VerifyToken(Resource):
+
+    @cognito.authenticated
+    def get(self):
+        """Verify the access token of the Authorization header (locally, without calling Cognito)"""
+        return ReturnDocument(g.claims, "success").asdict()
@@ -1,18 +1,36 @@
 from datetime import datetime
 
-import pandas as pd
 from botocore.exceptions import ClientError
-from fbprophet import Prophet
 from flask import request
 from flask_restx import Namespace, Resource, fields
 
+from core import metrics
 from core.data import ReturnDocument
-from db import Expense, RepositoryException, User
+from core.etag import strong_etag, not_modified, etag_headers
+from core.expense_import import import_format, read_rows, row_to_expense, RowError
+from core.forecast import predict_chart
+from core.forecast_cache import ForecastCache
+from core.forecast_jobs import ForecastJobs
+from db import Expense, RepositoryException
 from db.factory import create_repository
-from settings import REPOSITORY_NAME, REPOSITORY_SETTINGS
+from db.rollup import rollup_stats, rollup_fingerprint
+from settings import REPOSITORY_NAME, REPOSITORY_SETTINGS, REPOSITORY_CACHE_SETTINGS, METRICS_ENABLED
+from settings import EXPENSE_PAGE_SIZE
+from settings import FORECAST_ENGINE, FORECAST_CACHE_SIZE, FORECAST_CACHE_TTL, FORECAST_CACHE_DIR, FORECAST_WORKERS
+
+# Rows handed to the repository at once by /import/
+IMPORT_CHUNK_SIZE = 500
+# Rows listed in the error report of /import/
+IMPORT_MAX_ERRORS = 1000
 
 # Database
-repository = create_repository(REPOSITORY_NAME, REPOSITORY_SETTINGS)
+repository = create_repository(REPOSITORY_NAME, REPOSITORY_SETTINGS, REPOSITORY_CACHE_SETTINGS,
+                               metrics.repository_calls if METRICS_ENABLED else None)
+if METRICS_ENABLED:
+    metrics.register_cache(repository)
+
+forecast_cache = ForecastCache(FORECAST_CACHE_SIZE, FORECAST_CACHE_TTL, FORECAST_CACHE_DIR)
+forecast_jobs = ForecastJobs(forecast_cache, FORECAST_WORKERS, FORECAST_ENGINE) if FORECAST_WORKERS > 0 else None
 
 api = Namespace('expenses', description='For managing expenses')
 
@@ -61,6 +79,58 @@ class AddExpense(Resource):
             return ReturnDocument(f"{err.__str__()}-{err.__doc__}", "error").asdict()
 
 
+@api.route('/import/')
+class ImportExpenses(Resource):
+
+    @api.doc(params={'format': 'csv or ndjson (default: from the Content-Type)'})
+    def post(self):
+        """
+        Import expenses from a CSV (text/csv) or NDJSON (application/x-ndjson) request body.
+        Rows have the fields of /add/, the payor defaulting to the email.
+        Valid rows are imported, the others are listed in the error report with their line number.
+        """
+        try:
+            format = import_format(request.mimetype, request.args.get('format'))
+        except ValueError as err:
+            return ReturnDocument(err.__str__(), "error").asdict()
+
+        report = {"imported": 0, "failed": 0, "errors": []}
+
+        def error(line, message):
+            report["failed"] += 1
+            if len(report["errors"]) < IMPORT_MAX_ERRORS:
+                report["errors"].append({"line": line, "error": message})
+
+        def flush(chunk):
+            for (line, _), err in zip(chunk, repository.add_expenses([exp for _, exp in chunk])):
+                if err is None:
+                    report["imported"] += 1
+                else:
+                    error(line, err.__doc__.strip())
+            chunk.clear()
+
+        chunk = []
+        try:
+            for line, row in read_rows(request.stream, format):
+                try:
+                    if isinstance(row, RowError):
+                        raise row
+                    chunk.append((line, row_to_expense(row)))
+                except RowError as err:
+                    error(line, err.__str__())
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    flush(chunk)
+            flush(chunk)
+        except UnicodeDecodeError:
+            return ReturnDocument({"error": "File is not UTF-8", **report}, "error").asdict()
+        except ClientError as err:
+            return ReturnDocument({"error": err.__str__(), **report}, "error").asdict()
+
+        # Rows failing in the repository are reported after the ones failing validation
+        report["errors"].sort(key=lambda row: row["line"])
+        return ReturnDocument(report, "success").asdict()
+
+
 @api.route('/delete/')
 class DeleteExpense(Resource):
     model = api.model(
@@ -106,70 +176,77 @@ class GetExpense(Resource):
             return ReturnDocument(f"{err.__str__()}-{err.__doc__}", "error").asdict()
 
 
+def stats_document(email_id, limit=None, cursor=None):
+    """
+    Stats of a user with one page of their expenses (exp_list), EXPENSE_PAGE_SIZE expenses unless limit is given.
+    :param email_id: str
+    :param limit:    int
+    :param cursor:   str
+    :return: dict (ReturnDocument)
+    """
+    # Aggregates come from the rollups, only exp_list needs the expenses themselves
+    stats = rollup_stats(repository.get_rollup(email_id))
+    page, next_cursor = repository.page_expenses(email_id, limit=limit or EXPENSE_PAGE_SIZE, cursor=cursor)
+
+    data = {"exp_list": [exp.to_dict() for exp in page], **stats}
+    return ReturnDocument(data, "success", next_cursor).asdict()
+
+
 @api.route('/stats/')
 class ExpenseStats(Resource):
     model = api.model(
         "GetStats", {
             'email': fields.String(description="User email ID", required=True),
+            'limit': fields.Integer(description=f"Page size of exp_list (default {EXPENSE_PAGE_SIZE})", min=1),
+            'cursor': fields.String(description="next_cursor of the previous page"),
         }
     )
 
-    @api.expect(model)
+    @api.expect(model, validate=True)
     def post(self):
-        exp_list = []
+        """
+        Stats of a user with one page of their expenses (exp_list, EXPENSE_PAGE_SIZE unless limit is given);
+        pass next_cursor as cursor to get the next page
+        """
         data = request.get_json(force=True)
         email_id = data['email']
+        limit = data.get('limit')
+        cursor = data.get('cursor')
 
         try:
-            usr: User = repository.get_user(email_id)
-            for exp in usr.expense_ids:
-                exp_obj: Expense = repository.get_expense(exp)
-                exp_list.append(exp_obj.to_dict())
-            if not exp_list:
-                data = {
-                    "exp_list": [],
-                    "area_chart": {},
-                    "bar_chart": {},
-                    "pie_chart": {},
-                    "new_expenses": 0,
-                    "monthly_expenses": 0,
-                    "friends_amount": 0,
-                    "owed_amount": 0
-                }
-            else:
-                df = pd.DataFrame(exp_list).sort_values('date')
-
-                df['amount'] = pd.to_numeric(df['amount'])
-                df['month'] = pd.to_numeric(df["date"].apply(lambda x: x[5:7]))
-                df['year'] = pd.to_numeric(df["date"].apply(lambda x: x[0:4]))
-                df['day'] = pd.to_numeric(df["date"].apply(lambda x: x[8:10]))
-
-                now = datetime.now()
-                area_chart = df[df['year'] == now.year].groupby(['date'])['amount'].sum()
-                bar_chart = df.groupby(['month'])['amount'].sum()
-
-                new_expenses = df[(df['year'] == now.year) & (df['month'] == now.month) & (df['day'] == now.day)][
-                    'amount'].sum()
-                monthly_expenses = df[(df['year'] == now.year) & (df['month'] == now.month)]['amount'].sum()
-
-                friends_amount = df[(df['payor'] != email_id) & (df['user_id'] == email_id)]['amount'].sum()
-                owed_amount = df[(df['payor'] == email_id) & (df['user_id'] != email_id)]['amount'].sum()
-
-                pie_chart = df[(df['payor'] != email_id) & (df['user_id'] == email_id)].groupby(['payor'])[
-                    'amount'].sum()
-
-                data = {
-                    "exp_list": exp_list,
-                    "area_chart": area_chart.to_dict(),
-                    "bar_chart": bar_chart.to_dict(),
-                    "pie_chart": pie_chart.to_dict(),
-                    "new_expenses": new_expenses,
-                    "monthly_expenses": monthly_expenses,
-                    "friends_amount": friends_amount,
-                    "owed_amount": owed_amount
-                }
-
-            return ReturnDocument(data, "success").asdict()
+            return stats_document(email_id, limit, cursor)
+        except RepositoryException as err:
+            return ReturnDocument(err.__doc__, "error").asdict()
+        except ClientError as err:
+            return ReturnDocument(err.__str__(), "error").asdict()
+
+
+@api.route('/stats/<email>')
+@api.param('email', 'User email ID')
+class UserExpenseStats(Resource):
+
+    @api.doc(params={
+        'limit': f'Page size of exp_list (default {EXPENSE_PAGE_SIZE})',
+        'cursor': 'next_cursor of the previous page',
+    })
+    def get(self, email):
+        """
+        Same as POST /stats/, with an ETag: If-None-Match requests get a 304 while the expenses of the user
+        are unchanged
+        """
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        if 'limit' in request.args and (limit is None or limit < 1):
+            return ReturnDocument("limit must be a positive integer", "error").asdict()
+
+        try:
+            # The charts also depend on the current day
+            etag = strong_etag(repository.get_version(email), limit, cursor, datetime.now().date().isoformat())
+            response = not_modified(etag)
+            if response is not None:
+                return response
+
+            return stats_document(email, limit, cursor), 200, etag_headers(etag)
         except RepositoryException as err:
             return ReturnDocument(err.__doc__, "error").asdict()
         except ClientError as err:
@@ -186,50 +263,63 @@ class PredictStats(Resource):
 
     @api.expect(model)
     def post(self):
-        exp_list = []
         data = request.get_json(force=True)
         email_id = data['email']
 
         try:
-            usr: User = repository.get_user(email_id)
-            for exp in usr.expense_ids:
-                exp_obj: Expense = repository.get_expense(exp)
-                exp_list.append(exp_obj.to_dict())
-            if not exp_list or len(exp_list) <= 10:
-                data = {
-                    "predict_chart": "Insufficient Data (atleast 10 entries required)"
-                }
-            else:
-                df = pd.DataFrame(exp_list).sort_values('date')
-
-                df['amount'] = pd.to_numeric(df['amount'])
-                df['ds'] = pd.to_datetime(df['date'])
-
-                prophet_df = pd.DataFrame()
-                prophet_df['ds'] = df['ds']
-                prophet_df['y'] = df['amount']
-
-                m = Prophet()
-                m.fit(prophet_df)
-                future = m.make_future_dataframe(periods=3, freq='MS')
-                forecast = m.predict(future)
-
-                forecast['x'] = forecast['ds'].dt.strftime('%Y-%m-%d')
-                forecast['y'] = forecast['yhat']
-
-                df = forecast[['x', 'y']].tail(12)
-                predict_chart = {
-                    "point": df.to_dict(orient='records')
-                }
-                predict_chart = {"data": predict_chart, "EndIndex": "9"}
-
-                data = {
-                    "xml": predict_chart
-                }
-
+            # Forecasts are reused until the history of the user changes. Reading the version first keeps
+            # the rollup of a cached repository from being older than the expenses listed below
+            repository.get_version(email_id)
+            fingerprint = f"{FORECAST_ENGINE}:{rollup_fingerprint(repository.get_rollup(email_id))}"
+            data = forecast_cache.get(email_id, fingerprint)
+            if data is not None:
+                return data
+
+            job_id = forecast_jobs.running_job(email_id, fingerprint) if forecast_jobs is not None else None
+            if job_id is None:
+                exp_list = [exp.to_dict() for exp in repository.list_expenses(email_id)]
+                if not exp_list or len(exp_list) <= 10:
+                    data = {
+                        "predict_chart": "Insufficient Data (atleast 10 entries required)"
+                    }
+                    forecast_cache.put(email_id, fingerprint, data)
+                    return data
+
+                if forecast_jobs is None:
+                    data = {
+                        "xml": predict_chart(exp_list, FORECAST_ENGINE)
+                    }
+                    forecast_cache.put(email_id, fingerprint, data)
+                    return data
+
+                job_id = forecast_jobs.submit(email_id, fingerprint, exp_list)
+
+            # Poll /stats/predict/<job_id>, meanwhile the previous forecast (if any) is returned
+            data = {"job_id": job_id, "status": "pending"}
+            stale = forecast_cache.peek(email_id)
+            if stale is not None:
+                data.update(stale['result'])
             return data
             # return ReturnDocument(data, "success").asdict()
         except RepositoryException as err:
             return ReturnDocument(err.__doc__, "error").asdict()
         except ClientError as err:
             return ReturnDocument(err.__str__(), "error").asdict()
+
+
+@api.route('/stats/predict/<job_id>')
+@api.param('job_id', 'Job id returned by /stats/predict/')
+class PredictStatsJob(Resource):
+
+    def get(self, job_id):
+        """Get the result of a forecast job"""
+        status, result = forecast_jobs.status(job_id) if forecast_jobs is not None else (None, None)
+        if status is None:
+            return ReturnDocument("Unknown job", "error").asdict()
+        if status == "error":
+            return ReturnDocument(result.__str__(), "error").asdict()
+
+        data = {"job_id": job_id, "status": status}
+        if status == "done":
+            data.update(result)
+        return data
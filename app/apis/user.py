@@ -1,20 +1,29 @@
-import time
 from datetime import datetime
 
-import dateutil.parser
 import xmltodict
 from botocore.exceptions import ClientError
-from flask import request
+from flask import Response, request
 from flask_restx import Namespace, Resource, fields
 from flask_restx import reqparse
 
+from core import metrics
 from core.data import ReturnDocument
-from db import User, RepositoryException, Expense
+from core.etag import strong_etag, not_modified, etag_headers
+from core.expense_export import export_chunks, gzip_chunks, MIMETYPES
+from core.expense_import import import_format
+from db import User, RepositoryException
 from db.factory import create_repository
-from settings import REPOSITORY_NAME, REPOSITORY_SETTINGS
+from settings import REPOSITORY_NAME, REPOSITORY_SETTINGS, REPOSITORY_CACHE_SETTINGS, METRICS_ENABLED
+from settings import EXPENSE_PAGE_SIZE
+
+# Expenses read from the repository at once by /export/expenses/
+EXPORT_PAGE_SIZE = 500
 
 # Database
-repository = create_repository(REPOSITORY_NAME, REPOSITORY_SETTINGS)
+repository = create_repository(REPOSITORY_NAME, REPOSITORY_SETTINGS, REPOSITORY_CACHE_SETTINGS,
+                               metrics.repository_calls if METRICS_ENABLED else None)
+if METRICS_ENABLED:
+    metrics.register_cache(repository)
 
 api = Namespace('user', description='For managing users and friends')
 
@@ -31,11 +40,16 @@ add_user_fields = api.model(
 class QueryUser(Resource):
 
     def get(self, email):
-        """Get non-sensitive user information"""
+        """Get non-sensitive user information (supports If-None-Match)"""
         try:
+            etag = strong_etag(repository.get_version(email))
+            response = not_modified(etag)
+            if response is not None:
+                return response
+
             user: User = repository.get_user(email)
             data = {"email": user.id, "name": user.name}
-            return ReturnDocument(data, "success").asdict()
+            return ReturnDocument(data, "success").asdict(), 200, etag_headers(etag)
         except RepositoryException as err:
             return ReturnDocument(err.__doc__, "error").asdict()
 
@@ -118,40 +132,92 @@ class GetUserExpenses(Resource):
             'email': fields.String(description="User email ID", required=True),
             'from_date': fields.Date(description="For filtering"),
             'to_date': fields.Date(description="For filtering"),
+            'limit': fields.Integer(description=f"Page size (default {EXPENSE_PAGE_SIZE})", min=1),
+            'cursor': fields.String(description="next_cursor of the previous page"),
         },
     )
 
     @api.expect(filtered_expense_fields, validate=True)
     def post(self):
         """
-        Get all expenses of a particular user
+        Get one page of the expenses of a particular user (EXPENSE_PAGE_SIZE unless limit is given);
+        pass next_cursor as cursor to get the next page
         """
         data = request.get_json(force=True)
 
         email_id = data['email']
         from_date = data.get('from_date')
         to_date = data.get('to_date')
+        limit = data.get('limit')
+        cursor = data.get('cursor')
 
-        if from_date is not None and to_date is not None:
-            from_date = time.strptime(from_date, "%Y-%m-%d")
-            to_date = time.strptime(to_date, "%Y-%m-%d")
-
-        if from_date is None:
-            from_date = datetime(1970, 1, 1)
         if to_date is None:
-            to_date = datetime.utcnow()
+            to_date = datetime.utcnow().date().isoformat()
 
-        result = []
         try:
-            usr: User = repository.get_user(email_id)
-            for exp in usr.expense_ids:
-                exp_obj: Expense = repository.get_expense(exp)
-                # Filter date
-                if from_date < dateutil.parser.isoparse(exp_obj.date) < to_date:
-                    result.append(exp_obj.to_dict())
-            return ReturnDocument(result, "success").asdict()
+            # Dates are filtered by the repository, both ends inclusive
+            page, next_cursor = repository.page_expenses(email_id, from_date, to_date, limit=limit or EXPENSE_PAGE_SIZE,
+                                                         cursor=cursor)
+            result = [exp.to_dict() for exp in page]
+            return ReturnDocument(result, "success", next_cursor).asdict()
 
         except RepositoryException as err:
             return ReturnDocument(err.__doc__, "error").asdict()
         except ClientError as err:
             return ReturnDocument(err.__str__(), "error").asdict()
+
+
+@api.route("/export/expenses/<email>")
+@api.param('email', 'Email ID of user')
+class ExportUserExpenses(Resource):
+
+    @api.doc(params={
+        'format': 'csv (default) or ndjson',
+        'from_date': 'yyyy-mm-dd, inclusive',
+        'to_date': 'yyyy-mm-dd, inclusive',
+        'gzip': 'true to compress the export (Content-Encoding: gzip)',
+    })
+    def get(self, email):
+        """
+        Export all expenses of a particular user, streamed page by page.
+        Repositories reading the whole history for every page (DynamoDB in list mode) read it once instead.
+        """
+        from_date = request.args.get('from_date')
+        to_date = request.args.get('to_date')
+        compress = request.args.get('gzip', 'false').lower() == 'true'
+
+        try:
+            format = import_format(None, request.args.get('format', 'csv'))
+            # The first page is read before streaming starts, so that errors are still returned as documents
+            if getattr(repository, 'full_read_pages', False):
+                first_page = None, None
+                history = repository.list_expenses(email, from_date, to_date)
+            else:
+                first_page = repository.page_expenses(email, from_date, to_date, limit=EXPORT_PAGE_SIZE)
+                history = None
+        except ValueError as err:
+            return ReturnDocument(err.__str__(), "error").asdict()
+        except RepositoryException as err:
+            return ReturnDocument(err.__doc__, "error").asdict()
+        except ClientError as err:
+            return ReturnDocument(err.__str__(), "error").asdict()
+
+        def pages():
+            if history is not None:
+                for start in range(0, len(history), EXPORT_PAGE_SIZE):
+                    yield history[start:start + EXPORT_PAGE_SIZE]
+                return
+
+            page, cursor = first_page
+            yield page
+            while cursor is not None:
+                page, cursor = repository.page_expenses(email, from_date, to_date, limit=EXPORT_PAGE_SIZE,
+                                                        cursor=cursor)
+                yield page
+
+        chunks = export_chunks(pages(), format)
+        headers = {'Content-Disposition': f'attachment; filename="expenses.{format}"'}
+        if compress:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        return Response(chunks, mimetype=MIMETYPES[format], headers=headers)
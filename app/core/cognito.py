@@ -0,0 +1,215 @@
+"""
+Shared AWS Cognito clients and local verification of Cognito tokens.
+"""
+import json
+import os
+import threading
+import time
+import urllib.request
+from functools import wraps
+
+import boto3
+from flask import g, request
+from jose import jwt, JWTError
+from warrant import Cognito
+
+from core.data import ReturnDocument
+
+
+class TokenVerificationError(Exception):
+    """
+    Exception raised when a token is malformed, expired, or not signed by the user pool
+    """
+
+
+class JWKSCache(object):
+    """
+    Signing keys of a user pool (JWKS), fetched once and refreshed when a token uses an unknown key id.
+    Keys can also be loaded from a local file, e.g. for tests.
+    """
+
+    # Unknown key ids trigger at most one refresh per interval (seconds)
+    REFRESH_INTERVAL = 60
+
+    def __init__(self, url, path=None):
+        """
+        :param url:  str, JWKS url of the user pool
+        :param path: str, local JWKS file used instead of the url
+        """
+        self.url = url
+        self.path = path or None
+        self.keys = {}
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def get(self, kid):
+        """
+        Returns the key with the id
+        :param kid: str
+        :return: dict (JWK) or None
+        """
+        key = self.keys.get(kid)
+        if key is None:
+            with self.lock:
+                # Keys are rotated by Cognito, so an unknown key id means the cached set may be stale
+                if kid not in self.keys and time.time() - self.fetched > self.REFRESH_INTERVAL:
+                    self.refresh()
+                key = self.keys.get(kid)
+        return key
+
+    def jwks(self):
+        """
+        Returns the key set, in the JWKS format
+        :return: dict
+        """
+        if not self.fetched:
+            with self.lock:
+                if not self.fetched:
+                    self.refresh()
+        return {"keys": list(self.keys.values())}
+
+    def refresh(self):
+        """Reloads the key set (the lock must be held)"""
+        if self.path is not None:
+            with open(self.path) as f:
+                jwks = json.load(f)
+        else:
+            with urllib.request.urlopen(self.url, timeout=5) as response:
+                jwks = json.load(response)
+        self.keys = {key['kid']: key for key in jwks.get('keys', [])}
+        self.fetched = time.time()
+
+
+class PooledCognito(Cognito):
+    """
+    warrant Cognito user reusing the boto3 client and the signing keys of its CognitoPool,
+    instead of building a new client (and downloading the keys) for every request
+    """
+
+    def __init__(self, pool, username=None, id_token=None, refresh_token=None, access_token=None):
+        # Cognito.__init__ is not called, it builds a new boto3 client every time
+        self.pool = pool
+        self.user_pool_id = pool.user_pool_id
+        self.client_id = pool.client_id
+        self.user_pool_region = pool.region
+        self.username = username
+        self.id_token = id_token
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.client_secret = None
+        self.token_type = None
+        self.custom_attributes = None
+        self.base_attributes = None
+        self.client = pool.client()
+
+    def get_keys(self):
+        return self.__keys__(self.pool.jwks.jwks)
+
+    def get_key(self, kid):
+        key = self.__keys__(self.pool.jwks.get, kid)
+        if key is None:
+            raise TokenVerificationError('Unknown signing key.')
+        return key
+
+    @staticmethod
+    def __keys__(read, *args):
+        """
+        Reads the signing keys, which may be fetched from the user pool, like CognitoPool.verify_token
+        :param read: callable, method of the JWKSCache
+        :return: result of read
+        """
+        try:
+            return read(*args)
+        except (OSError, ValueError):
+            raise TokenVerificationError('Signing keys of the user pool are unavailable.')
+
+
+class CognitoPool(object):
+    """
+    Process-wide access to a Cognito user pool: one thread-safe boto3 client per process
+    (re-created after a fork), and in-process token verification against the cached JWKS.
+    """
+
+    def __init__(self, user_pool_id, client_id, region, jwks_path=None):
+        """
+        :param user_pool_id: str
+        :param client_id:    str, app client id
+        :param region:       str
+        :param jwks_path:    str, local JWKS file (default: downloaded from the user pool)
+        """
+        self.user_pool_id = user_pool_id
+        self.client_id = client_id
+        self.region = region
+        self.issuer = f"https://cognito-idp.{region}.amazonaws.com/{user_pool_id}"
+        self.jwks = JWKSCache(f"{self.issuer}/.well-known/jwks.json", jwks_path)
+
+        self._client = None
+        self._pid = None
+        self.lock = threading.Lock()
+
+    def client(self):
+        """
+        Returns the boto3 cognito-idp client of this process
+        :return: botocore client
+        """
+        if self._client is None or self._pid != os.getpid():
+            with self.lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = boto3.session.Session().client('cognito-idp', region_name=self.region)
+                    self._pid = os.getpid()
+        return self._client
+
+    def user(self, username=None, id_token=None, refresh_token=None, access_token=None):
+        """
+        Returns a warrant Cognito object sharing the client of the pool
+        :return: PooledCognito
+        """
+        return PooledCognito(self, username=username, id_token=id_token, refresh_token=refresh_token,
+                             access_token=access_token)
+
+    def verify_token(self, token, token_use):
+        """
+        Checks the signature, expiry, issuer and audience of a token without calling Cognito
+        :param token:     str
+        :param token_use: 'id' or 'access'
+        :return: dict, claims of the token
+        """
+        try:
+            key = self.jwks.get(jwt.get_unverified_header(token).get('kid'))
+            if key is None:
+                raise TokenVerificationError('Unknown signing key.')
+            claims = jwt.decode(
+                token, key, algorithms=['RS256'], issuer=self.issuer,
+                # Access tokens carry the app client in client_id instead of aud
+                audience=self.client_id if token_use == 'id' else None,
+                options={'verify_aud': token_use == 'id', 'verify_at_hash': False}
+            )
+        except JWTError as err:
+            raise TokenVerificationError(err.__str__())
+        except (OSError, ValueError):
+            raise TokenVerificationError('Signing keys of the user pool are unavailable.')
+
+        if claims.get('token_use') != token_use:
+            raise TokenVerificationError(f"Not an {token_use} token.")
+        if token_use == 'access' and claims.get('client_id') != self.client_id:
+            raise TokenVerificationError('Token issued for another client.')
+        return claims
+
+    def authenticated(self, func):
+        """
+        Decorator for resource methods requiring an "Authorization: Bearer <access token>" header.
+        The claims of the verified token are available as flask.g.claims.
+        """
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() != 'bearer' or not token:
+                return ReturnDocument("Missing bearer token", "error").asdict(), 401
+            try:
+                g.claims = self.verify_token(token, 'access')
+            except TokenVerificationError as err:
+                return ReturnDocument(err.__str__(), "error").asdict(), 401
+            return func(*args, **kwargs)
+
+        return wrapper
@@ -1,13 +1,18 @@
 class ReturnDocument(object):
 
-    def __init__(self, data, status):
+    def __init__(self, data, status, next_cursor=None):
         """
         Document structure returned by Greevil API
-        :param data:   object
-        :param status: str
+        :param data:        object
+        :param status:      str
+        :param next_cursor: str, cursor of the next page (paginated responses only)
         """
         self.data = data
         self.status = status
+        self.next_cursor = next_cursor
 
     def asdict(self):
-        return {"data": self.data, "status": self.status}
+        document = {"data": self.data, "status": self.status}
+        if self.next_cursor is not None:
+            document["next_cursor"] = self.next_cursor
+        return document
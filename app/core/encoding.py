@@ -0,0 +1,88 @@
+"""
+JSON encoding of API responses.
+
+Encoders (settings.JSON_ENCODER):
+    orjson - orjson, when it is installed (optional dependency), falling back to json
+    json   - the standard library encoder
+
+Both accept numpy scalars and arrays, pandas objects, dates and Decimals. Those types are
+recognized without importing numpy or pandas, which are only loaded by the analytics code.
+Both produce the same documents: the json encoder converts NaN, infinities and date keys like orjson.
+"""
+import datetime
+import decimal
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_builtin(obj):
+    """
+    Converts the values the encoders do not handle natively
+    :param obj: object
+    :return: JSON serializable object
+    """
+    module = type(obj).__module__.split('.')[0]
+    if module == 'numpy':
+        # Scalars and arrays
+        return obj.tolist()
+    if module == 'pandas':
+        if hasattr(obj, 'isoformat'):
+            # Timestamp, NaT
+            return None if obj != obj else obj.isoformat()
+        if hasattr(obj, 'to_dict') and hasattr(obj, 'columns'):
+            return obj.to_dict(orient='records')
+        if hasattr(obj, 'tolist'):
+            # Series, Index
+            return obj.tolist()
+        if hasattr(obj, 'to_dict'):
+            return obj.to_dict()
+        if repr(obj) == '<NA>':
+            return None
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def to_json_compatible(obj):
+    """
+    Converts a document to the values orjson would write, for the standard library encoder:
+    NaN and infinities become None, date keys their ISO format
+    :param obj: object
+    :return: JSON serializable object
+    """
+    if obj is None or isinstance(obj, (str, bool, int)):
+        return obj
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key.isoformat() if isinstance(key, (datetime.date, datetime.time)) else key: to_json_compatible(value)
+                for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json_compatible(value) for value in obj]
+    return to_json_compatible(to_builtin(obj))
+
+
+def dumps(data, encoder='orjson', indent=False):
+    """
+    Encodes a response document
+    :param data:    object
+    :param encoder: 'orjson' or 'json', orjson falls back to json when it is not installed
+    :param indent:  bool, pretty print (e.g. in debug mode)
+    :return: bytes
+    """
+    if encoder == 'orjson' and orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=to_builtin, option=option)
+
+    return (json.dumps(to_json_compatible(data), indent=4 if indent else None) + "\n").encode('utf-8')
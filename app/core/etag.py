@@ -0,0 +1,44 @@
+"""
+Conditional GET for resources derived from one user (see Repository.get_version).
+
+The ETag of a response is built from the user's version and from everything else the
+representation depends on (resource, query, Accept header), so that an If-None-Match
+request can be answered with a 304 before computing the response.
+"""
+import hashlib
+import json
+
+from flask import Response, request
+
+
+def strong_etag(version, *parts):
+    """
+    :param version: int, version of the user
+    :param parts:   JSON serializable values the representation depends on
+    :return: str, unquoted ETag
+    """
+    digest = hashlib.sha1(json.dumps([request.path, request.headers.get('Accept', ''), *parts]).encode('utf-8'))
+    return f"{version}-{digest.hexdigest()[:16]}"
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client already has this version
+    :param etag: str, unquoted
+    :return: Response or None
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+
+def etag_headers(etag):
+    """
+    Headers of a response carrying the ETag; clients must revalidate before reusing it
+    :param etag: str, unquoted
+    :return: dict
+    """
+    return {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
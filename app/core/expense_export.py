@@ -0,0 +1,73 @@
+"""
+Streaming serialization of expenses for /user/export/expenses/
+
+Expenses are written page by page as they are read from the repository, so an export
+never holds more than one page in memory (except on DynamoDB in list mode, where every page
+reads the whole history, so it is read once). Rows use the columns of /expenses/import/.
+"""
+import csv
+import io
+import json
+import zlib
+
+from core.expense_import import CSV, NDJSON
+
+COLUMNS = ['id', 'email', 'amount', 'date', 'description', 'comments', 'payor']
+
+MIMETYPES = {
+    CSV: 'text/csv',
+    NDJSON: 'application/x-ndjson',
+}
+
+
+def expense_row(exp):
+    """
+    :param exp: Expense
+    :return: dict with the COLUMNS
+    """
+    return {
+        'id': exp.id,
+        'email': exp.user_id,
+        'amount': float(exp.amount),
+        'date': exp.date,
+        'description': exp.description,
+        'comments': exp.comments,
+        'payor': exp.payor,
+    }
+
+
+def export_chunks(pages, format):
+    """
+    Serializes pages of expenses
+    :param pages:  iterable of lists of Expense
+    :param format: CSV or NDJSON
+    :return: iterator of str, one per page (the CSV header first)
+    """
+    if format == CSV:
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, COLUMNS)
+        writer.writeheader()
+        for page in pages:
+            writer.writerows(expense_row(exp) for exp in page)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    else:
+        for page in pages:
+            yield ''.join(json.dumps(expense_row(exp)) + '\n' for exp in page)
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compresses a stream of text chunks into a gzip stream, flushing after each chunk
+    so that the client receives every page as soon as it is read
+    :param chunks: iterator of str
+    :param level:  int, compression level
+    :return: iterator of bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,118 @@
+"""
+Parsing of expense files for /expenses/import/
+
+Rows are read one at a time from a binary stream (e.g. the request body), so files of any size
+can be imported without holding them in memory.
+
+    CSV    - header row with the fields of /expenses/add/: email, amount, date, description, comments, payor
+    NDJSON - one JSON object per line, with the same fields
+"""
+import csv
+import json
+import uuid
+from datetime import date as Date
+from decimal import Decimal, InvalidOperation
+
+from db import Expense
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+
+FORMATS = {
+    'text/csv': CSV,
+    'application/csv': CSV,
+    'application/x-ndjson': NDJSON,
+    'application/ndjson': NDJSON,
+    'application/jsonl': NDJSON,
+}
+
+
+class RowError(ValueError):
+    """
+    Exception raised when a row of an imported file is not a valid expense
+    """
+
+
+def import_format(mimetype, name=None):
+    """
+    Returns the format of an upload
+    :param mimetype: str, content type of the request
+    :param name:     str, explicit format (csv or ndjson), takes precedence
+    :return: CSV or NDJSON
+    """
+    if name:
+        if name not in (CSV, NDJSON):
+            raise ValueError('Unknown file format.')
+        return name
+    try:
+        return FORMATS[mimetype]
+    except KeyError:
+        raise ValueError('Unknown file format.')
+
+
+def read_rows(stream, format):
+    """
+    Reads the rows of a file incrementally
+    :param stream: binary file-like object, iterable by line
+    :param format: CSV or NDJSON
+    :return: iterator of (line number, dict or RowError)
+    """
+    lines = (line.decode('utf-8-sig') for line in stream)
+    if format == CSV:
+        reader = csv.DictReader(lines)
+        try:
+            for row in reader:
+                if None in row:
+                    yield reader.line_num, RowError('Too many columns')
+                else:
+                    yield reader.line_num, row
+        except csv.Error as err:
+            yield reader.line_num, RowError(err.__str__())
+    else:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, RowError('Invalid JSON')
+                continue
+            if not isinstance(row, dict):
+                yield number, RowError('Not a JSON object')
+            else:
+                yield number, row
+
+
+def row_to_expense(row):
+    """
+    Validates a row and builds its expense
+    :param row: dict
+    :return: Expense
+    """
+    email = (row.get('email') or '').strip()
+    if not email:
+        raise RowError('Missing email')
+
+    try:
+        amount = Decimal(str(row.get('amount') or '').strip())
+    except InvalidOperation:
+        raise RowError('Invalid amount')
+    if not amount.is_finite() or amount <= 0:
+        raise RowError('Invalid amount')
+
+    date = str(row.get('date') or '').strip()
+    try:
+        Date.fromisoformat(date[:10])
+    except ValueError:
+        raise RowError('Invalid date (yyyy-mm-dd)')
+
+    return Expense(
+        # Expense ids are derived from the time, which repeats within an import
+        id=uuid.uuid4().hex,
+        user_id=email,
+        amount=str(row['amount']).strip(),
+        date=date,
+        description=str(row.get('description') or ''),
+        comments=str(row.get('comments') or ''),
+        payor=(row.get('payor') or '').strip() or email,
+    )
@@ -0,0 +1,132 @@
+"""
+Expense forecasting for /expenses/stats/predict/
+
+Engines (settings.FORECAST_ENGINE):
+    numpy   - least squares trend plus monthly seasonality on monthly totals, fits in milliseconds
+    prophet - fbprophet model on the individual expenses (optional dependency)
+
+The engines import their scientific stack on first use, so that workers only load it
+once a forecast is actually requested. Their sections are timed in
+greevil_section_duration_seconds (see core/metrics.py).
+"""
+from core.metrics import timed
+
+# Months projected after the last month of history
+PERIODS = 3
+# Points returned (history + projection)
+POINTS = 12
+
+
+class Forecaster(object):
+    """Base class of the forecasting engines"""
+
+    def forecast(self, exp_list):
+        """
+        Forecasts the expenses
+        :param exp_list: list of dict (as returned by Expense.to_dict)
+        :return: list of {"x": date (yyyy-mm-dd), "y": amount}, the last PERIODS being the projection
+        """
+        raise NotImplementedError
+
+
+class NumpyForecaster(Forecaster):
+    """
+    Resamples the expenses to monthly totals and fits a linear trend with least squares.
+    With two years of history or more, the mean residual of each calendar month is added as seasonality.
+    """
+
+    def forecast(self, exp_list):
+        with timed('numpy_forecast'):
+            return self.__fit__(exp_list)
+
+    @staticmethod
+    def __fit__(exp_list):
+        import numpy as np
+
+        dates = np.array([exp['date'] for exp in exp_list]).astype('datetime64[us]').astype('datetime64[M]')
+        amounts = np.array([exp['amount'] for exp in exp_list], dtype=float)
+
+        # Monthly totals, months without expenses included
+        first = dates.min()
+        offsets = (dates - first).astype(int)
+        totals = np.bincount(offsets, weights=amounts)
+        months = np.arange(len(totals))
+
+        future = np.arange(len(totals) + PERIODS)
+        if len(totals) > 1:
+            slope, intercept = np.polyfit(months, totals, 1)
+            fitted = intercept + slope * future
+        else:
+            fitted = np.full(len(future), totals.mean())
+
+        if len(totals) >= 24:
+            calendar_month = (first.astype(int) + future) % 12
+            residuals = totals - fitted[:len(totals)]
+            seasonality = np.array([
+                residuals[calendar_month[:len(totals)] == month].mean() for month in range(12)
+            ])
+            fitted = fitted + seasonality[calendar_month]
+
+        x = (first + future).astype('datetime64[D]').astype(str).tolist()
+        return [{"x": day, "y": float(amount)} for day, amount in zip(x[-POINTS:], fitted[-POINTS:])]
+
+
+class ProphetForecaster(Forecaster):
+    """fbprophet model fitted on the individual expenses"""
+
+    def forecast(self, exp_list):
+        import pandas as pd
+        from fbprophet import Prophet
+
+        from core.frames import expense_frame
+
+        with timed('pandas_frame'):
+            df = expense_frame(exp_list)
+
+            prophet_df = pd.DataFrame()
+            prophet_df['ds'] = df['ds']
+            prophet_df['y'] = df['amount']
+
+        with timed('prophet_fit'):
+            m = Prophet()
+            m.fit(prophet_df)
+
+        with timed('prophet_predict'):
+            future = m.make_future_dataframe(periods=PERIODS, freq='MS')
+            forecast = m.predict(future)
+
+            forecast['x'] = forecast['ds'].dt.strftime('%Y-%m-%d')
+            forecast['y'] = forecast['yhat']
+
+            return forecast[['x', 'y']].tail(POINTS).to_dict(orient='records')
+
+
+ENGINES = {
+    'numpy': NumpyForecaster,
+    'prophet': ProphetForecaster,
+}
+
+
+def get_forecaster(engine):
+    """
+    Returns the forecasting engine with the given name
+    :param engine: str
+    :return: Forecaster
+    """
+    try:
+        return ENGINES[engine]()
+    except KeyError:
+        raise ValueError('Unknown forecasting engine.')
+
+
+def predict_chart(exp_list, engine='numpy'):
+    """
+    Forecasts the expense history and projects the next 3 months
+    :param exp_list: list of dict (as returned by Expense.to_dict)
+    :param engine:   str, see ENGINES
+    :return: dict - {"data": {"point": [{"x": date, "y": amount}, ...]}, "EndIndex": "9"}
+    """
+    predict_chart = {
+        "point": get_forecaster(engine).forecast(exp_list)
+    }
+    return {"data": predict_chart, "EndIndex": "9"}
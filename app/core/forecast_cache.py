@@ -0,0 +1,109 @@
+"""
+Cache of forecasts, keyed by user and by a fingerprint of the user's expense history.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class ForecastCache(object):
+    """
+    LRU cache holding the latest forecast of each user.
+    Entries expire after ttl seconds, or as soon as the history fingerprint changes.
+    When a directory is given, forecasts are also persisted there as JSON files, so they survive restarts
+    and are shared by the workers of a host.
+    """
+
+    def __init__(self, max_size=256, ttl=24 * 60 * 60, directory=None):
+        """
+        :param max_size:  int, number of users kept in memory
+        :param ttl:       int, seconds
+        :param directory: str or None
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory or None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, user_id, fingerprint):
+        """
+        Returns the cached forecast of a user if it is still valid for the fingerprint
+        :param user_id:     str
+        :param fingerprint: str
+        :return: forecast or None
+        """
+        entry = self.peek(user_id)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        return entry['result']
+
+    def peek(self, user_id):
+        """
+        Returns the cached entry of a user whatever its fingerprint, as long as it has not expired
+        :param user_id: str
+        :return: dict(fingerprint, result, created) or None
+        """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                self.entries.move_to_end(user_id)
+
+        if entry is None:
+            entry = self.__load__(user_id)
+            if entry is not None:
+                self.__remember__(user_id, entry)
+
+        if entry is None or time.time() - entry['created'] > self.ttl:
+            return None
+        return entry
+
+    def put(self, user_id, fingerprint, result):
+        """
+        Stores the forecast of a user
+        :param user_id:     str
+        :param fingerprint: str
+        :param result:      JSON serializable forecast
+        :return: None
+        """
+        entry = {'fingerprint': fingerprint, 'result': result, 'created': time.time()}
+        self.__remember__(user_id, entry)
+        self.__store__(user_id, entry)
+
+    def __remember__(self, user_id, entry):
+        with self.lock:
+            self.entries[user_id] = entry
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __path__(self, user_id):
+        return os.path.join(self.directory, hashlib.sha1(user_id.encode('utf-8')).hexdigest() + '.json')
+
+    def __load__(self, user_id):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.__path__(user_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __store__(self, user_id, entry):
+        if self.directory is None:
+            return
+        # Write then rename, so that other workers never read a partial file
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(path, self.__path__(user_id))
+        except (OSError, TypeError, ValueError):
+            os.remove(path)
@@ -0,0 +1,128 @@
+"""
+Background forecasting for /expenses/stats/predict/
+"""
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from core.forecast import predict_chart
+from core.metrics import sections
+
+# Finished jobs can be polled for this long (seconds)
+JOB_RETENTION = 10 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastJobs(object):
+    """
+    Runs forecasts in a pool of worker processes, off the request path.
+    Requests for a user whose forecast is already running are coalesced onto the running job,
+    and finished forecasts are stored in the forecast cache.
+    """
+
+    def __init__(self, cache, workers=2, engine='numpy'):
+        """
+        :param cache:   ForecastCache
+        :param workers: int, number of worker processes
+        :param engine:  str, forecasting engine (see core.forecast)
+        """
+        self.cache = cache
+        self.workers = workers
+        self.engine = engine
+        self.executor = None
+        # job id -> dict(user_id, fingerprint, future, finished)
+        self.jobs = {}
+        # user id -> id of the running job
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def running_job(self, user_id, fingerprint):
+        """
+        Returns the id of the job computing the forecast of a user for the fingerprint, if any
+        :param user_id:     str
+        :param fingerprint: str
+        :return: str or None
+        """
+        with self.lock:
+            job_id = self.running.get(user_id)
+            if job_id is not None and self.jobs[job_id]['fingerprint'] == fingerprint:
+                return job_id
+            return None
+
+    def submit(self, user_id, fingerprint, exp_list):
+        """
+        Starts forecasting the expenses of a user, unless the same forecast is already running
+        :param user_id:     str
+        :param fingerprint: str, fingerprint of the history (see db.rollup.rollup_fingerprint)
+        :param exp_list:    list of dict
+        :return: str, job id
+        """
+        with self.lock:
+            job_id = self.running.get(user_id)
+            if job_id is not None and self.jobs[job_id]['fingerprint'] == fingerprint:
+                return job_id
+
+            self.__prune__()
+            try:
+                future = self.__executor__().submit(predict_chart, exp_list, self.engine)
+            except BrokenProcessPool:
+                # A worker process died (e.g. killed for its memory), the pool refuses every job until replaced
+                logger.warning("Forecasting pool broken, starting a new one")
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                future = self.__executor__().submit(predict_chart, exp_list, self.engine)
+
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'user_id': user_id, 'fingerprint': fingerprint, 'future': future,
+                                 'submitted': time.perf_counter(), 'finished': None}
+            self.running[user_id] = job_id
+
+        future.add_done_callback(partial(self.__done__, job_id))
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns the state of a job
+        :param job_id: str
+        :return: (status, result) - status is "pending", "done" or "error", None for an unknown job
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None, None
+
+        future = job['future']
+        if not future.done():
+            return "pending", None
+        if future.exception() is not None:
+            return "error", future.exception()
+        return "done", {"xml": future.result()}
+
+    def __done__(self, job_id, future):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['finished'] = time.time()
+            if self.running.get(job['user_id']) == job_id:
+                del self.running[job['user_id']]
+        # The sections of the fit are timed in the forecasting process, only the whole job is seen here
+        sections.observe(('forecast_job',), time.perf_counter() - job['submitted'])
+
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(job['user_id'], job['fingerprint'], {"xml": future.result()})
+
+    def __executor__(self):
+        """The pool of worker processes, created lazily inside the (gunicorn) worker that uses it (the lock must be held)"""
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def __prune__(self):
+        """Forgets the jobs finished more than JOB_RETENTION seconds ago (the lock must be held)"""
+        expired = time.time() - JOB_RETENTION
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['finished'] and job['finished'] < expired]:
+            del self.jobs[job_id]
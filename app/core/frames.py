@@ -0,0 +1,31 @@
+"""
+pandas helpers for the analytics endpoints.
+"""
+import pandas as pd
+
+
+def parse_dates(dates):
+    """
+    Parses a column of ISO dates in one vectorized pass.
+    Dates and timestamps can be mixed ("2020-11-05", "2020-11-05T10:30:00.123456").
+    :param dates: pandas Series of str
+    :return: pandas Series of datetime64
+    """
+    try:
+        return pd.to_datetime(dates, format="ISO8601")
+    except (TypeError, ValueError):
+        # pandas < 2.0 does not know format="ISO8601", but infers mixed ISO formats by itself
+        return pd.to_datetime(dates)
+
+
+def expense_frame(exp_list):
+    """
+    Builds a DataFrame of expenses (as returned by Expense.to_dict), sorted by date.
+    Adds the parsed date as "ds".
+    :param exp_list: list of dict
+    :return: pandas DataFrame
+    """
+    df = pd.DataFrame(exp_list)
+    df['amount'] = pd.to_numeric(df['amount'])
+    df['ds'] = parse_dates(df['date'])
+    return df.sort_values('ds', kind='stable')
@@ -0,0 +1,48 @@
+"""
+Logging of the app, configured from LOG_LEVEL and LOG_SAMPLE_RATE (see settings.py).
+
+DEBUG records come from hot paths (every request, every item read), so only a sample of them
+is written; INFO and above are always written.
+"""
+import logging
+import random
+import sys
+
+FORMAT = "%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s"
+
+
+class SampleFilter(logging.Filter):
+    """Keeps a random fraction of the records below min_level"""
+
+    def __init__(self, rate, min_level=logging.INFO):
+        """
+        :param rate:      float, 0 to 1
+        :param min_level: int, records of this level and above are always kept
+        """
+        super().__init__()
+        self.rate = rate
+        self.min_level = min_level
+
+    def filter(self, record):
+        return record.levelno >= self.min_level or random.random() < self.rate
+
+
+def configure_logging(level="INFO", sample_rate=1.0, format=FORMAT):
+    """
+    Writes the records of the app to stderr (collected by gunicorn / docker)
+    :param level:       str or int, e.g. "DEBUG"
+    :param sample_rate: float, fraction of the DEBUG records written
+    :param format:      str, logging format
+    :return: None
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(format))
+    if sample_rate < 1:
+        handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    # botocore logs every request at DEBUG
+    for name in ("botocore", "boto3", "urllib3"):
+        logging.getLogger(name).setLevel(max(root.level, logging.INFO))
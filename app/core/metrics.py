@@ -0,0 +1,260 @@
+"""
+Prometheus metrics of the app, served in the text exposition format on /metrics.
+
+    greevil_http_request_duration_seconds     per method, endpoint (URL rule) and status
+    greevil_repository_call_duration_seconds  per backend and repository method (see db/timing.py)
+    greevil_dynamodb_call_duration_seconds    per DynamoDB operation, retries included
+    greevil_dynamodb_consumed_capacity_total  capacity units per DynamoDB operation and table
+    greevil_section_duration_seconds          pandas / Prophet / numpy sections of the analytics
+    greevil_repository_cache_total            hits and misses of the repository cache (db/cache.py)
+
+Metrics are kept per process: run a single gunicorn worker (with threads) for complete numbers,
+with several workers each scrape reaches one of them. Forecasts fitted in the background
+(FORECAST_WORKERS) are measured as a whole by the worker that submitted them.
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Counter(object):
+    """Monotonic counter per label values"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        :param name:          str, metric name
+        :param documentation: str, HELP line
+        :param labels:        tuple of str, label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """
+        :param labels: tuple of label values, in the order of the label names
+        :param amount: float
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """
+        :return: list of (name suffix, label values, extra label, value)
+        """
+        with self.lock:
+            return [('', labels, None, value) for labels, value in self.values.items()]
+
+
+class Histogram(object):
+    """Cumulative histogram of observations per label values"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: sorted tuple of float, upper bounds (+Inf is added)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # label values -> [count per bucket (not cumulative)..., sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """
+        :param labels: tuple of label values
+        :param value:  float, e.g. seconds
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+
+        samples = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', labels, f'le="{_format_value(bound)}"', cumulative))
+            samples.append(('_sum', labels, None, counts[-1]))
+            samples.append(('_count', labels, None, cumulative))
+        return samples
+
+
+class CallbackMetric(object):
+    """Metric whose samples are read from a callable when scraped (e.g. counters kept elsewhere)"""
+
+    def __init__(self, name, documentation, labels, type, callback):
+        """
+        :param type:     str, 'counter' or 'gauge'
+        :param callback: callable returning a list of (label values, value)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.type = type
+        self.callback = callback
+
+    def samples(self):
+        try:
+            return [('', labels, None, value) for labels, value in self.callback()]
+        except Exception:
+            logger.exception("Collecting %s failed", self.name)
+            return []
+
+
+class Registry(object):
+    """Metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Registers a metric, or returns the one already registered with its name
+        :return: the registered metric
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """
+        :return: str, text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, extra, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(metric.labels, labels, extra)} '
+                             f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.histogram(
+    'greevil_http_request_duration_seconds', 'Time to build the response of a request (streamed bodies excluded).',
+    ('method', 'endpoint', 'status'))
+repository_calls = REGISTRY.histogram(
+    'greevil_repository_call_duration_seconds', 'Time spent in the repository backend per method.',
+    ('backend', 'operation'))
+dynamodb_calls = REGISTRY.histogram(
+    'greevil_dynamodb_call_duration_seconds', 'Time of the DynamoDB API calls, retries included.',
+    ('operation', 'outcome'))
+dynamodb_capacity = REGISTRY.counter(
+    'greevil_dynamodb_consumed_capacity_total', 'Capacity units consumed by the DynamoDB API calls.',
+    ('operation', 'table'))
+sections = REGISTRY.histogram(
+    'greevil_section_duration_seconds', 'Time of the analytics sections (pandas, numpy, Prophet).',
+    ('section',))
+
+
+@contextmanager
+def timed(section):
+    """
+    Measures the block as a section of greevil_section_duration_seconds
+    :param section: str, e.g. 'prophet_fit'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        sections.observe((section,), time.perf_counter() - start)
+
+
+def register_cache(repository):
+    """
+    Exposes the hit and miss counters of a CachingRepository (see db/cache.py)
+    :param repository: repository, ignored unless it has cache_stats
+    """
+    if not hasattr(type(repository), 'cache_stats'):
+        return
+
+    def collect():
+        stats = repository.cache_stats()
+        return [((kind, result), count)
+                for kind, counters in stats.items() if isinstance(counters, dict)
+                for result, count in counters.items()]
+
+    REGISTRY.register(CallbackMetric('greevil_repository_cache_total', 'Lookups of the repository cache.',
+                                     ('kind', 'result'), 'counter', collect))
+
+
+def init_app(app, registry=REGISTRY):
+    """
+    Times every request and serves the registry on /metrics
+    :param app: Flask
+    """
+    from flask import Response, g, request
+
+    access_log = logging.getLogger('greevil.access')
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop('request_start', None)
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            # The URL rule, not the path, keeps the number of series bounded
+            endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_requests.observe((request.method, endpoint, str(response.status_code)), elapsed)
+            access_log.debug("%s %s %s %.1fms", request.method, request.path, response.status_code, elapsed * 1000)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype=None, content_type=CONTENT_TYPE)
@@ -1,4 +1,5 @@
 from xml.dom.minidom import Document
+from xml.sax.saxutils import escape
 
 
 class XmlTransformer(object):
@@ -76,3 +77,88 @@ class XmlTransformer(object):
         :return: string
         """
         return self.doc.toprettyxml(indent="\t")
+
+
+class XmlStream(object):
+    """
+    Serializes a python dictionary to XML incrementally, with the elements and escaping of XmlTransformer.
+    Iterating yields the document in chunks of about CHUNK_SIZE characters, so a response can be
+    streamed without building a DOM or the whole string first.
+    """
+    CHUNK_SIZE = 16 * 1024
+
+    # Text is escaped like minidom does
+    ENTITIES = {'"': "&quot;"}
+
+    def __init__(self, data: dict, pretty=False, indent="\t"):
+        """
+        :param data:   dict
+        :param pretty: bool, indent the elements like XmlTransformer (one per line)
+        :param indent: str, indentation of a level when pretty
+        """
+        if len(data) == 1:
+            # only one root element
+            self.root_name = str(list(data)[0])
+            self.root = data[self.root_name]
+        else:
+            # set "response" as default root element
+            self.root_name = "response"
+            self.root = data
+        self.pretty = pretty
+        self.indent = indent if pretty else ""
+        self.newl = "\n" if pretty else ""
+
+    def __iter__(self):
+        buffer = []
+        size = 0
+        for piece in self.pieces():
+            buffer.append(piece)
+            size += len(piece)
+            if size >= self.CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield "".join(buffer)
+
+    def __str__(self):
+        """
+        For print()
+        :return: string
+        """
+        return "".join(self.pieces())
+
+    def pieces(self):
+        """
+        Generates the document piece by piece
+        :return: iterator of str
+        """
+        yield '<?xml version="1.0" ?>\n'
+        yield from self.build(self.root_name, self.root, "")
+
+    def build(self, tag, structure, indent):
+        """
+        Recursively generate the elements of a value
+        :param tag:       str, tag name of the value
+        :param structure: dictionary, list or number/string
+        :param indent:    str, indentation of the element
+        :return: iterator of str
+        """
+        if isinstance(structure, dict):
+            # Empty lists produce no element
+            if not any(not isinstance(value, list) or value for value in structure.values()):
+                yield f"{indent}<{tag}/>{self.newl}"
+                return
+            yield f"{indent}<{tag}>{self.newl}"
+            for item in structure:
+                yield from self.build(str(item), structure[item], indent + self.indent)
+            yield f"{indent}</{tag}>{self.newl}"
+
+        elif isinstance(structure, list):
+            # One element per item, named after the list
+            for list_item in structure:
+                yield from self.build(tag, list_item, indent)
+
+        # Take int/float/double/string as string
+        else:
+            yield f"{indent}<{tag}>{escape(str(structure), self.ENTITIES)}</{tag}>{self.newl}"
@@ -1,7 +1,10 @@
 """
 Package for the db models.
 """
+import base64
+import binascii
 import hashlib
+import json
 import time
 from datetime import datetime
 
@@ -17,16 +20,32 @@ class User(object):
             friend_ids=None,
 
     ):
-        """Initializes the User Collection"""
+        """
+        Initializes the User Collection
+        :param expense_ids: list, or a callable returning the list when it is first accessed
+        """
         if friend_ids is None:
             friend_ids = []
-        if expense_ids is None:
-            expense_ids = []
         self.id = id
         self.name = name
         self.expense_ids = expense_ids
         self.friend_ids = friend_ids
 
+    @property
+    def expense_ids(self):
+        """
+        Ids of the expenses of the user, loaded on first access if a loader was given
+        """
+        if callable(self._expense_ids):
+            self._expense_ids = list(self._expense_ids())
+        return self._expense_ids
+
+    @expense_ids.setter
+    def expense_ids(self, expense_ids):
+        if expense_ids is None:
+            expense_ids = []
+        self._expense_ids = expense_ids
+
     def to_dict(self):
         """
         Converts object to python dictionary
@@ -94,6 +113,41 @@ class Expense(object):
         return obj
 
 
+def date_bounds(from_date=None, to_date=None):
+    """
+    Sort key bounds for a date range, both ends inclusive.
+    Dates are stored as ISO strings, so they compare lexicographically; "~" sorts after
+    any time component, which lets to_date cover the whole day.
+    :param from_date: str (yyyy-mm-dd) or None
+    :param to_date:   str (yyyy-mm-dd) or None
+    :return: (str, str) - low <= date < high
+    """
+    low = from_date or ""
+    high = to_date + "~" if to_date else "~"
+    return low, high
+
+
+def encode_cursor(position):
+    """
+    Builds an opaque pagination cursor
+    :param position: json serializable position of the last returned item (repository specific)
+    :return: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Reads a pagination cursor built by encode_cursor
+    :param cursor: str
+    :return: position
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, binascii.Error):
+        raise InvalidCursor
+
+
 class RepositoryException(Exception):
     """
     Exception raised when an object in the repository is not found
@@ -116,3 +170,9 @@ class ExpenseNotFound(RepositoryException):
     """
     Exception raised when an Expense object couldn't be retrieved from the repository, usually because it does not exist
     """
+
+
+class InvalidCursor(RepositoryException):
+    """
+    Exception raised when a pagination cursor is malformed or does not belong to the query
+    """
@@ -0,0 +1,312 @@
+"""
+Read-through cache of users, expenses and rollups, in front of any repository.
+
+Reads go to a size-bounded in-process LRU, then to the optional shared tier (e.g. redis,
+shared by the workers and hosts), then to the repository. Writes made through the cache
+invalidate the entries of every user and expense they touch, in both tiers.
+
+Once get_version has read the version of a user, the user and their rollup are cached under that
+version: entries loaded before a write made by another worker are not served with the newer version
+(e.g. under an ETag built from it).
+"""
+import copy
+import functools
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from . import User, Expense
+
+USER = "user:"
+EXPENSE = "expense:"
+ROLLUP = "rollup:"
+VERSION = "version:"
+
+
+class LRUCache(object):
+    """Thread-safe LRU of objects, expiring after ttl seconds"""
+
+    def __init__(self, max_size=1024, ttl=60):
+        """
+        :param max_size: int, number of entries
+        :param ttl:      int, seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: (found, value)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            if time.time() > entry[1]:
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedCache(object):
+    """
+    Interface of the shared cache tier. Values are bytes, implementations only store them.
+    """
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: bytes or None
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """
+        :param key:   str
+        :param value: bytes
+        :param ttl:   int, seconds
+        :return: None
+        """
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """
+        :param keys: list of str
+        :return: None
+        """
+        raise NotImplementedError
+
+
+class RedisCache(SharedCache):
+    """Shared tier on redis (optional dependency)"""
+
+    def __init__(self, url, prefix="greevil:"):
+        """
+        :param url:    str, e.g. redis://localhost:6379/0
+        :param prefix: str, prepended to every key
+        """
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+
+class CachingRepository(object):
+    """
+    Repository decorator caching get_user, get_expense and get_rollup.
+    Every other method is delegated to the wrapped repository.
+    """
+
+    def __init__(self, repository, max_size=1024, ttl=60, shared=None):
+        """
+        :param repository: repository to wrap (see db/factory.py)
+        :param max_size:   int, entries kept in process
+        :param ttl:        int, seconds an entry is trusted without being invalidated
+        :param shared:     SharedCache or None
+        """
+        self.repository = repository
+        self.name = repository.name
+        self.ttl = ttl
+        self.local = LRUCache(max_size, ttl)
+        self.shared = shared
+
+        self.counters = {kind: {'hits': 0, 'shared_hits': 0, 'misses': 0} for kind in (USER, EXPENSE, ROLLUP)}
+        self.counter_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+    def cache_stats(self):
+        """
+        Hit and miss counters per kind of object, with the size of the in-process LRU
+        :return: dict
+        """
+        with self.counter_lock:
+            stats = {kind.rstrip(':'): dict(counters) for kind, counters in self.counters.items()}
+        stats['size'] = len(self.local)
+        stats['max_size'] = self.local.max_size
+        return stats
+
+    ####################################################################################################################
+    def get_user(self, id):
+        return self.__read_through__(USER, self.__user_key__(USER, id), id, self.repository.get_user)
+
+    def get_version(self, user_id):
+        # Always read from the repository, the cached entries of the user are keyed by it
+        version = self.repository.get_version(user_id)
+        self.local.set(VERSION + user_id, version)
+        return version
+
+    def add_user(self, user: User):
+        result = self.repository.add_user(user)
+        self.__invalidate__(users=[user.id])
+        return result
+
+    def add_friend(self, user_id: str, friend_id: str):
+        try:
+            return self.repository.add_friend(user_id, friend_id)
+        finally:
+            self.__invalidate__(users=[user_id, friend_id])
+
+    def update_user(self, id, field, data=None):
+        try:
+            return self.repository.update_user(id, field, data)
+        finally:
+            self.__invalidate__(users=[id])
+
+    def get_expense(self, id):
+        return self.__read_through__(EXPENSE, EXPENSE + id, id, self.repository.get_expense)
+
+    def update_expense(self, id, field, data=None):
+        old = self.get_expense(id)
+        users = [old.user_id, old.payor]
+        if field in ('user_id', 'payor'):
+            users.append(data)
+        try:
+            return self.repository.update_expense(id, field, data)
+        finally:
+            self.__invalidate__(users=users, expenses=[id])
+
+    def delete_expense(self, id):
+        old = self.get_expense(id)
+        try:
+            return self.repository.delete_expense(id)
+        finally:
+            self.__invalidate__(users=[old.user_id, old.payor], expenses=[id])
+
+    def add_expense(self, exp: Expense):
+        try:
+            return self.repository.add_expense(exp)
+        finally:
+            self.__invalidate__(users=[exp.user_id, exp.payor], expenses=[exp.id])
+
+    def add_expenses(self, expenses):
+        try:
+            return self.repository.add_expenses(expenses)
+        finally:
+            self.__invalidate__(users={user_id for exp in expenses for user_id in (exp.user_id, exp.payor)},
+                                expenses=[exp.id for exp in expenses])
+
+    def get_rollup(self, user_id):
+        # Callers get their own copy, rollups are plain dicts
+        return dict(self.__read_through__(ROLLUP, self.__user_key__(ROLLUP, user_id), user_id,
+                                          self.repository.get_rollup))
+
+    def rebuild_rollups(self):
+        self.repository.rebuild_rollups()
+        # Rollups of every user may have changed, the shared tier expires them after ttl
+        self.local.clear()
+
+    ####################################################################################################################
+    def __user_key__(self, kind, user_id):
+        """
+        Cache key of the user or their rollup, with the last version read by get_version (if any).
+        Entries loaded after reading a version are at least as recent as that version.
+        :param kind:    USER or ROLLUP
+        :param user_id: str
+        :return: str
+        """
+        found, version = self.local.get(VERSION + user_id)
+        return f"{kind}{user_id}@{version}" if found else kind + user_id
+
+    def __read_through__(self, kind, key, id, load):
+        """
+        Returns the object from the first tier holding it, loading and caching it on a miss
+        :param kind: USER, EXPENSE or ROLLUP
+        :param key:  str, cache key of the object
+        :param id:   str
+        :param load: callable, reads the object from the repository
+        :return: object
+        """
+        found, value = self.local.get(key)
+        if found:
+            self.__count__(kind, 'hits')
+            return value
+
+        if self.shared is not None:
+            data = self.shared.get(key)
+            if data is not None:
+                value = pickle.loads(data)
+                if isinstance(value, User) and value._expense_ids is None:
+                    # Expense ids were not loaded by the process that cached the user
+                    value.expense_ids = functools.partial(self.__expense_ids__, value.id)
+                self.local.set(key, value)
+                self.__count__(kind, 'shared_hits')
+                return value
+
+        # Not found errors propagate and are not cached
+        self.__count__(kind, 'misses')
+        value = load(id)
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, pickle.dumps(self.__detach__(value)), self.ttl)
+        return value
+
+    @staticmethod
+    def __detach__(value):
+        """
+        Copy of an object that can be pickled. User expense ids may be loaded lazily by the repository:
+        they are not loaded here, an unloaded list is pickled as None.
+        """
+        if isinstance(value, User):
+            detached = User(id=value.id, name=value.name, friend_ids=list(value.friend_ids))
+            expense_ids = value._expense_ids
+            detached._expense_ids = None if callable(expense_ids) else list(expense_ids)
+            return detached
+        return copy.copy(value)
+
+    def __expense_ids__(self, user_id):
+        return self.repository.get_user(user_id).expense_ids
+
+    def __invalidate__(self, users=(), expenses=()):
+        """
+        Drops the cached users (with their rollups) and expenses from both tiers
+        :param users:    list of user ids
+        :param expenses: list of expense ids
+        :return: None
+        """
+        keys = [EXPENSE + id for id in expenses]
+        for id in users:
+            keys += {USER + id, ROLLUP + id, self.__user_key__(USER, id), self.__user_key__(ROLLUP, id)}
+        if self.shared is not None:
+            self.shared.delete(keys)
+        # Versions read before the write are outdated
+        self.local.delete(keys + [VERSION + id for id in users])
+
+    def __count__(self, kind, counter):
+        with self.counter_lock:
+            self.counters[kind][counter] += 1
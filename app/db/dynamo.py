@@ -2,29 +2,179 @@
 Repository of users and expenses - dynamodb
 """
 
+import bisect
+import copy
+import logging
+import os
+import threading
+import time
+
 import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+
+from core.metrics import dynamodb_calls, dynamodb_capacity
+
+from . import User, Expense, RepositoryException, ExpenseNotFound, UserNotFound, UserExists, InvalidCursor
+from . import date_bounds, encode_cursor, decode_cursor
+from .rollup import rollup_deltas
+
+logger = logging.getLogger(__name__)
+
+# batch_get_item accepts at most 100 keys per request, batch_write_item 25 items
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_RETRIES = 8
+# Expense writes conflicting with a concurrent write are re-read and retried
+TRANSACT_RETRIES = 5
+
+# Expense listing modes
+#   list  - expense ids are kept in the Expenses attribute of the user item
+#   index - expenses are queried through the participant indexes (see manage.py migrate-participant-index)
+LIST_MODE = 'list'
+INDEX_MODE = 'index'
+
+# Expense fields and their attributes in the expense table
+EXPENSE_FIELDS = {
+    'user_id': 'For',
+    'payor': 'By',
+    'amount': 'Amount',
+    'date': 'Date',
+    'description': 'Description',
+    'comments': 'Comments',
+}
+
+# Date, For, By and Comments are reserved words in DynamoDB expressions
+EXPENSE_PROJECTION = "#id, #amount, #date, #description, #comments, #for, #by"
+EXPENSE_ATTRIBUTE_NAMES = {
+    '#id': 'ExpenseId',
+    '#amount': 'Amount',
+    '#date': 'Date',
+    '#description': 'Description',
+    '#comments': 'Comments',
+    '#for': 'For',
+    '#by': 'By',
+}
+
+
+def _return_consumed_capacity(params, model, **kwargs):
+    """Asks every operation that can report it for its consumed capacity"""
+    if 'ReturnConsumedCapacity' in model.input_shape.members:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+
+def _start_call(model, context, **kwargs):
+    context['greevil_start'] = time.perf_counter()
+
+
+def _observe_call(http_response, parsed, model, context, **kwargs):
+    start = context.pop('greevil_start', None)
+    if start is not None:
+        dynamodb_calls.observe((model.name, 'ok' if http_response.status_code < 400 else 'error'),
+                               time.perf_counter() - start)
 
-from . import User, Expense, ExpenseNotFound, UserNotFound, UserExists
+    # A dict for single table operations, a list for batches and transactions
+    consumed = parsed.get('ConsumedCapacity') or []
+    for capacity in ([consumed] if isinstance(consumed, dict) else consumed):
+        if 'CapacityUnits' in capacity:
+            dynamodb_capacity.inc((model.name, capacity.get('TableName', '')), float(capacity['CapacityUnits']))
+
+
+def _observe_error(model, context, **kwargs):
+    """The call failed without a response (e.g. connection errors once retries are exhausted)"""
+    start = context.pop('greevil_start', None)
+    if start is not None:
+        dynamodb_calls.observe((model.name, 'error'), time.perf_counter() - start)
 
 
 class Repository(object):
     """
     Dynamodb repository
     user table = greevil-users
-        schema - CustomerId, Name, Expenses, Friends
+        schema - CustomerId, Name, Expenses, Friends, Version
     expenses table = greevil-expenses
         schema - ExpenseId, Amount, Date, Description, Comments, For, By
+        indexes (index mode) - For-Date-index (For, Date), By-Date-index (By, Date)
+    rollup table = greevil-rollups
+        schema - CustomerId, Bucket, Amount (see db/rollup.py)
     """
 
-    # TODO get all settings from settings.py
     def __init__(self, settings):
-        """Initializes the repository. Note that settings are not used."""
+        """
+        Initializes the repository. Connections are opened on first use, once per process,
+        so a repository created before gunicorn forks its workers is safe to use in each of them.
+        """
         self.name = 'DynamoDB'
+        self.settings = settings
+
+        self.expense_mode = settings.get('DYNAMODB_EXPENSE_MODE', LIST_MODE)
+        if self.expense_mode not in (LIST_MODE, INDEX_MODE):
+            raise ValueError('Unknown expense mode.')
+        self.payee_index = settings.get('DYNAMODB_PAYEE_INDEX', 'For-Date-index')
+        self.payor_index = settings.get('DYNAMODB_PAYOR_INDEX', 'By-Date-index')
+
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __connect__(self):
+        """
+        Creates the session, the resource (and its connection pool) and the tables of this process
+        :return: None
+        """
+        settings = self.settings
+        config = Config(
+            max_pool_connections=int(settings.get('DYNAMODB_MAX_POOL_CONNECTIONS', 10)),
+            retries={
+                'mode': settings.get('DYNAMODB_RETRY_MODE', 'standard'),
+                'total_max_attempts': int(settings.get('DYNAMODB_MAX_ATTEMPTS', 3)),
+            },
+            connect_timeout=float(settings.get('DYNAMODB_CONNECT_TIMEOUT', 60)),
+            read_timeout=float(settings.get('DYNAMODB_READ_TIMEOUT', 60)),
+            tcp_keepalive=bool(settings.get('DYNAMODB_TCP_KEEPALIVE', False)),
+        )
+        session = boto3.session.Session(region_name=settings.get('DYNAMODB_REGION', 'us-east-1'))
+        dynamodb = session.resource('dynamodb', config=config,
+                                    endpoint_url=settings.get('DYNAMODB_ENDPOINT_URL') or None)
+
+        self._user_index = dynamodb.Table(settings['DYNAMODB_USER_TABLE'])
+        self._expense_index = dynamodb.Table(settings['DYNAMODB_EXPENSE_TABLE'])
+        self._rollup_index = dynamodb.Table(settings.get('DYNAMODB_ROLLUP_TABLE', 'greevil-rollups'))
+        self._dynamodb = dynamodb
+
+        events = dynamodb.meta.client.meta.events
+        events.register('before-parameter-build.dynamodb', _return_consumed_capacity)
+        events.register('before-call.dynamodb', _start_call)
+        events.register('after-call.dynamodb', _observe_call)
+        events.register('after-call-error.dynamodb', _observe_error)
+
+    def __connection__(self):
+        """Connects on first use in a process, e.g. in a gunicorn worker forked after the app was loaded"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.__connect__()
+                    self._pid = os.getpid()
 
-        self.dynamodb = boto3.resource('dynamodb', region_name="us-east-1")
+    @property
+    def dynamodb(self):
+        """boto3 resource of the current process"""
+        self.__connection__()
+        return self._dynamodb
 
-        self.user_index = self.dynamodb.Table(settings['DYNAMODB_USER_TABLE'])
-        self.expense_index = self.dynamodb.Table(settings['DYNAMODB_EXPENSE_TABLE'])
+    @property
+    def user_index(self):
+        self.__connection__()
+        return self._user_index
+
+    @property
+    def expense_index(self):
+        self.__connection__()
+        return self._expense_index
+
+    @property
+    def rollup_index(self):
+        self.__connection__()
+        return self._rollup_index
 
     def get_user(self, id):
         """
@@ -33,26 +183,60 @@ class Repository(object):
         :return: User
         """
         response = self.user_index.get_item(
-            Key={'CustomerId': id}
+            Key={'CustomerId': id},
+            **self.__user_projection__()
         )
-        print(response['Item'])
+        logger.debug("Read user")
         try:
-            user_obj: User = User(
-                id=response['Item']['CustomerId'],
-                name=response["Item"]["Name"],
-                expense_ids=response["Item"]["Expenses"],
-                friend_ids=response["Item"]["Friends"]
-            )
-        except IndexError:
+            user_obj: User = self.__item_to_user__(response['Item'])
+        except (IndexError, KeyError):
             raise UserNotFound
         return user_obj
 
     def get_all_users(self):
         """
         Get all users from the repository
-        :return:
+        :return: list of User
+        """
+        users = []
+        kwargs = self.__user_projection__()
+        while True:
+            response = self.user_index.scan(**kwargs)
+            users.extend(self.__item_to_user__(item) for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return users
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def __user_projection__(self):
+        """
+        Projection of the user reads
+        :return: dict of keyword arguments
         """
-        return self.user_index.get_items()['Items']
+        if self.expense_mode == INDEX_MODE:
+            # Leave the (legacy) expense list behind, expense ids are loaded from the index when needed
+            return {
+                'ProjectionExpression': "CustomerId, #name, Friends",
+                'ExpressionAttributeNames': {'#name': 'Name'}
+            }
+        return {}
+
+    def __item_to_user__(self, item):
+        """
+        Builds a User from an item of the user table
+        :param item: dict
+        :return: User
+        """
+        user_id = item['CustomerId']
+        if self.expense_mode == INDEX_MODE:
+            expense_ids = lambda: [exp.id for exp in self.list_expenses(user_id)]
+        else:
+            expense_ids = item.get("Expenses")
+        return User(
+            id=user_id,
+            name=item["Name"],
+            expense_ids=expense_ids,
+            friend_ids=item.get("Friends")
+        )
 
     def add_user(self, user: User):
         """
@@ -60,11 +244,21 @@ class Repository(object):
         :param user:
         :return:
         """
-        # TODO
-        if self.user_index.get(user.id) is not None:
+        item = {
+            'CustomerId': user.id,
+            'Name': user.name,
+            'Friends': list(user.friend_ids),
+            'Version': 0
+        }
+        if self.expense_mode == LIST_MODE:
+            item['Expenses'] = list(user.expense_ids)
+        try:
+            self.user_index.put_item(
+                Item=item,
+                ConditionExpression="attribute_not_exists(CustomerId)"
+            )
+        except self.user_index.meta.client.exceptions.ConditionalCheckFailedException:
             raise UserExists
-
-        self.user_index[user.id] = user
         return user.id
 
     def add_friend(self, user_id: str, friend_id: str):
@@ -78,29 +272,86 @@ class Repository(object):
         user: User = self.get_user(user_id)
 
         def add_friend_helper(table, id, fid):
-            response = table.update_item(
+            try:
+                table.update_item(
+                    Key={
+                        'CustomerId': id
+                    },
+                    UpdateExpression="set Friends = list_append(if_not_exists(Friends,:empty_list), :i) add Version :one",
+                    ConditionExpression="attribute_not_exists(Friends) OR NOT contains(Friends, :fid)",
+                    ExpressionAttributeValues={
+                        ':i': [fid],
+                        ':fid': fid,
+                        ':empty_list': [],
+                        ':one': 1
+                    }
+                )
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                # Already friends
+                pass
+
+        # Adding friends (both ways)
+        add_friend_helper(self.user_index, user_id, friend_id)
+        add_friend_helper(self.user_index, friend_id, user_id)
+
+    def update_user(self, id, field, data=None):
+        """Update data for the specified user."""
+        if field == 'name':
+            # Name is a reserved word in DynamoDB expressions
+            kwargs = {'UpdateExpression': "set #name = :value", 'ExpressionAttributeNames': {'#name': 'Name'}}
+        elif field == 'friend_ids':
+            kwargs = {'UpdateExpression': "set Friends = :value"}
+            data = list(data or [])
+        else:
+            raise ValueError('Unknown user field.')
+        kwargs['UpdateExpression'] += " add Version :one"
+
+        try:
+            self.user_index.update_item(
                 Key={
                     'CustomerId': id
                 },
-                UpdateExpression="set Friends = list_append(if_not_exists(Friends,:empty_list), :i)",
+                ConditionExpression="attribute_exists(CustomerId)",
                 ExpressionAttributeValues={
-                    ':i': [fid],
-                    ':empty_list': []
+                    ':value': data,
+                    ':one': 1
                 },
-                ReturnValues="UPDATED_NEW"
+                **kwargs
             )
-            return response
+        except self.user_index.meta.client.exceptions.ConditionalCheckFailedException:
+            raise UserNotFound
 
-        # Adding friends (both ways)
-        add_friend_helper(self.user_index, user_id, friend_id)
-        add_friend_helper(self.user_index, friend_id, user_id)
+    def get_version(self, user_id):
+        """
+        Returns the version of a user, which changes whenever the user or one of their expenses changes
+        :param user_id: str
+        :return: int
+        """
+        response = self.user_index.get_item(
+            Key={'CustomerId': user_id},
+            ProjectionExpression="CustomerId, Version",
+            ConsistentRead=True
+        )
+        if 'Item' not in response:
+            raise UserNotFound
+        return int(response['Item'].get('Version', 0))
 
-    def update_user(self, id, field, data=None):
-        """Update data for the specified video."""
-        # TODO
-        user_obj = self.get_user(id)
-        # Set field attribute to data arg
-        setattr(user_obj, field, data)
+    def __version_helper__(self, user_id):
+        """
+        Bumps the version of a user
+        :param user_id: str
+        :return: None
+        """
+        self.user_index.update_item(
+            Key={
+                'CustomerId': user_id
+            },
+            UpdateExpression="add Version :one",
+            ConditionExpression="attribute_exists(CustomerId)",
+            ExpressionAttributeValues={
+                ':one': 1
+            }
+        )
 
     ####################################################################################################################
     def get_expense(self, id):
@@ -113,104 +364,813 @@ class Repository(object):
             response = self.expense_index.get_item(
                 Key={'ExpenseId': id}
             )
-            expense_obj: Expense = Expense(
-                id=id,
-                user_id=response['Item']["For"],
-                payor=response['Item']["By"],
-                amount=response['Item']["Amount"],
-                description=response["Item"]["Description"],
-                comments=response["Item"]["Comments"],
-                date=response["Item"]["Date"]
-            )
-        except IndexError:
+            expense_obj: Expense = self.__item_to_expense__(response['Item'])
+        except (IndexError, KeyError):
             raise ExpenseNotFound
 
         return expense_obj
 
+    def get_expenses(self, ids):
+        """
+        Returns the expenses connected with the ids, using batched reads.
+        Ids that do not exist are skipped.
+        :param ids: list of str
+        :return: list of Expense (in the order of ids)
+        """
+        ids = list(dict.fromkeys(ids))
+        items = {}
+        for start in range(0, len(ids), BATCH_GET_SIZE):
+            chunk = ids[start:start + BATCH_GET_SIZE]
+            for item in self.__batch_get_helper__([{'ExpenseId': id} for id in chunk]):
+                items[item['ExpenseId']] = item
+
+        return [self.__item_to_expense__(items[id]) for id in ids if id in items]
+
+    def list_expenses(self, user_id, from_date=None, to_date=None):
+        """
+        Returns the expenses of a user (as payee or payor) within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        expenses, _ = self.page_expenses(user_id, from_date, to_date)
+        return expenses
+
+    def page_expenses(self, user_id, from_date=None, to_date=None, limit=None, cursor=None):
+        """
+        Returns one page of the expenses of a user within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :param limit:     int, page size (None for everything)
+        :param cursor:    str, next_cursor of the previous page
+        :return: (list of Expense, next cursor or None)
+        """
+        if self.expense_mode == LIST_MODE:
+            # The id list has no order: every page reads and sorts the whole history (see full_read_pages)
+            low, high = date_bounds(from_date, to_date)
+            user: User = self.get_user(user_id)
+            expenses = sorted(
+                (exp for exp in self.get_expenses(user.expense_ids) if low <= exp.date < high),
+                key=lambda exp: (exp.date, exp.id)
+            )
+            return self.__list_page__(expenses, limit, cursor)
+
+        position = decode_cursor(cursor) if cursor is not None else None
+
+        if limit is None:
+            items = []
+            for index, attribute in ((self.payee_index, 'For'), (self.payor_index, 'By')):
+                items.extend(
+                    item for item in self.__query_helper__(index, self.__key_condition__(attribute, user_id, from_date, to_date))
+                    # Expenses paid for oneself show up in both indexes
+                    if attribute == 'For' or item['For'] != user_id
+                )
+            return sorted((self.__item_to_expense__(item) for item in items), key=lambda exp: (exp.date, exp.id)), None
+
+        return self.__index_page_helper__(user_id, from_date, to_date, limit, position or {})
+
+    @property
+    def full_read_pages(self):
+        """
+        True when every page of page_expenses reads the whole history of the user (list mode):
+        callers reading every page (e.g. exports) should use list_expenses instead
+        """
+        return self.expense_mode == LIST_MODE
+
+    @staticmethod
+    def __list_page__(expenses, limit, cursor):
+        """
+        Cuts a page out of a history sorted by (date, id), like the in-memory repository
+        :param expenses: list of Expense, sorted
+        :param limit:    int, page size (None for everything)
+        :param cursor:   str, (date, id) key of the last expense of the previous page
+        :return: (list of Expense, next cursor or None)
+        """
+        start = 0
+        if cursor is not None:
+            try:
+                start = bisect.bisect_right([(exp.date, exp.id) for exp in expenses], tuple(decode_cursor(cursor)))
+            except TypeError:
+                raise InvalidCursor
+
+        if limit is None or len(expenses) - start <= limit:
+            return expenses[start:], None
+        page = expenses[start:start + limit]
+        return page, encode_cursor([page[-1].date, page[-1].id])
+
+    def __index_page_helper__(self, user_id, from_date, to_date, limit, position):
+        """
+        Reads one page from both participant indexes and merges them in date order.
+        The cursor holds, for each index, the key of the last item consumed from it (a valid ExclusiveStartKey),
+        or None once the index is exhausted.
+        :return: (list of Expense, next cursor or None)
+        """
+        if not isinstance(position, dict):
+            raise InvalidCursor
+
+        streams = []
+        for index, attribute in ((self.payee_index, 'For'), (self.payor_index, 'By')):
+            kwargs = {
+                'IndexName': index,
+                'KeyConditionExpression': self.__key_condition__(attribute, user_id, from_date, to_date),
+                'ProjectionExpression': EXPENSE_PROJECTION,
+                'ExpressionAttributeNames': EXPENSE_ATTRIBUTE_NAMES,
+                'Limit': limit,
+            }
+            start_key = position.get(attribute, {})
+            if start_key is None:
+                streams.append({'attribute': attribute, 'items': [], 'more': False, 'last': None})
+                continue
+            if not isinstance(start_key, dict):
+                raise InvalidCursor
+            if start_key:
+                kwargs['ExclusiveStartKey'] = start_key
+            response = self.expense_index.query(**kwargs)
+            streams.append({
+                'attribute': attribute,
+                'items': response['Items'],
+                'more': 'LastEvaluatedKey' in response,
+                'last': start_key,
+                'last_evaluated': response.get('LastEvaluatedKey'),
+            })
+
+        page = []
+        while len(page) < limit:
+            # Items past the fetched ones are unknown, so a stream with more pages must not run dry
+            if any(not stream['items'] and stream['more'] for stream in streams):
+                break
+            heads = [stream for stream in streams if stream['items']]
+            if not heads:
+                break
+            stream = min(heads, key=lambda s: (s['items'][0]['Date'], s['items'][0]['ExpenseId']))
+            item = stream['items'].pop(0)
+            stream['last'] = {'ExpenseId': item['ExpenseId'], stream['attribute']: user_id, 'Date': item['Date']}
+            # Expenses paid for oneself show up in both indexes
+            if stream['attribute'] == 'For' or item['For'] != user_id:
+                page.append(self.__item_to_expense__(item))
+
+        next_position = {}
+        for stream in streams:
+            if stream['items']:
+                next_position[stream['attribute']] = stream['last']
+            else:
+                next_position[stream['attribute']] = stream['last_evaluated'] if stream['more'] else None
+        if all(key is None for key in next_position.values()):
+            return page, None
+        return page, encode_cursor(next_position)
+
+    @staticmethod
+    def __key_condition__(attribute, user_id, from_date, to_date):
+        """
+        Key condition on a participant index for a date range
+        :param attribute: 'For' or 'By'
+        :return: boto3 key condition
+        """
+        low, high = date_bounds(from_date, to_date)
+        key_condition = Key(attribute).eq(user_id)
+        if from_date is not None:
+            key_condition &= Key('Date').between(low, high)
+        elif to_date is not None:
+            key_condition &= Key('Date').lt(high)
+        return key_condition
+
+    def __query_helper__(self, index, key_condition):
+        """
+        Queries a participant index, following LastEvaluatedKey through all pages
+        :param index: name of the index
+        :param key_condition: boto3 key condition
+        :return: generator of items
+        """
+        kwargs = {
+            'IndexName': index,
+            'KeyConditionExpression': key_condition,
+            'ProjectionExpression': EXPENSE_PROJECTION,
+            'ExpressionAttributeNames': EXPENSE_ATTRIBUTE_NAMES,
+        }
+        while True:
+            response = self.expense_index.query(**kwargs)
+            yield from response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def __batch_get_helper__(self, keys):
+        """
+        Fetches up to BATCH_GET_SIZE expense items, retrying UnprocessedKeys with exponential backoff
+        :param keys: list of primary keys
+        :return: list of items
+        """
+        table = self.expense_index.name
+        request = {
+            table: {
+                'Keys': keys,
+                'ProjectionExpression': EXPENSE_PROJECTION,
+                'ExpressionAttributeNames': EXPENSE_ATTRIBUTE_NAMES,
+            }
+        }
+        items = []
+        for attempt in range(BATCH_RETRIES):
+            response = self.dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response['Responses'].get(table, []))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                return items
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+
+        raise ExpenseNotFound
+
+    @staticmethod
+    def __item_to_expense__(item):
+        """
+        Builds an Expense from an item of the expense table
+        :param item: dict
+        :return: Expense
+        """
+        return Expense(
+            id=item["ExpenseId"],
+            user_id=item["For"],
+            payor=item["By"],
+            amount=item["Amount"],
+            description=item["Description"],
+            comments=item["Comments"],
+            date=item["Date"]
+        )
+
     def update_expense(self, id, field, data=None):
-        # TODO
-        """Update data for the specified expense."""
-        exp_obj: Expense = self.get_expense(id)
-        # Set field attribute to data arg
-        setattr(exp_obj, field, data)
-        return exp_obj
+        """
+        Update data for the specified expense.
+        The expense, the expense lists of its participants and their rollups are written in one transaction.
+        """
+        if field not in EXPENSE_FIELDS:
+            raise ValueError('Unknown expense field.')
+
+        for attempt in range(TRANSACT_RETRIES):
+            old: Expense = self.__consistent_expense__(id)
+            exp_obj = copy.copy(old)
+            # Set field attribute to data arg
+            setattr(exp_obj, field, data)
+
+            actions = [self.__expense_update_action__(old, field, data)]
+            actions += self.__participant_actions__(old, exp_obj)
+            actions += self.__rollup_actions__(old, exp_obj)
+            if self.__transact__(actions, old, exp_obj):
+                return exp_obj
+            time.sleep(min(0.05 * 2 ** attempt, 1))
+
+        raise RepositoryException
 
     def delete_expense(self, id):
-        """Delete the specified expense."""
-        exp_obj: Expense = self.get_expense(id)
-        payor = self.get_user(exp_obj.payor)
-        payee = self.get_user(exp_obj.user_id)
-        payee_expenses = payee.expense_ids
-        payee_expenses.remove(id)
-        # TODO if None put an empty list
-        self.expense_index.delete_item(
-            Key={
-                'ExpenseId': id
+        """
+        Delete the specified expense.
+        The expense, the expense lists of its participants and their rollups are written in one transaction.
+        """
+        for attempt in range(TRANSACT_RETRIES):
+            old: Expense = self.__consistent_expense__(id)
+
+            actions = [{
+                'Delete': {
+                    'TableName': self.expense_index.name,
+                    'Key': {'ExpenseId': id},
+                    **self.__unchanged_condition__(old)
+                }
+            }]
+            actions += self.__participant_actions__(old, None)
+            actions += self.__rollup_actions__(old, None)
+            if self.__transact__(actions, old, None):
+                return
+            time.sleep(min(0.05 * 2 ** attempt, 1))
+
+        raise RepositoryException
+
+    def add_expense(self, exp: Expense):
+        """
+        Adds an expense object to the repository.
+        The expense, the expense lists of its participants and their rollups are written in one transaction,
+        which fails with UserNotFound if a participant does not exist and RepositoryException if the expense id
+        is already taken.
+        """
+        actions = [{
+            'Put': {
+                'TableName': self.expense_index.name,
+                'Item': {
+                    'ExpenseId': exp.id,
+                    'Amount': exp.amount,
+                    'Date': exp.date,
+                    'Description': exp.description,
+                    'Comments': exp.comments,
+                    'For': exp.user_id,
+                    'By': exp.payor
+                },
+                'ConditionExpression': "attribute_not_exists(ExpenseId)"
             }
-        )
+        }]
+        actions += self.__participant_actions__(None, exp)
+        actions += self.__rollup_actions__(None, exp)
+        for attempt in range(TRANSACT_RETRIES):
+            if self.__transact__(actions, None, exp):
+                return
+            time.sleep(min(0.05 * 2 ** attempt, 1))
 
-        self.user_index.update_item(
-            Key={
-                'CustomerId': exp_obj.user_id
-            },
-            UpdateExpression="set Expenses = :i",
-            ExpressionAttributeValues={
-                ':i': payee_expenses,
-            },
-            ReturnValues="UPDATED_NEW"
-        )
+        raise RepositoryException
 
-        if exp_obj.payor != exp_obj.user_id:
-            payor_expenses = payor.expense_ids
-            payor_expenses.remove(id)
-            self.user_index.update_item(
+    def add_expenses(self, expenses):
+        """
+        Adds many expense objects to the repository.
+        Expenses are written with batch_write_item; the expense lists and rollups of their participants are then
+        updated once per user and bucket. Unlike add_expense this is not atomic, run manage.py rebuild-rollups
+        if an import is interrupted. Expenses whose id is already taken (or repeated) get a RepositoryException.
+        :param expenses: list of Expense
+        :return: list of RepositoryException or None, one per expense
+        """
+        existing = self.__existing_keys__(self.user_index, 'CustomerId',
+                                          {user_id for exp in expenses for user_id in (exp.user_id, exp.payor)})
+        taken = self.__existing_keys__(self.expense_index, 'ExpenseId', {exp.id for exp in expenses})
+        errors = []
+        for exp in expenses:
+            if exp.user_id not in existing or exp.payor not in existing:
+                errors.append(UserNotFound())
+            elif exp.id in taken:
+                errors.append(RepositoryException())
+            else:
+                errors.append(None)
+                # The first of the expenses sharing an id is written
+                taken.add(exp.id)
+
+        requests = [{
+            'PutRequest': {
+                'Item': {
+                    'ExpenseId': exp.id,
+                    'Amount': exp.amount,
+                    'Date': exp.date,
+                    'Description': exp.description,
+                    'Comments': exp.comments,
+                    'For': exp.user_id,
+                    'By': exp.payor
+                }
+            }
+        } for exp, error in zip(expenses, errors) if error is None]
+
+        unprocessed = set()
+        for start in range(0, len(requests), BATCH_WRITE_SIZE):
+            unprocessed.update(self.__batch_write_helper__(requests[start:start + BATCH_WRITE_SIZE]))
+
+        written = []
+        for position, exp in enumerate(expenses):
+            if exp.id in unprocessed:
+                errors[position] = RepositoryException()
+            elif errors[position] is None:
+                written.append(exp)
+
+        expense_ids = {}
+        for exp in written:
+            for user_id in {exp.user_id, exp.payor}:
+                expense_ids.setdefault(user_id, []).append(exp.id)
+        for user_id, ids in expense_ids.items():
+            if self.expense_mode == LIST_MODE:
+                self.__expense_helper__(ids, user_id)
+            else:
+                self.__version_helper__(user_id)
+
+        deltas = {}
+        for exp in written:
+            for key, amount in rollup_deltas(None, exp).items():
+                deltas[key] = deltas.get(key, 0) + amount
+        for (user_id, bucket), amount in deltas.items():
+            self.rollup_index.update_item(
                 Key={
-                    'CustomerId': exp_obj.payor
+                    'CustomerId': user_id,
+                    'Bucket': bucket
                 },
-                UpdateExpression="set Expenses = :i",
+                UpdateExpression="add Amount :amount",
                 ExpressionAttributeValues={
-                    ':i': payor_expenses,
-                },
-                ReturnValues="UPDATED_NEW"
+                    ':amount': amount
+                }
             )
+        return errors
 
-    def add_expense(self, exp: Expense):
-        """Adds an expense object to the repository."""
-        payee: User = self.get_user(exp.user_id)
-        payor: User = self.get_user(exp.payor)
-
-        response = self.expense_index.put_item(
-            Item={
-                'ExpenseId': exp.id,
-                'Amount': exp.amount,
-                'Date': exp.date,
-                'Description': exp.description,
-                'Comments': exp.comments,
-                'For': exp.user_id,
-                'By': exp.payor
+    def __existing_keys__(self, index, key, ids):
+        """
+        Returns the ids of the items that exist in a table, fetched BATCH_GET_SIZE at a time
+        :param index: Table, e.g. self.user_index
+        :param key:   str, name of the hash key (e.g. 'CustomerId')
+        :param ids:   set of str
+        :return: set of str
+        """
+        table = index.name
+        ids = sorted(ids)
+        existing = set()
+        for start in range(0, len(ids), BATCH_GET_SIZE):
+            request = {
+                table: {
+                    'Keys': [{key: id} for id in ids[start:start + BATCH_GET_SIZE]],
+                    'ProjectionExpression': key,
+                }
             }
-        )
-        print(f"Expense response {response}")
-        self.__expense_helper__(exp.id, exp.payor)
-        if exp.user_id != exp.payor:
-            self.__expense_helper__(exp.id, exp.user_id)
+            for attempt in range(BATCH_RETRIES):
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                existing.update(item[key] for item in response['Responses'].get(table, []))
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            else:
+                raise RepositoryException
+        return existing
+
+    def __batch_write_helper__(self, requests):
+        """
+        Writes up to BATCH_WRITE_SIZE expense items, retrying UnprocessedItems with exponential backoff
+        :param requests: list of PutRequest
+        :return: set of ids of the expenses that could not be written
+        """
+        table = self.expense_index.name
+        request = {table: requests}
+        for attempt in range(BATCH_RETRIES):
+            response = self.dynamodb.batch_write_item(RequestItems=request)
+            request = response.get('UnprocessedItems')
+            if not request:
+                return set()
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+
+        return {item['PutRequest']['Item']['ExpenseId'] for item in request.get(table, [])}
 
-    def __expense_helper__(self, exp_id, user_id):
+    def __expense_helper__(self, exp_ids, user_id):
         """
-        Adds expenses to user document too
-        :param exp_id: expense id
-        :param user_id: id of user affected by the expense
+        Appends expenses to the expense list of a user, bumping their version
+        :param exp_ids: list of expense ids
+        :param user_id: id of user affected by the expenses
         :return:
         """
         response = self.user_index.update_item(
             Key={
                 'CustomerId': user_id
             },
-            UpdateExpression="set Expenses = list_append(if_not_exists(Expenses,:empty_list), :i)",
+            UpdateExpression="set Expenses = list_append(if_not_exists(Expenses,:empty_list), :i) add Version :one",
             ExpressionAttributeValues={
-                ':i': [exp_id],
-                ':empty_list': []
+                ':i': exp_ids,
+                ':empty_list': [],
+                ':one': 1
             },
             ReturnValues="UPDATED_NEW"
         )
         return response
+
+    def __consistent_expense__(self, id):
+        """
+        Strongly consistent read of an expense, the base of a conditional write
+        :param id: str
+        :return: Expense
+        """
+        response = self.expense_index.get_item(Key={'ExpenseId': id}, ConsistentRead=True)
+        if 'Item' not in response:
+            raise ExpenseNotFound
+        return self.__item_to_expense__(response['Item'])
+
+    @staticmethod
+    def __unchanged_condition__(exp):
+        """
+        Condition on the attributes the expense lists and rollups depend on, so that a write based on
+        a stale read fails instead of corrupting them
+        :param exp: Expense, as read
+        :return: dict of ConditionExpression, ExpressionAttributeNames and ExpressionAttributeValues
+        """
+        return {
+            'ConditionExpression': "#for = :old_for AND #by = :old_by AND #amount = :old_amount AND #date = :old_date",
+            'ExpressionAttributeNames': {'#for': 'For', '#by': 'By', '#amount': 'Amount', '#date': 'Date'},
+            'ExpressionAttributeValues': {
+                ':old_for': exp.user_id,
+                ':old_by': exp.payor,
+                ':old_amount': exp.amount,
+                ':old_date': exp.date,
+            }
+        }
+
+    def __expense_update_action__(self, old, field, data):
+        """
+        Transaction item updating one field of an expense
+        :param old:   Expense, as read
+        :param field: str, see EXPENSE_FIELDS
+        :param data:  new value
+        :return: dict
+        """
+        condition = self.__unchanged_condition__(old)
+        condition['ExpressionAttributeNames']['#field'] = EXPENSE_FIELDS[field]
+        condition['ExpressionAttributeValues'][':data'] = data
+        return {
+            'Update': {
+                'TableName': self.expense_index.name,
+                'Key': {'ExpenseId': old.id},
+                'UpdateExpression': "set #field = :data",
+                **condition
+            }
+        }
+
+    def __participant_actions__(self, old, new):
+        """
+        Transaction items keeping the participants of an expense consistent when it goes from old to new.
+        Every participant must exist and gets their version bumped. In list mode the expense id is also
+        added to or removed from their Expenses.
+        :param old: Expense or None
+        :param new: Expense or None
+        :return: list of dict
+        """
+        exp_id = (old or new).id
+        old_users = {old.user_id, old.payor} if old is not None else set()
+        new_users = {new.user_id, new.payor} if new is not None else set()
+
+        actions = []
+        for user_id in sorted(old_users | new_users):
+            update = "add Version :one"
+            condition = "attribute_exists(CustomerId)"
+            values = {':one': 1}
+            if self.expense_mode == LIST_MODE and user_id not in old_users:
+                update = "set Expenses = list_append(if_not_exists(Expenses, :empty_list), :i) " + update
+                values.update({':i': [exp_id], ':empty_list': []})
+            elif self.expense_mode == LIST_MODE and user_id not in new_users:
+                position = self.__expense_position__(exp_id, user_id)
+                if position is not None:
+                    # Fails if the list changed since it was read, the transaction is then retried
+                    update = f"remove Expenses[{position}] " + update
+                    condition = f"Expenses[{position}] = :id"
+                    values[':id'] = exp_id
+            actions.append({
+                'Update': {
+                    'TableName': self.user_index.name,
+                    'Key': {'CustomerId': user_id},
+                    'UpdateExpression': update,
+                    'ConditionExpression': condition,
+                    'ExpressionAttributeValues': values
+                }
+            })
+        return actions
+
+    def __expense_position__(self, exp_id, user_id):
+        """
+        Position of an expense in the Expenses list of a user
+        :param exp_id:  str
+        :param user_id: str
+        :return: int or None
+        """
+        response = self.user_index.get_item(
+            Key={'CustomerId': user_id},
+            ProjectionExpression="Expenses",
+            ConsistentRead=True
+        )
+        expense_ids = response.get('Item', {}).get('Expenses', [])
+        return expense_ids.index(exp_id) if exp_id in expense_ids else None
+
+    def __rollup_actions__(self, old, new):
+        """
+        Transaction items updating the rollups of the participants when an expense goes from old to new
+        :param old: Expense or None
+        :param new: Expense or None
+        :return: list of dict
+        """
+        return [{
+            'Update': {
+                'TableName': self.rollup_index.name,
+                'Key': {'CustomerId': user_id, 'Bucket': bucket},
+                'UpdateExpression': "add Amount :amount",
+                'ExpressionAttributeValues': {':amount': amount}
+            }
+        } for (user_id, bucket), amount in sorted(rollup_deltas(old, new).items())]
+
+    def __transact__(self, actions, old, new):
+        """
+        Runs the transaction items built for an expense going from old to new
+        :param actions: list of dict, items with python values (serialized by the resource client)
+        :param old:     Expense or None
+        :param new:     Expense or None
+        :return: bool, False when the expense or an expense list changed since it was read,
+                 or a concurrent transaction conflicted (retry)
+        :raises UserNotFound: a participant of new does not exist
+        :raises RepositoryException: the id of an added expense is already taken
+        """
+        client = self.dynamodb.meta.client
+        try:
+            client.transact_write_items(TransactItems=actions)
+        except client.exceptions.TransactionCanceledException as err:
+            reasons = err.response.get('CancellationReasons', [])
+            failed = [action for action, reason in zip(actions, reasons)
+                      if reason.get('Code') == 'ConditionalCheckFailed']
+            if not failed:
+                # Concurrent transactions on the same items (e.g. the user of both) are retried too
+                if any(reason.get('Code') == 'TransactionConflict' for reason in reasons):
+                    return False
+                raise
+            new_users = {new.user_id, new.payor} if new is not None else set()
+            old_users = {old.user_id, old.payor} if old is not None else set()
+            for action in failed:
+                (kind, params), = action.items()
+                if kind == 'Put':
+                    # Expense id already taken, retrying would not help
+                    raise RepositoryException
+                user_id = params['Key'].get('CustomerId')
+                if params['TableName'] == self.user_index.name and user_id in new_users - old_users:
+                    raise UserNotFound
+            return False
+        return True
+
+    def get_rollup(self, user_id):
+        """
+        Returns the rollup buckets of a user (see db/rollup.py)
+        :param user_id: str
+        :return: dict of bucket -> amount
+        """
+        buckets = {}
+        kwargs = {'KeyConditionExpression': Key('CustomerId').eq(user_id)}
+        while True:
+            response = self.rollup_index.query(**kwargs)
+            for item in response['Items']:
+                buckets[item['Bucket']] = item['Amount']
+            if 'LastEvaluatedKey' not in response:
+                return buckets
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def rebuild_rollups(self):
+        """
+        Recomputes every rollup from the expense table, creating the rollup table if needed
+        :return: None
+        """
+        client = self.dynamodb.meta.client
+        try:
+            client.describe_table(TableName=self.rollup_index.name)
+        except client.exceptions.ResourceNotFoundException:
+            client.create_table(
+                TableName=self.rollup_index.name,
+                KeySchema=[
+                    {'AttributeName': 'CustomerId', 'KeyType': 'HASH'},
+                    {'AttributeName': 'Bucket', 'KeyType': 'RANGE'},
+                ],
+                AttributeDefinitions=[
+                    {'AttributeName': 'CustomerId', 'AttributeType': 'S'},
+                    {'AttributeName': 'Bucket', 'AttributeType': 'S'},
+                ],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            self.rollup_index.wait_until_exists()
+            logger.info("Created %s", self.rollup_index.name)
+
+        buckets = {}
+        kwargs = {
+            'ProjectionExpression': EXPENSE_PROJECTION,
+            'ExpressionAttributeNames': EXPENSE_ATTRIBUTE_NAMES,
+        }
+        while True:
+            response = self.expense_index.scan(**kwargs)
+            for item in response['Items']:
+                for key, amount in rollup_deltas(None, self.__item_to_expense__(item)).items():
+                    buckets[key] = buckets.get(key, 0) + amount
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        with self.rollup_index.batch_writer(overwrite_by_pkeys=['CustomerId', 'Bucket']) as batch:
+            # Drop the buckets that no longer have any expense
+            kwargs = {
+                'ProjectionExpression': 'CustomerId, #bucket',
+                'ExpressionAttributeNames': {'#bucket': 'Bucket'},
+            }
+            while True:
+                response = self.rollup_index.scan(**kwargs)
+                for item in response['Items']:
+                    if (item['CustomerId'], item['Bucket']) not in buckets:
+                        batch.delete_item(Key={'CustomerId': item['CustomerId'], 'Bucket': item['Bucket']})
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+            for (user_id, bucket), amount in buckets.items():
+                batch.put_item(Item={'CustomerId': user_id, 'Bucket': bucket, 'Amount': amount})
+        logger.info("Rebuilt %d rollup buckets", len(buckets))
+
+    ####################################################################################################################
+    def create_tables(self):
+        """
+        Creates the user, expense and rollup tables (on demand billing) that do not exist yet, with the participant
+        indexes in index mode, e.g. for DynamoDB Local or tests
+        :return: None
+        """
+        client = self.dynamodb.meta.client
+        existing = set(client.list_tables()['TableNames'])
+
+        expense_table = {
+            'KeySchema': [{'AttributeName': 'ExpenseId', 'KeyType': 'HASH'}],
+            'AttributeDefinitions': [{'AttributeName': 'ExpenseId', 'AttributeType': 'S'}],
+        }
+        if self.expense_mode == INDEX_MODE:
+            expense_table['AttributeDefinitions'] += [
+                {'AttributeName': 'For', 'AttributeType': 'S'},
+                {'AttributeName': 'By', 'AttributeType': 'S'},
+                {'AttributeName': 'Date', 'AttributeType': 'S'},
+            ]
+            expense_table['GlobalSecondaryIndexes'] = [{
+                'IndexName': index,
+                'KeySchema': [
+                    {'AttributeName': attribute, 'KeyType': 'HASH'},
+                    {'AttributeName': 'Date', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+            } for index, attribute in ((self.payee_index, 'For'), (self.payor_index, 'By'))]
+
+        tables = {
+            self.user_index: {
+                'KeySchema': [{'AttributeName': 'CustomerId', 'KeyType': 'HASH'}],
+                'AttributeDefinitions': [{'AttributeName': 'CustomerId', 'AttributeType': 'S'}],
+            },
+            self.expense_index: expense_table,
+            self.rollup_index: {
+                'KeySchema': [
+                    {'AttributeName': 'CustomerId', 'KeyType': 'HASH'},
+                    {'AttributeName': 'Bucket', 'KeyType': 'RANGE'},
+                ],
+                'AttributeDefinitions': [
+                    {'AttributeName': 'CustomerId', 'AttributeType': 'S'},
+                    {'AttributeName': 'Bucket', 'AttributeType': 'S'},
+                ],
+            },
+        }
+        for table, schema in tables.items():
+            if table.name in existing:
+                logger.info("%s already exists", table.name)
+                continue
+            client.create_table(TableName=table.name, BillingMode='PAY_PER_REQUEST', **schema)
+            table.wait_until_exists()
+            logger.info("Created %s", table.name)
+
+    def migrate_participant_index(self, drop_expense_lists=False):
+        """
+        Creates the participant indexes (For/Date and By/Date) on the expense table and waits for them to be backfilled.
+        Optionally removes the Expenses lists from the user items afterwards (only once every reader runs in index mode).
+        :param drop_expense_lists: bool
+        :return: None
+        """
+        client = self.dynamodb.meta.client
+        table = self.expense_index.name
+
+        for index, attribute in ((self.payee_index, 'For'), (self.payor_index, 'By')):
+            description = client.describe_table(TableName=table)['Table']
+            if index in [gsi['IndexName'] for gsi in description.get('GlobalSecondaryIndexes', [])]:
+                logger.info("%s already exists", index)
+            else:
+                gsi = {
+                    'IndexName': index,
+                    'KeySchema': [
+                        {'AttributeName': attribute, 'KeyType': 'HASH'},
+                        {'AttributeName': 'Date', 'KeyType': 'RANGE'},
+                    ],
+                    'Projection': {'ProjectionType': 'ALL'},
+                }
+                if description.get('BillingModeSummary', {}).get('BillingMode') != 'PAY_PER_REQUEST':
+                    throughput = description['ProvisionedThroughput']
+                    gsi['ProvisionedThroughput'] = {
+                        'ReadCapacityUnits': throughput['ReadCapacityUnits'],
+                        'WriteCapacityUnits': throughput['WriteCapacityUnits'],
+                    }
+                client.update_table(
+                    TableName=table,
+                    AttributeDefinitions=[
+                        {'AttributeName': attribute, 'AttributeType': 'S'},
+                        {'AttributeName': 'Date', 'AttributeType': 'S'},
+                    ],
+                    GlobalSecondaryIndexUpdates=[{'Create': gsi}]
+                )
+                logger.info("Creating %s", index)
+
+            # Only one index can be created at a time
+            self.__wait_for_index__(index)
+            logger.info("%s is active", index)
+
+        if drop_expense_lists:
+            kwargs = {'ProjectionExpression': 'CustomerId'}
+            while True:
+                response = self.user_index.scan(**kwargs)
+                for item in response['Items']:
+                    self.user_index.update_item(
+                        Key={'CustomerId': item['CustomerId']},
+                        UpdateExpression="remove Expenses"
+                    )
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            logger.info("Removed expense lists from users")
+
+    def __wait_for_index__(self, index, delay=10):
+        """
+        Blocks until the index on the expense table is active (backfilling finished)
+        :param index: name of the index
+        :param delay: seconds between polls
+        :return: None
+        """
+        client = self.dynamodb.meta.client
+        while True:
+            description = client.describe_table(TableName=self.expense_index.name)['Table']
+            status = [
+                gsi.get('IndexStatus') for gsi in description.get('GlobalSecondaryIndexes', [])
+                if gsi['IndexName'] == index
+            ]
+            if status == ['ACTIVE'] and description['TableStatus'] == 'ACTIVE':
+                return
+            time.sleep(delay)
@@ -4,14 +4,46 @@ Factory for the different types of db/repositories.
 
 # Only if you are storing objects in the memory
 _local_connection_obj = None
+# Dynamodb repositories by settings, sharing their connection pool within a process
+_dynamodb_repositories = {}
+# Mongodb repositories by settings, sharing their MongoClient pool within a process
+_mongodb_repositories = {}
+# SQLite repositories by settings, each one keeps a connection per thread
+_sqlite_repositories = {}
+# Caching repositories by backend and settings, so that writes made through one invalidate the cache of all
+_cached_repositories = {}
+# Timed repositories by backend and settings
+_timed_repositories = {}
 
 
-def create_repository(name, settings):
+def create_repository(name, settings, cache_settings=None, timer=None):
     """Creates a repository from its name and settings. The settings
     is a dictionary where the keys are different for every type of repository.
-    See each repository for details on the required settings."""
+    See each repository for details on the required settings.
+    With cache_settings (see REPOSITORY_CACHE_SETTINGS in settings.py), the repository
+    is wrapped in a read-through cache (see db/cache.py).
+    With a timer (a histogram of core/metrics.py), every call reaching the backend
+    is timed (see db/timing.py)."""
+    if cache_settings and cache_settings.get('REPOSITORY_CACHE_SIZE'):
+        key = (name, tuple(sorted(settings.items())), timer is not None)
+        if key not in _cached_repositories:
+            _cached_repositories[key] = _create_cache(create_repository(name, settings, timer=timer), cache_settings)
+        return _cached_repositories[key]
+
+    if timer is not None:
+        from .timing import TimedRepository
+        key = (name, tuple(sorted(settings.items())))
+        if key not in _timed_repositories:
+            _timed_repositories[key] = TimedRepository(create_repository(name, settings), timer)
+        return _timed_repositories[key]
+
     if name == 'mongodb':
         from .mongo import Repository
+        key = tuple(sorted(settings.items()))
+        if key not in _mongodb_repositories:
+            _mongodb_repositories[key] = Repository(settings)
+        return _mongodb_repositories[key]
+
     elif name == 'memory':
         from .memory import Repository
         global _local_connection_obj
@@ -21,7 +53,27 @@ def create_repository(name, settings):
 
     elif name == 'dynamodb':
         from .dynamo import Repository
+        key = tuple(sorted(settings.items()))
+        if key not in _dynamodb_repositories:
+            _dynamodb_repositories[key] = Repository(settings)
+        return _dynamodb_repositories[key]
+
+    elif name == 'sqlite':
+        from .sqlite import Repository
+        key = tuple(sorted(settings.items()))
+        if key not in _sqlite_repositories:
+            _sqlite_repositories[key] = Repository(settings)
+        return _sqlite_repositories[key]
+
     else:
         raise ValueError('Unknown repository.')
 
-    return Repository(settings)
+
+def _create_cache(repository, cache_settings):
+    from .cache import CachingRepository, RedisCache
+
+    shared = None
+    if cache_settings.get('REPOSITORY_CACHE_REDIS_URL'):
+        shared = RedisCache(cache_settings['REPOSITORY_CACHE_REDIS_URL'])
+    return CachingRepository(repository, max_size=cache_settings['REPOSITORY_CACHE_SIZE'],
+                             ttl=cache_settings.get('REPOSITORY_CACHE_TTL', 60), shared=shared)
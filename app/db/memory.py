@@ -1,19 +1,61 @@
 """
 Repository of users and expenses that uses in-memory objects, no serialization.
-Used for testing only.
+
+Thread-safe, with the expenses of every user indexed by date, so that it can serve a single process
+deployment. State can be snapshotted to a JSON file and loaded back at startup (MEMORY_SNAPSHOT_FILE).
 """
 
-from . import User, Expense, ExpenseNotFound, UserNotFound, UserExists
+import atexit
+import bisect
+import copy
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from . import User, Expense, RepositoryException, ExpenseNotFound, UserNotFound, UserExists, InvalidCursor
+from . import date_bounds, encode_cursor, decode_cursor
+from .rollup import rollup_deltas
+
+# Users are guarded by one of LOCK_STRIPES locks, chosen by the hash of their id
+LOCK_STRIPES = 64
+
+# Fields that can be updated
+USER_FIELDS = ('name', 'friend_ids')
+EXPENSE_FIELDS = ('user_id', 'payor', 'amount', 'date', 'description', 'comments')
 
 
 class Repository(object):
     """In-Memory repository."""
 
     def __init__(self, settings):
-        """Initializes the repository. Note that settings are not used."""
+        """
+        Initializes the repository, loading the snapshot if there is one.
+        :param settings: dict - MEMORY_SNAPSHOT_FILE (str, optional), MEMORY_SNAPSHOT_INTERVAL (seconds, 0 = only at exit)
+        """
         self.name = 'In-Memory'
         self.user_index = {}
         self.expense_index = {}
+        # user id -> sorted list of (date, expense id)
+        self.date_index = {}
+        # (user id, user id), sorted -> sorted list of (date, expense id) of the expenses between the two users
+        self.counterparty_index = {}
+        # user id -> rollup buckets (see db/rollup.py)
+        self.rollup_index = {}
+        # user id -> version, bumped by every change to the user or their expenses
+        self.version_index = {}
+
+        # Writes lock the stripes of every user they touch, reads the stripe of the user they read
+        self.locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        # Adds of expenses between other users hold other stripes, new expense ids are claimed under this lock
+        self.expense_id_lock = threading.Lock()
+
+        self.snapshot_file = settings.get('MEMORY_SNAPSHOT_FILE') or None
+        if self.snapshot_file is not None:
+            if os.path.exists(self.snapshot_file):
+                self.load(self.snapshot_file)
+            self.__schedule_snapshots__(float(settings.get('MEMORY_SNAPSHOT_INTERVAL', 0)))
 
     def get_user(self, id):
         """
@@ -31,7 +73,7 @@ class Repository(object):
         Get all users from the repository
         :return:
         """
-        return self.user_index.values()
+        return list(self.user_index.values())
 
     def add_user(self, user: User):
         """
@@ -39,10 +81,11 @@ class Repository(object):
         :param user:
         :return:
         """
-        if self.user_index.get(user.id) is not None:
-            raise UserExists
+        with self.__locked__(user.id):
+            if self.user_index.get(user.id) is not None:
+                raise UserExists
 
-        self.user_index[user.id] = user
+            self.user_index[user.id] = user
         return user.id
 
     def add_friend(self, user_id: str, friend_id: str):
@@ -52,19 +95,40 @@ class Repository(object):
         :param friend_id:  str
         :return:
         """
-        friend: User = self.get_user(friend_id)
-        user: User = self.get_user(user_id)
-        user.friend_ids.append(friend_id)
-        friend.friend_ids.append(user_id)
+        with self.__locked__(user_id, friend_id):
+            friend: User = self.get_user(friend_id)
+            user: User = self.get_user(user_id)
+            user.friend_ids.append(friend_id)
+            friend.friend_ids.append(user_id)
 
-        user.friend_ids = list(set(user.friend_ids))
-        friend.friend_ids = list(set(friend.friend_ids))
+            user.friend_ids = list(set(user.friend_ids))
+            friend.friend_ids = list(set(friend.friend_ids))
+            self.__bump_version__(user_id)
+            self.__bump_version__(friend_id)
 
     def update_user(self, id, field, data=None):
-        """Update data for the specified video."""
-        user_obj = self.get_user(id)
-        # Set field attribute to data arg
-        setattr(user_obj, field, data)
+        """Update data for the specified user."""
+        if field not in USER_FIELDS:
+            raise ValueError('Unknown user field.')
+        if field == 'friend_ids':
+            data = list(data or [])
+        with self.__locked__(id):
+            user_obj = self.get_user(id)
+            # Set field attribute to data arg
+            setattr(user_obj, field, data)
+            self.__bump_version__(id)
+
+    def get_version(self, user_id):
+        """
+        Returns the version of a user, which changes whenever the user or one of their expenses changes
+        :param user_id: str
+        :return: int
+        """
+        self.get_user(user_id)
+        return self.version_index.get(user_id, 0)
+
+    def __bump_version__(self, user_id):
+        self.version_index[user_id] = self.version_index.get(user_id, 0) + 1
 
     ####################################################################################################################
     def get_expense(self, id):
@@ -79,28 +143,313 @@ class Repository(object):
 
         return expense_obj
 
+    def get_expenses(self, ids):
+        """
+        Returns the expenses connected with the ids, skipping the ones that do not exist
+        :param ids: list of str
+        :return: list of Expense (in the order of ids)
+        """
+        expense_index = self.expense_index
+        return [expense_index[id] for id in ids if id in expense_index]
+
+    def list_expenses(self, user_id, from_date=None, to_date=None):
+        """
+        Returns the expenses of a user (as payee or payor) within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        expenses, _ = self.page_expenses(user_id, from_date, to_date)
+        return expenses
+
+    def page_expenses(self, user_id, from_date=None, to_date=None, limit=None, cursor=None):
+        """
+        Returns one page of the expenses of a user within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :param limit:     int, page size (None for everything)
+        :param cursor:    str, next_cursor of the previous page
+        :return: (list of Expense, next cursor or None)
+        """
+        self.get_user(user_id)
+        with self.__locked__(user_id):
+            return self.__page__(self.date_index.get(user_id, []), from_date, to_date, limit, cursor)
+
+    def list_shared_expenses(self, user_id, counterparty_id, from_date=None, to_date=None):
+        """
+        Returns the expenses between two users (one paying for the other) within a date range, ordered by date
+        :param user_id:         str
+        :param counterparty_id: str
+        :param from_date:       str (yyyy-mm-dd), inclusive
+        :param to_date:         str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        self.get_user(user_id)
+        self.get_user(counterparty_id)
+        with self.__locked__(user_id, counterparty_id):
+            index = self.counterparty_index.get(tuple(sorted((user_id, counterparty_id))), [])
+            expenses, _ = self.__page__(index, from_date, to_date)
+        return expenses
+
+    def __page__(self, index, from_date=None, to_date=None, limit=None, cursor=None):
+        """
+        Reads a page of a date index with binary searches (the lock of the index must be held)
+        :param index: sorted list of (date, expense id)
+        :return: (list of Expense, next cursor or None)
+        """
+        low, high = date_bounds(from_date, to_date)
+        start = bisect.bisect_left(index, (low,))
+        end = bisect.bisect_left(index, (high,))
+        if cursor is not None:
+            # Cursor is the (date, id) key of the last returned expense
+            try:
+                start = max(start, bisect.bisect_right(index, tuple(decode_cursor(cursor))))
+            except TypeError:
+                raise InvalidCursor
+
+        next_cursor = None
+        if limit is not None and end - start > limit:
+            end = start + limit
+            next_cursor = encode_cursor(index[end - 1])
+        return [self.expense_index[id] for _, id in index[start:end]], next_cursor
+
     def update_expense(self, id, field, data=None):
         """Update data for the specified expense."""
-        exp_obj: Expense = self.get_expense(id)
-        # Set field attribute to data arg
-        setattr(exp_obj, field, data)
+        if field not in EXPENSE_FIELDS:
+            raise ValueError('Unknown expense field.')
+        users = [data] if field in ('user_id', 'payor') else []
+        with self.__expense_locked__(id, *users) as exp_obj:
+            for user_id in users:
+                self.get_user(user_id)
+            old = copy.copy(exp_obj)
+            updated = copy.copy(exp_obj)
+            setattr(updated, field, data)
+            # Raises on invalid values before anything is changed
+            deltas = rollup_deltas(old, updated)
+            # Participants and date are indexed
+            self.__unindex_expense__(exp_obj)
+            # Set field attribute to data arg
+            setattr(exp_obj, field, data)
+            self.__index_expense__(exp_obj)
+            self.__rollup_helper__(deltas)
         return exp_obj
 
     def delete_expense(self, id):
         """Delete the specified expense."""
-        exp_obj: Expense = self.get_expense(id)
-        payor = self.get_user(exp_obj.payor)
-        payee = self.get_user(exp_obj.user_id)
-        self.update_user(payor, "expense_ids", payor.expense_ids.remove(id))
-        if payor.id != payee.id:
-            self.update_user(payor, "expense_ids", payor.expense_ids.remove(id))
+        with self.__expense_locked__(id) as exp_obj:
+            self.__unindex_expense__(exp_obj)
+            del self.expense_index[id]
+            self.__rollup_helper__(rollup_deltas(exp_obj, None))
 
     def add_expense(self, exp: Expense):
-        """Adds an expense object to the repository."""
-        self.expense_index[exp.id] = exp
-        payee: User = self.get_user(exp.user_id)
-        payor: User = self.get_user(exp.payor)
+        """Adds an expense object to the repository, raising RepositoryException if its id is already taken."""
+        with self.__locked__(exp.user_id, exp.payor):
+            self.get_user(exp.user_id)
+            self.get_user(exp.payor)
+            deltas = rollup_deltas(None, exp)
+
+            with self.expense_id_lock:
+                if exp.id in self.expense_index:
+                    # Expense id already taken
+                    raise RepositoryException
+                self.expense_index[exp.id] = exp
+            self.__index_expense__(exp)
+            self.__rollup_helper__(deltas)
+
+    def add_expenses(self, expenses):
+        """
+        Adds many expense objects to the repository
+        :param expenses: list of Expense
+        :return: list of RepositoryException or None, one per expense
+        """
+        errors = []
+        for exp in expenses:
+            try:
+                self.add_expense(exp)
+                errors.append(None)
+            except RepositoryException as err:
+                errors.append(err)
+        return errors
 
-        payee.expense_ids.append(exp.id)
+    def __index_expense__(self, exp: Expense):
+        """
+        Adds the expense to the expense list, date index and counterparty index of its participants
+        :param exp: Expense
+        :return: None
+        """
+        for user_id in {exp.user_id, exp.payor}:
+            self.user_index[user_id].expense_ids.append(exp.id)
+            bisect.insort(self.date_index.setdefault(user_id, []), (exp.date, exp.id))
+            self.__bump_version__(user_id)
         if exp.user_id != exp.payor:
-            payor.expense_ids.append(exp.id)
+            pair = tuple(sorted((exp.user_id, exp.payor)))
+            bisect.insort(self.counterparty_index.setdefault(pair, []), (exp.date, exp.id))
+
+    def __unindex_expense__(self, exp: Expense):
+        """
+        Removes the expense from the expense list, date index and counterparty index of its participants
+        :param exp: Expense
+        :return: None
+        """
+        for user_id in {exp.user_id, exp.payor}:
+            self.user_index[user_id].expense_ids.remove(exp.id)
+            index = self.date_index[user_id]
+            del index[bisect.bisect_left(index, (exp.date, exp.id))]
+            self.__bump_version__(user_id)
+        if exp.user_id != exp.payor:
+            index = self.counterparty_index[tuple(sorted((exp.user_id, exp.payor)))]
+            del index[bisect.bisect_left(index, (exp.date, exp.id))]
+
+    def __rollup_helper__(self, deltas):
+        """
+        Applies changes to the rollups of the participants of an expense
+        :param deltas: dict of (user id, bucket) -> amount, see rollup_deltas
+        :return: None
+        """
+        for (user_id, bucket), amount in deltas.items():
+            buckets = self.rollup_index.setdefault(user_id, {})
+            buckets[bucket] = buckets.get(bucket, 0) + amount
+
+    def get_rollup(self, user_id):
+        """
+        Returns the rollup buckets of a user (see db/rollup.py)
+        :param user_id: str
+        :return: dict of bucket -> amount
+        """
+        self.get_user(user_id)
+        with self.__locked__(user_id):
+            return dict(self.rollup_index.get(user_id, {}))
+
+    def rebuild_rollups(self):
+        """
+        Recomputes every rollup from the stored expenses
+        :return: None
+        """
+        with self.__all_locked__():
+            self.rollup_index = {}
+            for exp in self.expense_index.values():
+                self.__rollup_helper__(rollup_deltas(None, exp))
+
+    ####################################################################################################################
+    def snapshot(self, path=None):
+        """
+        Writes the users and expenses to a JSON file, atomically
+        :param path: str, defaults to MEMORY_SNAPSHOT_FILE
+        :return: None
+        """
+        path = path or self.snapshot_file
+        with self.__all_locked__():
+            state = {
+                'users': [{
+                    'id': user.id,
+                    'name': user.name,
+                    'friend_ids': list(user.friend_ids),
+                } for user in self.user_index.values()],
+                'expenses': [{
+                    'id': exp.id,
+                    'user_id': exp.user_id,
+                    'amount': exp.amount,
+                    'description': exp.description,
+                    'comments': exp.comments,
+                    'payor': exp.payor,
+                    'date': exp.date,
+                } for exp in self.expense_index.values()],
+                'versions': dict(self.version_index),
+            }
+
+        # Write then rename, so that a crash never leaves a partial snapshot
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f, default=str)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError):
+            os.remove(temp_path)
+            raise
+
+    def load(self, path):
+        """
+        Replaces the content of the repository with a snapshot, rebuilding the indexes and rollups
+        :param path: str
+        :return: None
+        """
+        with open(path) as f:
+            state = json.load(f)
+
+        with self.__all_locked__():
+            self.user_index = {}
+            self.expense_index = {}
+            self.date_index = {}
+            self.counterparty_index = {}
+            self.rollup_index = {}
+            for user in state['users']:
+                self.user_index[user['id']] = User(id=user['id'], name=user['name'], friend_ids=user['friend_ids'])
+            for exp in state['expenses']:
+                exp = Expense(**exp)
+                self.expense_index[exp.id] = exp
+                self.__index_expense__(exp)
+                self.__rollup_helper__(rollup_deltas(None, exp))
+            self.version_index = dict(state.get('versions', {}))
+
+    def __schedule_snapshots__(self, interval):
+        """
+        Snapshots the repository at exit and, with an interval, periodically from a daemon thread
+        :param interval: float, seconds
+        :return: None
+        """
+        atexit.register(self.snapshot)
+
+        if interval > 0:
+            stopped = threading.Event()
+
+            def run():
+                while not stopped.wait(interval):
+                    self.snapshot()
+
+            threading.Thread(target=run, name='memory-snapshot', daemon=True).start()
+
+    ####################################################################################################################
+    @contextmanager
+    def __locked__(self, *user_ids):
+        """
+        Holds the locks of the users, always acquired in the same order so that writers cannot deadlock
+        :param user_ids: str
+        """
+        stripes = sorted({hash(user_id) % LOCK_STRIPES for user_id in user_ids})
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.locks[stripe].release()
+
+    @contextmanager
+    def __all_locked__(self):
+        """Holds every lock, for operations on the whole repository"""
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+    @contextmanager
+    def __expense_locked__(self, id, *user_ids):
+        """
+        Holds the locks of the participants of an expense (and of other users), making sure the participants
+        did not change before the locks were acquired
+        :param id:       str, expense id
+        :param user_ids: str
+        :return: Expense
+        """
+        while True:
+            exp_obj: Expense = self.get_expense(id)
+            participants = (exp_obj.user_id, exp_obj.payor)
+            with self.__locked__(*participants, *user_ids):
+                if self.expense_index.get(id) is exp_obj and (exp_obj.user_id, exp_obj.payor) == participants:
+                    yield exp_obj
+                    return
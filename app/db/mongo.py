@@ -1,2 +1,486 @@
+"""
+Repository of users and expenses - mongodb
+
+One MongoClient (a thread-safe connection pool) is shared by the threads of a worker process.
+Stats rollups are not stored: get_rollup aggregates them server-side with an aggregation
+pipeline, so only the buckets are sent back.
+
+A MONGODB_URI starting with mongomock:// runs on an in-process mongomock client (tests).
+"""
+
+import os
+import threading
+import time
+from decimal import Decimal
+
+import pymongo
+from bson.decimal128 import Decimal128
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from . import User, Expense, RepositoryException, ExpenseNotFound, UserNotFound, UserExists, InvalidCursor
+from . import date_bounds, encode_cursor, decode_cursor
+from .rollup import DAY, MONTH, OWES, TOTAL_OWES, TOTAL_OWED, TOTAL_COUNT
+
+# Values per "$in" lookup
+IN_SIZE = 1000
+# Expense updates racing with a change of participants are re-read and retried
+UPDATE_RETRIES = 5
+
+# Expense fields and their keys in the expense documents
+EXPENSE_FIELDS = {
+    'user_id': 'user_id',
+    'payor': 'payor',
+    'amount': 'amount',
+    'date': 'date',
+    'description': 'description',
+    'comments': 'comments',
+}
+
+# Pages of a user's expenses (the participants array is a multikey index), and what users owe each other
+EXPENSE_INDEXES = [
+    pymongo.IndexModel([('participants', pymongo.ASCENDING), ('date', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+                       name='participants_date'),
+    pymongo.IndexModel([('user_id', pymongo.ASCENDING), ('payor', pymongo.ASCENDING)], name='user_payor'),
+]
+
+
+def to_decimal(value):
+    """
+    Converts an amount read from the database
+    :param value: Decimal128, or a number ($sum of no documents is 0)
+    :return: Decimal
+    """
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return Decimal(value)
+
+
 class Repository(object):
-    pass
+    """
+    Mongodb repository
+    users collection = greevil-users
+        schema - _id (email), name, friends, version
+    expenses collection = greevil-expenses
+        schema - _id, user_id, payor, participants, amount (Decimal128), date, day, description, comments
+        indexes - (participants, date, _id), (user_id, payor)
+    """
+
+    def __init__(self, settings):
+        """
+        Initializes the repository, creating the indexes if needed
+        :param settings: dict - MONGODB_URI, MONGODB_DATABASE, MONGODB_USER_COLLECTION, MONGODB_EXPENSE_COLLECTION,
+                         MONGODB_MAX_POOL_SIZE, MONGODB_TIMEOUT (seconds)
+        """
+        self.name = 'MongoDB'
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.pid = None
+        self.client = None
+
+        self.expense_index.create_indexes(EXPENSE_INDEXES)
+
+    def __connect__(self):
+        settings = self.settings
+        uri = settings['MONGODB_URI']
+        if uri.startswith('mongomock://'):
+            import mongomock
+            return mongomock.MongoClient()
+
+        timeout = int(float(settings.get('MONGODB_TIMEOUT', 5)) * 1000)
+        return pymongo.MongoClient(
+            uri,
+            maxPoolSize=int(settings.get('MONGODB_MAX_POOL_SIZE', 50)),
+            serverSelectionTimeoutMS=timeout,
+            connectTimeoutMS=timeout,
+            socketTimeoutMS=timeout,
+            retryWrites=True,
+        )
+
+    def __connection__(self):
+        """
+        Client of the current process, MongoClient is not fork-safe (e.g. gunicorn --preload)
+        :return: MongoClient
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.client = self.__connect__()
+                    self.pid = os.getpid()
+        return self.client
+
+    @property
+    def database(self):
+        return self.__connection__()[self.settings.get('MONGODB_DATABASE', 'greevil')]
+
+    @property
+    def user_index(self):
+        return self.database[self.settings.get('MONGODB_USER_COLLECTION', 'greevil-users')]
+
+    @property
+    def expense_index(self):
+        return self.database[self.settings.get('MONGODB_EXPENSE_COLLECTION', 'greevil-expenses')]
+
+    def get_user(self, id):
+        """
+        Returns user connected with the id(if exists)
+        :param id: str (as email)
+        :return: User
+        """
+        document = self.user_index.find_one({'_id': id}, {'name': 1, 'friends': 1})
+        if document is None:
+            raise UserNotFound
+        return self.__document_to_user__(document)
+
+    def get_all_users(self):
+        """
+        Get all users from the repository
+        :return: list of User
+        """
+        return [self.__document_to_user__(document) for document in self.user_index.find({}, {'name': 1, 'friends': 1})]
+
+    def __document_to_user__(self, document):
+        """
+        Builds a User from a document of the user collection, expense ids are loaded when needed
+        :param document: dict
+        :return: User
+        """
+        return User(
+            id=document['_id'],
+            name=document['name'],
+            expense_ids=lambda: [exp.id for exp in self.list_expenses(document['_id'])],
+            friend_ids=document.get('friends', [])
+        )
+
+    def add_user(self, user: User):
+        """
+        Add user to the repository if user does not exist
+        :param user:
+        :return:
+        """
+        try:
+            self.user_index.insert_one({
+                '_id': user.id,
+                'name': user.name,
+                'friends': list(user.friend_ids),
+                'version': 0,
+            })
+        except DuplicateKeyError:
+            raise UserExists
+        return user.id
+
+    def add_friend(self, user_id: str, friend_id: str):
+        """
+        Add friend (both directions)
+        :param user_id: str
+        :param friend_id:  str
+        :return:
+        """
+        self.__users_helper__(user_id, friend_id)
+        self.user_index.bulk_write([
+            pymongo.UpdateOne({'_id': user_id}, {'$addToSet': {'friends': friend_id}, '$inc': {'version': 1}}),
+            pymongo.UpdateOne({'_id': friend_id}, {'$addToSet': {'friends': user_id}, '$inc': {'version': 1}}),
+        ])
+
+    def update_user(self, id, field, data=None):
+        """Update data for the specified user."""
+        if field == 'name':
+            update = {'name': data}
+        elif field == 'friend_ids':
+            update = {'friends': list(data or [])}
+        else:
+            raise ValueError('Unknown user field.')
+
+        result = self.user_index.update_one({'_id': id}, {'$set': update, '$inc': {'version': 1}})
+        if result.matched_count == 0:
+            raise UserNotFound
+
+    def get_version(self, user_id):
+        """
+        Returns the version of a user, which changes whenever the user or one of their expenses changes
+        :param user_id: str
+        :return: int
+        """
+        document = self.user_index.find_one({'_id': user_id}, {'version': 1})
+        if document is None:
+            raise UserNotFound
+        return document.get('version', 0)
+
+    def __users_helper__(self, *user_ids):
+        """
+        Makes sure that users exist
+        :param user_ids: str
+        :return: None
+        """
+        user_ids = list(set(user_ids))
+        if self.user_index.count_documents({'_id': {'$in': user_ids}}) != len(user_ids):
+            raise UserNotFound
+
+    def __versions_helper__(self, counts):
+        """
+        Bumps the versions of users
+        :param counts: dict of user id -> number of changes
+        :return: None
+        """
+        if counts:
+            self.user_index.bulk_write([
+                pymongo.UpdateOne({'_id': user_id}, {'$inc': {'version': count}}) for user_id, count in counts.items()
+            ], ordered=False)
+
+    ####################################################################################################################
+    def get_expense(self, id):
+        """
+        Returns the expense connected with the id(if exists)
+        :param id: int
+        :return: Expense
+        """
+        document = self.expense_index.find_one({'_id': id})
+        if document is None:
+            raise ExpenseNotFound
+        return self.__document_to_expense__(document)
+
+    def get_expenses(self, ids):
+        """
+        Returns the expenses connected with the ids, skipping the ones that do not exist
+        :param ids: list of str
+        :return: list of Expense (in the order of ids)
+        """
+        ids = list(ids)
+        found = {}
+        for start in range(0, len(ids), IN_SIZE):
+            for document in self.expense_index.find({'_id': {'$in': ids[start:start + IN_SIZE]}}):
+                found[document['_id']] = self.__document_to_expense__(document)
+        return [found[id] for id in ids if id in found]
+
+    def list_expenses(self, user_id, from_date=None, to_date=None):
+        """
+        Returns the expenses of a user (as payee or payor) within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        expenses, _ = self.page_expenses(user_id, from_date, to_date)
+        return expenses
+
+    def page_expenses(self, user_id, from_date=None, to_date=None, limit=None, cursor=None):
+        """
+        Returns one page of the expenses of a user within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :param limit:     int, page size (None for everything)
+        :param cursor:    str, next_cursor of the previous page
+        :return: (list of Expense, next cursor or None)
+        """
+        self.__users_helper__(user_id)
+        low, high = date_bounds(from_date, to_date)
+        query = {'participants': user_id, 'date': {'$gte': low, '$lt': high}}
+        if cursor is not None:
+            # Cursor is the (date, id) key of the last returned expense
+            position = decode_cursor(cursor)
+            if not (isinstance(position, list) and len(position) == 2 and all(isinstance(key, str) for key in position)):
+                raise InvalidCursor
+            date, id = position
+            query['$or'] = [{'date': {'$gt': date}}, {'date': date, '_id': {'$gt': id}}]
+
+        documents = self.expense_index.find(query).sort([('date', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        if limit is not None:
+            # One more document tells whether there is a next page
+            documents = documents.limit(limit + 1)
+        expenses = [self.__document_to_expense__(document) for document in documents]
+
+        if limit is None or len(expenses) <= limit:
+            return expenses, None
+        expenses = expenses[:limit]
+        return expenses, encode_cursor([expenses[-1].date, expenses[-1].id])
+
+    def list_shared_expenses(self, user_id, counterparty_id, from_date=None, to_date=None):
+        """
+        Returns the expenses between two users (one paying for the other) within a date range, ordered by date
+        :param user_id:         str
+        :param counterparty_id: str
+        :param from_date:       str (yyyy-mm-dd), inclusive
+        :param to_date:         str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        self.__users_helper__(user_id, counterparty_id)
+        if user_id == counterparty_id:
+            return []
+        low, high = date_bounds(from_date, to_date)
+        documents = self.expense_index.find({
+            '$or': [
+                {'user_id': user_id, 'payor': counterparty_id},
+                {'user_id': counterparty_id, 'payor': user_id},
+            ],
+            'date': {'$gte': low, '$lt': high},
+        }).sort([('date', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        return [self.__document_to_expense__(document) for document in documents]
+
+    def update_expense(self, id, field, data=None):
+        """
+        Update data for the specified expense.
+        The update only applies if the participants did not change since the expense was read.
+        """
+        if field not in EXPENSE_FIELDS:
+            raise ValueError('Unknown expense field.')
+
+        for attempt in range(UPDATE_RETRIES):
+            document = self.expense_index.find_one({'_id': id})
+            if document is None:
+                raise ExpenseNotFound
+            old = self.__document_to_expense__(document)
+            exp_obj = self.__document_to_expense__(document)
+            # Set field attribute to data arg
+            setattr(exp_obj, field, data)
+            if field in ('user_id', 'payor'):
+                self.__users_helper__(data)
+
+            update = self.__expense_document__(exp_obj)
+            del update['_id']
+            result = self.expense_index.update_one(
+                {'_id': id, 'user_id': old.user_id, 'payor': old.payor},
+                {'$set': update}
+            )
+            if result.matched_count:
+                self.__versions_helper__({user_id: 1 for user_id in {old.user_id, old.payor, exp_obj.user_id, exp_obj.payor}})
+                return exp_obj
+            time.sleep(min(0.05 * 2 ** attempt, 1))
+
+        raise RepositoryException
+
+    def delete_expense(self, id):
+        """Delete the specified expense."""
+        document = self.expense_index.find_one_and_delete({'_id': id}, projection={'participants': 1})
+        if document is None:
+            raise ExpenseNotFound
+        self.__versions_helper__({user_id: 1 for user_id in document['participants']})
+
+    def add_expense(self, exp: Expense):
+        """Adds an expense object to the repository."""
+        document = self.__expense_document__(exp)
+        self.__users_helper__(exp.user_id, exp.payor)
+        try:
+            self.expense_index.insert_one(document)
+        except DuplicateKeyError:
+            # Expense id already taken
+            raise RepositoryException
+        self.__versions_helper__({user_id: 1 for user_id in document['participants']})
+
+    def add_expenses(self, expenses):
+        """
+        Adds many expense objects to the repository, with one unordered insert_many
+        :param expenses: list of Expense
+        :return: list of RepositoryException or None, one per expense
+        """
+        documents = [self.__expense_document__(exp) for exp in expenses]
+        user_ids = list({user_id for exp in expenses for user_id in (exp.user_id, exp.payor)})
+        existing = set()
+        for start in range(0, len(user_ids), IN_SIZE):
+            existing.update(document['_id'] for document in self.user_index.find(
+                {'_id': {'$in': user_ids[start:start + IN_SIZE]}}, {'_id': 1}
+            ))
+
+        errors = [None if exp.user_id in existing and exp.payor in existing else UserNotFound() for exp in expenses]
+        positions = [position for position, err in enumerate(errors) if err is None]
+        if positions:
+            try:
+                self.expense_index.insert_many([documents[position] for position in positions], ordered=False)
+            except BulkWriteError as err:
+                for write_error in err.details['writeErrors']:
+                    errors[positions[write_error['index']]] = RepositoryException()
+
+        counts = {}
+        for document, err in zip(documents, errors):
+            if err is None:
+                for user_id in document['participants']:
+                    counts[user_id] = counts.get(user_id, 0) + 1
+        self.__versions_helper__(counts)
+        return errors
+
+    @staticmethod
+    def __expense_document__(exp: Expense):
+        """
+        Builds the document of an expense
+        :param exp: Expense
+        :return: dict
+        """
+        return {
+            '_id': exp.id,
+            'user_id': exp.user_id,
+            'payor': exp.payor,
+            'participants': sorted({exp.user_id, exp.payor}),
+            'amount': Decimal128(Decimal(str(exp.amount))),
+            'date': exp.date,
+            # Grouping key of the rollups
+            'day': exp.date[:10],
+            'description': exp.description,
+            'comments': exp.comments,
+        }
+
+    @staticmethod
+    def __document_to_expense__(document):
+        """
+        Builds an Expense from a document of the expense collection
+        :param document: dict
+        :return: Expense
+        """
+        return Expense(
+            id=document['_id'],
+            user_id=document['user_id'],
+            payor=document['payor'],
+            amount=to_decimal(document['amount']),
+            description=document['description'],
+            comments=document['comments'],
+            date=document['date']
+        )
+
+    ####################################################################################################################
+    def get_rollup(self, user_id):
+        """
+        Returns the rollup buckets of a user (see db/rollup.py), aggregated by the server
+        :param user_id: str
+        :return: dict of bucket -> amount
+        """
+        self.__users_helper__(user_id)
+        result, = self.expense_index.aggregate([
+            {'$match': {'participants': user_id}},
+            {'$facet': {
+                'days': [
+                    {'$group': {'_id': '$day', 'amount': {'$sum': '$amount'}, 'count': {'$sum': 1}}},
+                ],
+                'owes': [
+                    {'$match': {'user_id': user_id, 'payor': {'$ne': user_id}}},
+                    {'$group': {'_id': '$payor', 'amount': {'$sum': '$amount'}}},
+                ],
+                'owed': [
+                    {'$match': {'payor': user_id, 'user_id': {'$ne': user_id}}},
+                    {'$group': {'_id': None, 'amount': {'$sum': '$amount'}}},
+                ],
+            }},
+        ])
+
+        buckets = {}
+        count = 0
+        for day in result['days']:
+            amount = to_decimal(day['amount'])
+            buckets[DAY + day['_id']] = amount
+            buckets[MONTH + day['_id'][:7]] = buckets.get(MONTH + day['_id'][:7], 0) + amount
+            count += day['count']
+        if count:
+            buckets[TOTAL_COUNT] = Decimal(count)
+
+        for owes in result['owes']:
+            buckets[OWES + owes['_id']] = to_decimal(owes['amount'])
+        if result['owes']:
+            buckets[TOTAL_OWES] = sum(to_decimal(owes['amount']) for owes in result['owes'])
+
+        for owed in result['owed']:
+            buckets[TOTAL_OWED] = to_decimal(owed['amount'])
+        return buckets
+
+    def rebuild_rollups(self):
+        """
+        Rollups are aggregated on every read, only the indexes they use are (re)created
+        :return: None
+        """
+        self.expense_index.create_indexes(EXPENSE_INDEXES)
@@ -0,0 +1,128 @@
+"""
+Per-user expense rollups.
+
+Repositories keep a few running sums per user, updated on every expense write, so that
+the stats endpoint can be answered from the buckets instead of the whole expense history.
+
+Buckets (all of them are sums):
+    day#<yyyy-mm-dd>   amount of the expenses the user takes part in, per day
+    month#<yyyy-mm>    same, per month
+    owes#<payor>       amount paid by a friend for the user
+    total#owes         amount the user owes to friends
+    total#owed         amount friends owe the user
+    total#count        number of expenses the user takes part in
+"""
+import hashlib
+from datetime import datetime
+from decimal import Decimal
+
+DAY = "day#"
+MONTH = "month#"
+OWES = "owes#"
+TOTAL_OWES = "total#owes"
+TOTAL_OWED = "total#owed"
+TOTAL_COUNT = "total#count"
+
+
+def expense_buckets(exp):
+    """
+    Contributions of an expense to the rollups of its participants
+    :param exp: Expense
+    :return: list of (user id, bucket, amount)
+    """
+    amount = Decimal(str(exp.amount))
+    day = exp.date[:10]
+
+    buckets = []
+    for user_id in {exp.user_id, exp.payor}:
+        buckets.append((user_id, DAY + day, amount))
+        buckets.append((user_id, MONTH + day[:7], amount))
+        buckets.append((user_id, TOTAL_COUNT, Decimal(1)))
+
+    if exp.payor != exp.user_id:
+        buckets.append((exp.user_id, OWES + exp.payor, amount))
+        buckets.append((exp.user_id, TOTAL_OWES, amount))
+        buckets.append((exp.payor, TOTAL_OWED, amount))
+
+    return buckets
+
+
+def rollup_deltas(old=None, new=None):
+    """
+    Changes to apply to the rollups when an expense goes from old to new
+    :param old: Expense or None (added)
+    :param new: Expense or None (deleted)
+    :return: dict of (user id, bucket) -> amount, without zero changes
+    """
+    deltas = {}
+    if old is not None:
+        for user_id, bucket, amount in expense_buckets(old):
+            deltas[(user_id, bucket)] = deltas.get((user_id, bucket), 0) - amount
+    if new is not None:
+        for user_id, bucket, amount in expense_buckets(new):
+            deltas[(user_id, bucket)] = deltas.get((user_id, bucket), 0) + amount
+
+    return {key: amount for key, amount in deltas.items() if amount != 0}
+
+
+def rollup_stats(buckets, now=None):
+    """
+    Builds the stats of a user (see /expenses/stats/) from their rollup
+    :param buckets: dict of bucket -> amount
+    :param now:     datetime, defaults to now
+    :return: dict
+    """
+    if not buckets.get(TOTAL_COUNT):
+        return {
+            "area_chart": {},
+            "bar_chart": {},
+            "pie_chart": {},
+            "new_expenses": 0,
+            "monthly_expenses": 0,
+            "friends_amount": 0,
+            "owed_amount": 0
+        }
+
+    if now is None:
+        now = datetime.now()
+    year = f"{now.year:04d}-"
+    month = now.strftime("%Y-%m")
+    today = now.strftime("%Y-%m-%d")
+
+    area_chart = {}
+    bar_chart = {}
+    pie_chart = {}
+    for bucket, amount in sorted(buckets.items()):
+        # Buckets emptied by deletes are left behind
+        if amount == 0:
+            continue
+        if bucket.startswith(DAY) and bucket[len(DAY):].startswith(year):
+            area_chart[bucket[len(DAY):]] = float(amount)
+        elif bucket.startswith(MONTH):
+            month_number = int(bucket[len(MONTH) + 5:])
+            bar_chart[month_number] = bar_chart.get(month_number, 0) + float(amount)
+        elif bucket.startswith(OWES):
+            pie_chart[bucket[len(OWES):]] = float(amount)
+
+    return {
+        "area_chart": area_chart,
+        "bar_chart": dict(sorted(bar_chart.items())),
+        "pie_chart": pie_chart,
+        "new_expenses": float(buckets.get(DAY + today, 0)),
+        "monthly_expenses": float(buckets.get(MONTH + month, 0)),
+        "friends_amount": float(buckets.get(TOTAL_OWES, 0)),
+        "owed_amount": float(buckets.get(TOTAL_OWED, 0))
+    }
+
+
+def rollup_fingerprint(buckets):
+    """
+    Fingerprint of the expense history of a user (number of expenses, last date and total amount),
+    which changes whenever expenses are added or deleted
+    :param buckets: dict of bucket -> amount
+    :return: str
+    """
+    count = Decimal(buckets.get(TOTAL_COUNT, 0)).normalize()
+    days = [bucket[len(DAY):] for bucket, amount in buckets.items() if bucket.startswith(DAY) and amount != 0]
+    total = Decimal(sum(amount for bucket, amount in buckets.items() if bucket.startswith(DAY))).normalize()
+    return hashlib.sha1(f"{count}|{max(days, default='')}|{total}".encode('utf-8')).hexdigest()
@@ -0,0 +1,563 @@
+"""
+Repository of users and expenses - sqlite
+
+Single node backend that needs no service, e.g. for tests and small deployments. Every thread
+(of every worker process) has its own connection to the database file, which is in WAL mode so
+that readers are never blocked by the writer. Stats rollups are not stored: get_rollup
+aggregates them from the expense indexes with GROUP BY queries.
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+from . import User, Expense, RepositoryException, ExpenseNotFound, UserNotFound, UserExists, InvalidCursor
+from . import date_bounds, encode_cursor, decode_cursor
+from .rollup import DAY, MONTH, OWES, TOTAL_OWES, TOTAL_OWED, TOTAL_COUNT
+
+# Statements compiled and kept per connection (sqlite3 reuses them for the same SQL text)
+CACHED_STATEMENTS = 256
+# Host parameters per statement for "IN (...)" lookups, below SQLITE_MAX_VARIABLE_NUMBER of old builds
+MAX_VARIABLES = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id      TEXT PRIMARY KEY,
+    name    TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS friends (
+    user_id   TEXT NOT NULL REFERENCES users (id),
+    friend_id TEXT NOT NULL REFERENCES users (id),
+    PRIMARY KEY (user_id, friend_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS expenses (
+    id          TEXT PRIMARY KEY,
+    user_id     TEXT NOT NULL REFERENCES users (id),
+    payor       TEXT NOT NULL REFERENCES users (id),
+    amount      TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    comments    TEXT NOT NULL DEFAULT '',
+    date        TEXT NOT NULL
+);
+
+-- Pages of a user's expenses, as payee and as payor, in (date, id) order
+CREATE INDEX IF NOT EXISTS expenses_user_date ON expenses (user_id, date, id);
+CREATE INDEX IF NOT EXISTS expenses_payor_date ON expenses (payor, date, id);
+-- What a user is owed, and the expenses between two users
+CREATE INDEX IF NOT EXISTS expenses_payor_user ON expenses (payor, user_id, amount);
+"""
+
+# Expense fields, they are also the column names
+EXPENSE_FIELDS = ('id', 'user_id', 'payor', 'amount', 'description', 'comments', 'date')
+EXPENSE_COLUMNS = ", ".join(EXPENSE_FIELDS)
+
+SELECT_USER = "SELECT id, name FROM users WHERE id = ?"
+SELECT_FRIENDS = "SELECT friend_id FROM friends WHERE user_id = ? ORDER BY friend_id"
+SELECT_VERSION = "SELECT version FROM users WHERE id = ?"
+BUMP_VERSION = "UPDATE users SET version = version + ? WHERE id = ?"
+SELECT_EXPENSE = f"SELECT {EXPENSE_COLUMNS} FROM expenses WHERE id = ?"
+INSERT_EXPENSE = f"INSERT INTO expenses ({EXPENSE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+# Both halves seek their index to the (date, id) position and stop at the page size,
+# expenses paid for oneself are in the first one
+PAGE_EXPENSES = f"""
+SELECT * FROM (
+    SELECT {EXPENSE_COLUMNS} FROM expenses
+    WHERE user_id = :user AND (date, id) > (:date, :id) AND date < :high
+    ORDER BY date, id LIMIT :limit
+)
+UNION ALL
+SELECT * FROM (
+    SELECT {EXPENSE_COLUMNS} FROM expenses
+    WHERE payor = :user AND (date, id) > (:date, :id) AND date < :high AND user_id <> :user
+    ORDER BY date, id LIMIT :limit
+)
+ORDER BY date, id LIMIT :limit
+"""
+
+SHARED_EXPENSES = f"""
+SELECT {EXPENSE_COLUMNS} FROM expenses
+WHERE ((payor = :user AND user_id = :other) OR (payor = :other AND user_id = :user))
+    AND date >= :low AND date < :high
+ORDER BY date, id
+"""
+
+# Amounts are summed as doubles, rounding drops the representation error
+ROLLUP_DAYS = """
+SELECT substr(date, 1, 10) AS day, round(total(amount), 9), count(*) FROM (
+    SELECT date, amount FROM expenses WHERE user_id = :user
+    UNION ALL
+    SELECT date, amount FROM expenses WHERE payor = :user AND user_id <> :user
+)
+GROUP BY day
+"""
+ROLLUP_OWES = """
+SELECT payor, round(total(amount), 9) FROM expenses
+WHERE user_id = :user AND payor <> :user
+GROUP BY payor
+"""
+ROLLUP_OWED = """
+SELECT round(total(amount), 9) FROM expenses
+WHERE payor = :user AND user_id <> :user
+"""
+
+
+class Repository(object):
+    """
+    SQLite repository
+    users table    - id, name, version
+    friends table  - user_id, friend_id (both directions)
+    expenses table - id, user_id, payor, amount, description, comments, date
+        indexes - (user_id, date), (payor, date), (payor, user_id)
+    """
+
+    def __init__(self, settings):
+        """
+        Initializes the repository, creating the schema if needed
+        :param settings: dict - SQLITE_FILE (str), SQLITE_BUSY_TIMEOUT (seconds a writer waits for the lock)
+        """
+        self.name = 'SQLite'
+        self.path = settings['SQLITE_FILE']
+        if self.path == ':memory:':
+            # Every thread would get a database of its own
+            raise ValueError('SQLite repository needs a database file.')
+        self.timeout = float(settings.get('SQLITE_BUSY_TIMEOUT', 5))
+        self.local = threading.local()
+
+        connection = self.__connection__()
+        # WAL is persistent, it only has to be enabled once per database file
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript(SCHEMA)
+
+    def __connect__(self):
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            # Transactions are started explicitly, see __transaction__
+            isolation_level=None,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        # WAL makes NORMAL durable up to the last checkpoint, without an fsync per commit
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+
+    def __connection__(self):
+        """
+        Connection of the current thread, connections are not shared with forked processes
+        :return: sqlite3.Connection
+        """
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self.__connect__()
+            local.pid = os.getpid()
+        return local.connection
+
+    @contextmanager
+    def __transaction__(self, write=True):
+        """
+        Runs statements in one transaction. Writers take the write lock up front (BEGIN IMMEDIATE),
+        so that they wait for each other instead of failing when upgrading a read lock.
+        :param write: bool
+        :return: sqlite3.Connection
+        """
+        connection = self.__connection__()
+        connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get_user(self, id):
+        """
+        Returns user connected with the id(if exists)
+        :param id: str (as email)
+        :return: User
+        """
+        with self.__transaction__(write=False) as connection:
+            row = connection.execute(SELECT_USER, (id,)).fetchone()
+            if row is None:
+                raise UserNotFound
+            friend_ids = [friend_id for friend_id, in connection.execute(SELECT_FRIENDS, (id,))]
+
+        return User(
+            id=row[0],
+            name=row[1],
+            expense_ids=lambda: [exp.id for exp in self.list_expenses(id)],
+            friend_ids=friend_ids
+        )
+
+    def get_all_users(self):
+        """
+        Get all users from the repository
+        :return: list of User
+        """
+        with self.__transaction__(write=False) as connection:
+            users = connection.execute("SELECT id, name FROM users ORDER BY id").fetchall()
+            friend_ids = {}
+            for user_id, friend_id in connection.execute("SELECT user_id, friend_id FROM friends ORDER BY user_id, friend_id"):
+                friend_ids.setdefault(user_id, []).append(friend_id)
+
+        return [User(
+            id=user_id,
+            name=name,
+            expense_ids=lambda user_id=user_id: [exp.id for exp in self.list_expenses(user_id)],
+            friend_ids=friend_ids.get(user_id, [])
+        ) for user_id, name in users]
+
+    def add_user(self, user: User):
+        """
+        Add user to the repository if user does not exist
+        :param user:
+        :return:
+        """
+        try:
+            with self.__transaction__() as connection:
+                connection.execute("INSERT INTO users (id, name) VALUES (?, ?)", (user.id, user.name))
+                connection.executemany(
+                    "INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)",
+                    [(user.id, friend_id) for friend_id in user.friend_ids]
+                )
+        except sqlite3.IntegrityError:
+            raise UserExists
+        return user.id
+
+    def add_friend(self, user_id: str, friend_id: str):
+        """
+        Add friend (both directions)
+        :param user_id: str
+        :param friend_id:  str
+        :return:
+        """
+        with self.__transaction__() as connection:
+            self.__users_helper__(connection, user_id, friend_id)
+            connection.executemany(
+                "INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)",
+                [(user_id, friend_id), (friend_id, user_id)]
+            )
+            connection.executemany(BUMP_VERSION, [(1, user_id), (1, friend_id)])
+
+    def update_user(self, id, field, data=None):
+        """Update data for the specified user."""
+        with self.__transaction__() as connection:
+            self.__users_helper__(connection, id)
+            if field == 'name':
+                connection.execute("UPDATE users SET name = ? WHERE id = ?", (data, id))
+            elif field == 'friend_ids':
+                connection.execute("DELETE FROM friends WHERE user_id = ?", (id,))
+                connection.executemany(
+                    "INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)",
+                    [(id, friend_id) for friend_id in data or []]
+                )
+            else:
+                raise ValueError('Unknown user field.')
+            connection.execute(BUMP_VERSION, (1, id))
+
+    def get_version(self, user_id):
+        """
+        Returns the version of a user, which changes whenever the user or one of their expenses changes
+        :param user_id: str
+        :return: int
+        """
+        row = self.__connection__().execute(SELECT_VERSION, (user_id,)).fetchone()
+        if row is None:
+            raise UserNotFound
+        return row[0]
+
+    @staticmethod
+    def __users_helper__(connection, *user_ids):
+        """
+        Makes sure that users exist, within the transaction of connection
+        :param user_ids: str
+        :return: None
+        """
+        for user_id in set(user_ids):
+            if connection.execute(SELECT_VERSION, (user_id,)).fetchone() is None:
+                raise UserNotFound
+
+    ####################################################################################################################
+    def get_expense(self, id):
+        """
+        Returns the expense connected with the id(if exists)
+        :param id: int
+        :return: Expense
+        """
+        row = self.__connection__().execute(SELECT_EXPENSE, (id,)).fetchone()
+        if row is None:
+            raise ExpenseNotFound
+        return self.__row_to_expense__(row)
+
+    def get_expenses(self, ids):
+        """
+        Returns the expenses connected with the ids, skipping the ones that do not exist
+        :param ids: list of str
+        :return: list of Expense (in the order of ids)
+        """
+        ids = list(ids)
+        found = {}
+        connection = self.__connection__()
+        for start in range(0, len(ids), MAX_VARIABLES):
+            chunk = ids[start:start + MAX_VARIABLES]
+            rows = connection.execute(
+                f"SELECT {EXPENSE_COLUMNS} FROM expenses WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            for row in rows:
+                found[row[0]] = self.__row_to_expense__(row)
+        return [found[id] for id in ids if id in found]
+
+    def list_expenses(self, user_id, from_date=None, to_date=None):
+        """
+        Returns the expenses of a user (as payee or payor) within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        expenses, _ = self.page_expenses(user_id, from_date, to_date)
+        return expenses
+
+    def page_expenses(self, user_id, from_date=None, to_date=None, limit=None, cursor=None):
+        """
+        Returns one page of the expenses of a user within a date range, ordered by date
+        :param user_id:   str
+        :param from_date: str (yyyy-mm-dd), inclusive
+        :param to_date:   str (yyyy-mm-dd), inclusive
+        :param limit:     int, page size (None for everything)
+        :param cursor:    str, next_cursor of the previous page
+        :return: (list of Expense, next cursor or None)
+        """
+        low, high = date_bounds(from_date, to_date)
+        # Expenses after this (date, id) key, ids are never empty
+        position = (low, "")
+        if cursor is not None:
+            # Cursor is the (date, id) key of the last returned expense
+            last = decode_cursor(cursor)
+            if not (isinstance(last, list) and len(last) == 2 and all(isinstance(key, str) for key in last)):
+                raise InvalidCursor
+            position = max(position, tuple(last))
+
+        with self.__transaction__(write=False) as connection:
+            self.__users_helper__(connection, user_id)
+            rows = connection.execute(PAGE_EXPENSES, {
+                'user': user_id,
+                'date': position[0],
+                'id': position[1],
+                'high': high,
+                # One more row tells whether there is a next page, -1 is no limit
+                'limit': -1 if limit is None else limit + 1,
+            }).fetchall()
+
+        expenses = [self.__row_to_expense__(row) for row in rows]
+        if limit is None or len(expenses) <= limit:
+            return expenses, None
+        expenses = expenses[:limit]
+        return expenses, encode_cursor([expenses[-1].date, expenses[-1].id])
+
+    def list_shared_expenses(self, user_id, counterparty_id, from_date=None, to_date=None):
+        """
+        Returns the expenses between two users (one paying for the other) within a date range, ordered by date
+        :param user_id:         str
+        :param counterparty_id: str
+        :param from_date:       str (yyyy-mm-dd), inclusive
+        :param to_date:         str (yyyy-mm-dd), inclusive
+        :return: list of Expense
+        """
+        low, high = date_bounds(from_date, to_date)
+        with self.__transaction__(write=False) as connection:
+            self.__users_helper__(connection, user_id, counterparty_id)
+            rows = connection.execute(SHARED_EXPENSES, {
+                'user': user_id,
+                'other': counterparty_id,
+                'low': low,
+                'high': high,
+            }).fetchall()
+        return [self.__row_to_expense__(row) for row in rows if row[1] != row[2]]
+
+    def update_expense(self, id, field, data=None):
+        """Update data for the specified expense."""
+        if field not in EXPENSE_FIELDS or field == 'id':
+            raise ValueError('Unknown expense field.')
+
+        with self.__transaction__() as connection:
+            row = connection.execute(SELECT_EXPENSE, (id,)).fetchone()
+            if row is None:
+                raise ExpenseNotFound
+            exp_obj = self.__row_to_expense__(row)
+            # Set field attribute to data arg
+            setattr(exp_obj, field, data)
+            if field in ('user_id', 'payor'):
+                self.__users_helper__(connection, data)
+
+            value = dict(zip(EXPENSE_FIELDS, self.__expense_row__(exp_obj)))[field]
+            connection.execute(f"UPDATE expenses SET {field} = ? WHERE id = ?", (value, id))
+            self.__versions_helper__(connection, {row[1], row[2], exp_obj.user_id, exp_obj.payor})
+        return exp_obj
+
+    def delete_expense(self, id):
+        """Delete the specified expense."""
+        with self.__transaction__() as connection:
+            row = connection.execute("SELECT user_id, payor FROM expenses WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                raise ExpenseNotFound
+            connection.execute("DELETE FROM expenses WHERE id = ?", (id,))
+            self.__versions_helper__(connection, set(row))
+
+    def add_expense(self, exp: Expense):
+        """Adds an expense object to the repository."""
+        values = self.__expense_row__(exp)
+        try:
+            with self.__transaction__() as connection:
+                self.__users_helper__(connection, exp.user_id, exp.payor)
+                connection.execute(INSERT_EXPENSE, values)
+                self.__versions_helper__(connection, {exp.user_id, exp.payor})
+        except sqlite3.IntegrityError:
+            # Expense id already taken
+            raise RepositoryException
+
+    def add_expenses(self, expenses):
+        """
+        Adds many expense objects to the repository, in one transaction
+        :param expenses: list of Expense
+        :return: list of RepositoryException or None, one per expense
+        """
+        values = [self.__expense_row__(exp) for exp in expenses]
+        with self.__transaction__() as connection:
+            user_ids = list({user_id for exp in expenses for user_id in (exp.user_id, exp.payor)})
+            existing = set()
+            for start in range(0, len(user_ids), MAX_VARIABLES):
+                chunk = user_ids[start:start + MAX_VARIABLES]
+                existing.update(user_id for user_id, in connection.execute(
+                    f"SELECT id FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                ))
+
+            errors = []
+            rows = []
+            versions = {}
+            for exp, row in zip(expenses, values):
+                if exp.user_id not in existing or exp.payor not in existing:
+                    errors.append(UserNotFound())
+                    continue
+                errors.append(None)
+                rows.append(row)
+                for user_id in {exp.user_id, exp.payor}:
+                    versions[user_id] = versions.get(user_id, 0) + 1
+
+            connection.execute("SAVEPOINT add_expenses")
+            try:
+                connection.executemany(INSERT_EXPENSE, rows)
+                connection.execute("RELEASE add_expenses")
+            except sqlite3.IntegrityError:
+                # Expense ids already taken: insert row by row to find them, the others are still added
+                connection.execute("ROLLBACK TO add_expenses")
+                connection.execute("RELEASE add_expenses")
+                self.__insert_each__(connection, expenses, values, errors, versions)
+            connection.executemany(BUMP_VERSION, [(count, user_id) for user_id, count in versions.items()])
+        return errors
+
+    @staticmethod
+    def __insert_each__(connection, expenses, values, errors, versions):
+        """
+        Inserts the expenses without an error one by one, within the transaction of connection.
+        Errors and version increments of the expenses that fail are updated in place.
+        :param expenses: list of Expense
+        :param values:   list of tuple, rows of the expenses
+        :param errors:   list of RepositoryException or None, one per expense
+        :param versions: dict of user id -> version increment
+        :return: None
+        """
+        for i, (exp, row) in enumerate(zip(expenses, values)):
+            if errors[i] is not None:
+                continue
+            try:
+                connection.execute(INSERT_EXPENSE, row)
+            except sqlite3.IntegrityError:
+                # Expense id already taken
+                errors[i] = RepositoryException()
+                for user_id in {exp.user_id, exp.payor}:
+                    versions[user_id] -= 1
+                    if not versions[user_id]:
+                        del versions[user_id]
+
+    @staticmethod
+    def __versions_helper__(connection, user_ids):
+        """
+        Bumps the versions of users, within the transaction of connection
+        :param user_ids: set of str
+        :return: None
+        """
+        connection.executemany(BUMP_VERSION, [(1, user_id) for user_id in user_ids])
+
+    @staticmethod
+    def __expense_row__(exp: Expense):
+        """
+        Values of an expense, in the order of EXPENSE_COLUMNS
+        :param exp: Expense
+        :return: tuple
+        """
+        # Same validation as the rollups of the other repositories
+        Decimal(str(exp.amount))
+        return (exp.id, exp.user_id, exp.payor, str(exp.amount), exp.description or '', exp.comments or '', exp.date)
+
+    @staticmethod
+    def __row_to_expense__(row):
+        """
+        Builds an Expense from a row of the expense table
+        :param row: tuple, in the order of EXPENSE_COLUMNS
+        :return: Expense
+        """
+        return Expense(
+            id=row[0],
+            user_id=row[1],
+            payor=row[2],
+            amount=row[3],
+            description=row[4],
+            comments=row[5],
+            date=row[6]
+        )
+
+    ####################################################################################################################
+    def get_rollup(self, user_id):
+        """
+        Returns the rollup buckets of a user (see db/rollup.py), aggregated from the expenses
+        :param user_id: str
+        :return: dict of bucket -> amount
+        """
+        buckets = {}
+        with self.__transaction__(write=False) as connection:
+            self.__users_helper__(connection, user_id)
+            parameters = {'user': user_id}
+
+            count = 0
+            for day, amount, day_count in connection.execute(ROLLUP_DAYS, parameters):
+                amount = Decimal(str(amount))
+                buckets[DAY + day] = amount
+                buckets[MONTH + day[:7]] = buckets.get(MONTH + day[:7], 0) + amount
+                count += day_count
+            if count:
+                buckets[TOTAL_COUNT] = Decimal(count)
+
+            owes = 0
+            for payor, amount in connection.execute(ROLLUP_OWES, parameters):
+                buckets[OWES + payor] = Decimal(str(amount))
+                owes += buckets[OWES + payor]
+            if owes:
+                buckets[TOTAL_OWES] = owes
+
+            owed, = connection.execute(ROLLUP_OWED, parameters).fetchone()
+            if owed:
+                buckets[TOTAL_OWED] = Decimal(str(owed))
+        return buckets
+
+    def rebuild_rollups(self):
+        """
+        Rollups are aggregated on every read, only the statistics of the query planner are refreshed
+        :return: None
+        """
+        self.__connection__().execute("ANALYZE")
@@ -0,0 +1,41 @@
+"""
+Repository decorator timing every call to the wrapped repository (see core/metrics.py).
+"""
+import functools
+import time
+
+
+class TimedRepository(object):
+    """
+    Observes the duration of each public method of the wrapped repository in a histogram
+    labelled with the backend name and the method name. Other attributes are delegated.
+    """
+
+    def __init__(self, repository, histogram):
+        """
+        :param repository: repository to wrap (see db/factory.py)
+        :param histogram:  core.metrics.Histogram labelled (backend, operation)
+        """
+        self.repository = repository
+        self.name = repository.name
+        self.histogram = histogram
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repository, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        labels = (self.name, name)
+        observe = self.histogram.observe
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                observe(labels, time.perf_counter() - start)
+
+        # Later calls find the wrapper without going through __getattr__
+        setattr(self, name, timed)
+        return timed
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Maintenance commands for the configured repository (see settings.py).
+
+    python manage.py create-tables
+    python manage.py migrate-participant-index [--drop-expense-lists]
+    python manage.py rebuild-rollups
+"""
+import argparse
+
+from core.logs import configure_logging
+from db.factory import create_repository
+from settings import REPOSITORY_NAME, REPOSITORY_SETTINGS
+
+
+def create_tables(repository, args):
+    """
+    Creates the DynamoDB tables that do not exist yet (e.g. on DynamoDB Local).
+    """
+    if REPOSITORY_NAME != 'dynamodb':
+        raise SystemExit("create-tables is only available for dynamodb")
+    repository.create_tables()
+
+
+def migrate_participant_index(repository, args):
+    """
+    Creates the per-user expense indexes on an existing DynamoDB expense table.
+    Run it before switching DYNAMODB_EXPENSE_MODE to 'index', and pass --drop-expense-lists
+    only once every worker runs in index mode.
+    """
+    if REPOSITORY_NAME != 'dynamodb':
+        raise SystemExit("migrate-participant-index is only available for dynamodb")
+    repository.migrate_participant_index(drop_expense_lists=args.drop_expense_lists)
+
+
+def rebuild_rollups(repository, args):
+    """
+    Recomputes the per-user stats rollups from the stored expenses, fixing any drift.
+    """
+    repository.rebuild_rollups()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Greevil maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create-tables", help=create_tables.__doc__)
+    create.set_defaults(func=create_tables)
+
+    migrate = commands.add_parser("migrate-participant-index", help=migrate_participant_index.__doc__)
+    migrate.add_argument("--drop-expense-lists", action="store_true",
+                         help="remove the Expenses attribute from every user item")
+    migrate.set_defaults(func=migrate_participant_index)
+
+    rebuild = commands.add_parser("rebuild-rollups", help=rebuild_rollups.__doc__)
+    rebuild.set_defaults(func=rebuild_rollups)
+
+    args = parser.parse_args()
+    # Progress of the commands is logged at INFO
+    configure_logging("INFO", format="%(message)s")
+    repository = create_repository(REPOSITORY_NAME, REPOSITORY_SETTINGS)
+    args.func(repository, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,11 @@ from flask import Flask
 from flask_cors import CORS
 
 from apis import api
+from core import metrics
+from core.logs import configure_logging
+from settings import LOG_LEVEL, LOG_SAMPLE_RATE, METRICS_ENABLED
+
+configure_logging(LOG_LEVEL, LOG_SAMPLE_RATE)
 
 app = Flask(__name__)
 
@@ -11,5 +16,8 @@ cors = CORS(app, resources={r"/*": {"origins": "*"}})
 
 api.init_app(app)
 
+if METRICS_ENABLED:
+    metrics.init_app(app)
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8000)
@@ -10,18 +10,107 @@ from os import environ
 cognitoUserPoolId = "us-east-1_N3LQnEiUA"
 cognitoUserPoolClientId = "2ar481vjkra0k54fu6c6vre6m0"
 awsRegion = 'us-east-1'
+# Local JWKS of the user pool (e.g. for tests), downloaded from Cognito when empty
+cognitoJwksFile = environ.get('COGNITO_JWKS_FILE', '')
 
 # default storage
 REPOSITORY_NAME = environ.get('REPOSITORY_NAME', 'dynamodb')
 
 if REPOSITORY_NAME == 'memory':
-    REPOSITORY_SETTINGS = {}
+    # State lives in the process, run a single worker (threads are fine)
+    REPOSITORY_SETTINGS = {
+        # JSON snapshot loaded at startup and written at exit, empty to keep everything in memory only
+        "MEMORY_SNAPSHOT_FILE": environ.get('MEMORY_SNAPSHOT_FILE', ''),
+        # seconds between snapshots, 0 to only write it at exit
+        "MEMORY_SNAPSHOT_INTERVAL": int(environ.get('MEMORY_SNAPSHOT_INTERVAL', 300)),
+    }
 
 elif REPOSITORY_NAME == 'dynamodb':
     REPOSITORY_SETTINGS = {
         "DYNAMODB_USER_TABLE": environ.get('DYNAMODB_USER_TABLE', 'greevil-users'),
-        "DYNAMODB_EXPENSE_TABLE": environ.get('DYNAMODB_EXPENSE_TABLE', 'greevil-expenses')
+        "DYNAMODB_EXPENSE_TABLE": environ.get('DYNAMODB_EXPENSE_TABLE', 'greevil-expenses'),
+        "DYNAMODB_ROLLUP_TABLE": environ.get('DYNAMODB_ROLLUP_TABLE', 'greevil-rollups'),
+        # 'list' keeps expense ids on the user item, 'index' queries the participant indexes
+        # (create them first with: python manage.py migrate-participant-index); in 'list' mode every
+        # page of expenses reads the whole history of the user
+        "DYNAMODB_EXPENSE_MODE": environ.get('DYNAMODB_EXPENSE_MODE', 'list'),
+        "DYNAMODB_PAYEE_INDEX": environ.get('DYNAMODB_PAYEE_INDEX', 'For-Date-index'),
+        "DYNAMODB_PAYOR_INDEX": environ.get('DYNAMODB_PAYOR_INDEX', 'By-Date-index'),
+        "DYNAMODB_REGION": environ.get('DYNAMODB_REGION', awsRegion),
+        # e.g. http://localhost:8000 for DynamoDB Local
+        "DYNAMODB_ENDPOINT_URL": environ.get('DYNAMODB_ENDPOINT_URL', ''),
+        # HTTP connections kept open per worker process, at least the number of threads of a worker
+        "DYNAMODB_MAX_POOL_CONNECTIONS": int(environ.get('DYNAMODB_MAX_POOL_CONNECTIONS', 25)),
+        # botocore retry mode ('legacy', 'standard' or 'adaptive') and attempts, first one included
+        "DYNAMODB_RETRY_MODE": environ.get('DYNAMODB_RETRY_MODE', 'standard'),
+        "DYNAMODB_MAX_ATTEMPTS": int(environ.get('DYNAMODB_MAX_ATTEMPTS', 3)),
+        # seconds
+        "DYNAMODB_CONNECT_TIMEOUT": float(environ.get('DYNAMODB_CONNECT_TIMEOUT', 2)),
+        "DYNAMODB_READ_TIMEOUT": float(environ.get('DYNAMODB_READ_TIMEOUT', 5)),
+        "DYNAMODB_TCP_KEEPALIVE": environ.get('DYNAMODB_TCP_KEEPALIVE', 'true').lower() == 'true',
+    }
+
+elif REPOSITORY_NAME == 'sqlite':
+    # Workers of one host share the database file
+    REPOSITORY_SETTINGS = {
+        "SQLITE_FILE": environ.get('SQLITE_FILE', 'greevil.sqlite3'),
+        # seconds a write waits for the write lock held by another worker
+        "SQLITE_BUSY_TIMEOUT": float(environ.get('SQLITE_BUSY_TIMEOUT', 5)),
+    }
+
+elif REPOSITORY_NAME == 'mongodb':
+    REPOSITORY_SETTINGS = {
+        # mongodb:// or mongodb+srv:// (requires dnspython), mongomock:// for an in-process mock (requires mongomock)
+        "MONGODB_URI": environ.get('MONGODB_URI', 'mongodb://localhost:27017'),
+        "MONGODB_DATABASE": environ.get('MONGODB_DATABASE', 'greevil'),
+        "MONGODB_USER_COLLECTION": environ.get('MONGODB_USER_COLLECTION', 'greevil-users'),
+        "MONGODB_EXPENSE_COLLECTION": environ.get('MONGODB_EXPENSE_COLLECTION', 'greevil-expenses'),
+        # connections kept open per worker process, at least the number of threads of a worker
+        "MONGODB_MAX_POOL_SIZE": int(environ.get('MONGODB_MAX_POOL_SIZE', 50)),
+        # seconds
+        "MONGODB_TIMEOUT": float(environ.get('MONGODB_TIMEOUT', 5)),
     }
 
 else:
     raise ValueError('Unknown repository.')
+
+# Read-through cache of users, expenses and rollups in front of the repository (see db/cache.py)
+REPOSITORY_CACHE_SETTINGS = {
+    # entries kept per worker process, 0 to disable the cache
+    "REPOSITORY_CACHE_SIZE": int(environ.get('REPOSITORY_CACHE_SIZE', 4096)),
+    # seconds, bounds staleness of writes made by other processes without the shared tier
+    "REPOSITORY_CACHE_TTL": int(environ.get('REPOSITORY_CACHE_TTL', 30)),
+    # shared tier (requires redis), e.g. redis://localhost:6379/0, empty for in-process only
+    "REPOSITORY_CACHE_REDIS_URL": environ.get('REPOSITORY_CACHE_REDIS_URL', ''),
+}
+
+# Expenses per page of /expenses/stats/ and /user/view/expenses/ when the request gives no limit
+EXPENSE_PAGE_SIZE = int(environ.get('EXPENSE_PAGE_SIZE', 100))
+
+# JSON encoder of the API responses: 'orjson' (falls back to 'json' when orjson is not installed) or 'json'
+JSON_ENCODER = environ.get('JSON_ENCODER', 'orjson')
+
+if JSON_ENCODER not in ('orjson', 'json'):
+    raise ValueError('Unknown JSON encoder.')
+
+# Forecasting engine of /expenses/stats/predict/: 'numpy' (built-in) or 'prophet' (requires fbprophet)
+FORECAST_ENGINE = environ.get('FORECAST_ENGINE', 'numpy')
+
+if FORECAST_ENGINE not in ('numpy', 'prophet'):
+    raise ValueError('Unknown forecasting engine.')
+
+# Forecasts (/expenses/stats/predict/) are cached per user until their expenses change
+FORECAST_CACHE_SIZE = int(environ.get('FORECAST_CACHE_SIZE', 256))
+FORECAST_CACHE_TTL = int(environ.get('FORECAST_CACHE_TTL', 24 * 60 * 60))
+# Directory where forecasts are persisted (shared by the workers of a host), empty to keep them in memory only
+FORECAST_CACHE_DIR = environ.get('FORECAST_CACHE_DIR', '')
+
+# Worker processes fitting forecasts in the background, 0 to fit them inside the request
+FORECAST_WORKERS = int(environ.get('FORECAST_WORKERS', 2))
+
+# Logging (see core/logs.py): level, and fraction of the DEBUG records written
+LOG_LEVEL = environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(environ.get('LOG_SAMPLE_RATE', 0.01))
+
+# Request, repository, DynamoDB and analytics timers served on /metrics (see core/metrics.py)
+METRICS_ENABLED = environ.get('METRICS_ENABLED', 'true').lower() == 'true'
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Date parsing of the stats pipeline: per-row string slicing (before) vs the vectorized
+core.frames.expense_frame (after), over histories of increasing size.
+"""
+import random
+from datetime import date, timedelta
+
+import pandas as pd
+
+from common import arguments, measure, report
+from core.frames import expense_frame
+
+
+def history(size, seed=0):
+    """Synthetic expenses, mixing plain dates and full timestamps"""
+    rng = random.Random(seed)
+    start = date(2015, 1, 1)
+    exp_list = []
+    for i in range(size):
+        day = start + timedelta(days=rng.randrange(3650))
+        exp_list.append({
+            "id": str(i),
+            "user_id": "user@greevil",
+            "amount": rng.randint(1, 5000),
+            "description": "",
+            "comments": "",
+            "payor": rng.choice(["user@greevil", "friend@greevil"]),
+            "date": day.isoformat() if i % 2 else f"{day.isoformat()}T{rng.randrange(24):02d}:15:00.000123",
+        })
+    return exp_list
+
+
+def before(exp_list):
+    """The former ExpenseStats pipeline: three apply() passes"""
+    df = pd.DataFrame(exp_list).sort_values('date')
+    df['amount'] = pd.to_numeric(df['amount'])
+    df['month'] = pd.to_numeric(df["date"].apply(lambda x: x[5:7]))
+    df['year'] = pd.to_numeric(df["date"].apply(lambda x: x[0:4]))
+    df['day'] = pd.to_numeric(df["date"].apply(lambda x: x[8:10]))
+    return df
+
+
+def after(exp_list):
+    """The same columns from the parsed dates"""
+    df = expense_frame(exp_list)
+    df['month'] = df['ds'].dt.month
+    df['year'] = df['ds'].dt.year
+    df['day'] = df['ds'].dt.day
+    return df
+
+
+def main():
+    args = arguments(__doc__)
+    results = []
+    for size in args.sizes:
+        exp_list = history(size)
+        old = measure(lambda: before(exp_list), args.repeat)
+        new = measure(lambda: after(exp_list), args.repeat)
+        results.append({"rows": size, "before_s": old, "after_s": new, "speedup": round(old / new, 2)})
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+End-to-end load test of the HTTP API. Boots run:app under gunicorn (on the in-memory repository
+unless REPOSITORY_NAME says otherwise), seeds synthetic users, friends and expenses through the
+API, then replays a mix of search, add expense, stats and predict requests from concurrent
+keep-alive clients. Reports requests/s, latency percentiles and histograms per request type, and
+CPU time and peak RSS of the server processes (read from /proc, Linux only).
+
+    python benchmarks/bench_http.py --concurrency 16 --duration 30 --mix search=40 add=20 stats=30 predict=10
+    REPOSITORY_NAME=mongodb MONGODB_URI=mongomock://localhost python benchmarks/bench_http.py
+    python benchmarks/bench_http.py --url http://localhost --server-pid <gunicorn master pid>
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import date, timedelta
+
+from common import APP_DIR, report
+
+# Upper bounds of the latency histogram buckets, in ms
+HISTOGRAM_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, float("inf")]
+# Expenses per /expenses/import/ request while seeding
+SEED_CHUNK = 5000
+STATS_PAGE_SIZE = 50
+
+
+class Client(object):
+    """HTTP/1.1 keep-alive connection of one simulated user, reconnecting after errors"""
+
+    def __init__(self, url, timeout=30):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        :return: (status, headers, body); status 0 when the connection failed
+        """
+        headers = dict(headers or {})
+        if body is not None:
+            body = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, response.headers, response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return 0, {}, b""
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def boot(args):
+    """
+    Starts gunicorn with run:app and waits until it answers
+    :return: (subprocess.Popen, url)
+    """
+    env = dict(os.environ)
+    env.setdefault("REPOSITORY_NAME", "memory")
+    if env["REPOSITORY_NAME"] == "memory" and args.workers > 1:
+        raise SystemExit("The in-memory repository lives in one process, use --workers 1 (and --threads)")
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "--threads", str(args.threads),
+         "-b", f"127.0.0.1:{port}", *args.gunicorn_args, "run:app"],
+        cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=sys.stderr if args.verbose else subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    client = Client(url)
+    deadline = time.monotonic() + 60
+    while client.request("GET", "/user/search/boot")[0] == 0:
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.kill()
+            raise SystemExit("The server did not start, run with --verbose for its logs")
+        time.sleep(0.2)
+    client.close()
+    return server, url
+
+
+def seed(url, args):
+    """
+    Adds users with friends and expenses through the API
+    :return: list of user emails
+    """
+    rng = random.Random(args.seed)
+    client = Client(url)
+    users = [f"load{i}@greevil" for i in range(args.users)]
+    for email in users:
+        client.request("POST", "/user/add/", {"email": email, "name": email.split("@")[0]})
+    for email in users:
+        for friend in rng.sample(users, min(args.friends, len(users))):
+            if friend != email:
+                client.request("POST", "/user/add/friend/", {"your_id": email, "friend_id": friend})
+
+    rows = []
+
+    def flush():
+        status, _, body = client.request("POST", "/expenses/import/?format=ndjson", "\n".join(rows).encode('utf-8'))
+        if status != 200 or json.loads(body).get("status") != "success":
+            raise SystemExit(f"Seeding failed: {status} {body[:200]!r}")
+        rows.clear()
+
+    for email in users:
+        for _ in range(args.expenses_per_user):
+            rows.append(json.dumps(random_expense(rng, email, users)))
+            if len(rows) == SEED_CHUNK:
+                flush()
+    if rows:
+        flush()
+    client.close()
+    return users
+
+
+def random_expense(rng, email, users):
+    """An /expenses/add/ body within the last year, paid by the user or a friend"""
+    day = date.today() - timedelta(days=rng.randrange(365))
+    return {
+        "email": email,
+        "amount": f"{rng.randint(100, 20000) / 100:.2f}",
+        "date": day.isoformat(),
+        "description": "Load test",
+        "comments": "",
+        "payor": email if rng.random() < 0.5 else rng.choice(users),
+    }
+
+
+def requests_mix(users):
+    """
+    Request builders of the mix, each returns (method, path, body)
+    :param users: list of user emails
+    :return: dict of name -> callable(rng)
+    """
+    return {
+        "search": lambda rng: ("GET", f"/user/search/{rng.choice(users)}", None),
+        "add": lambda rng: ("POST", "/expenses/add/", random_expense(rng, rng.choice(users), users)),
+        "stats": lambda rng: ("GET", f"/expenses/stats/{rng.choice(users)}?limit={STATS_PAGE_SIZE}", None),
+        "predict": lambda rng: ("POST", "/expenses/stats/predict/", {"email": rng.choice(users)}),
+    }
+
+
+def simulate(url, users, args, results, deadline, seed):
+    """
+    One simulated user sending requests back to back until the deadline
+    :param results: dict of name -> list of (latency in seconds, ok), appended to
+    """
+    rng = random.Random(seed)
+    client = Client(url)
+    builders = requests_mix(users)
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    etags = {}
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, path, body = builders[name](rng)
+        headers = {"Accept": "application/json"}
+        if args.revalidate and method == "GET" and path in etags:
+            headers["If-None-Match"] = etags[path]
+
+        start = time.perf_counter()
+        status, response_headers, content = client.request(method, path, body, headers)
+        latency = time.perf_counter() - start
+
+        # Errors are reported in the body with a 200 (compact with orjson)
+        ok = status == 304 or (status == 200 and b'"status": "error"' not in content
+                               and b'"status":"error"' not in content)
+        if status == 200 and response_headers.get("ETag"):
+            etags[path] = response_headers["ETag"]
+        results[name].append((latency, ok))
+    client.close()
+
+
+def process_tree(pid):
+    """
+    pid and its descendants (gunicorn workers, forecast workers)
+    :return: list of int
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # The command name can contain spaces, the fields after it cannot
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def usage(pids):
+    """
+    :return: (cpu seconds by pid, total RSS in bytes)
+    """
+    cpu, rss = {}, 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            continue
+        # utime and stime, fields 14 and 15 of stat
+        cpu[pid] = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu, rss
+
+
+class Sampler(threading.Thread):
+    """Samples CPU time and RSS of the server processes while the load runs"""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start_cpu, _ = usage(process_tree(pid))
+        self.end_cpu = dict(self.start_cpu)
+        self.peak_rss = 0
+        self.processes = 0
+
+    def run(self):
+        while True:
+            pids = process_tree(self.pid)
+            cpu, rss = usage(pids)
+            self.end_cpu.update(cpu)
+            self.peak_rss = max(self.peak_rss, rss)
+            self.processes = max(self.processes, len(cpu))
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return sum(self.end_cpu.values()) - sum(self.start_cpu.values())
+
+
+def summarize(name, samples, elapsed):
+    latencies = sorted(latency for latency, _ in samples)
+    if not latencies:
+        return None
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+
+    histogram = {}
+    for latency in latencies:
+        bound = next(bound for bound in HISTOGRAM_MS if latency * 1000 <= bound)
+        key = f"le_{bound:g}ms" if bound != float("inf") else f"gt_{HISTOGRAM_MS[-2]:g}ms"
+        histogram[key] = histogram.get(key, 0) + 1
+    return {
+        "request": name,
+        "requests": len(latencies),
+        "errors": sum(1 for _, ok in samples if not ok),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "max_ms": latencies[-1] * 1000,
+        "histogram": histogram,
+    }
+
+
+def mix_argument(value):
+    name, _, weight = value.partition("=")
+    if name not in ("search", "add", "stats", "predict") or not weight.isdigit():
+        raise argparse.ArgumentTypeError("expected <search|add|stats|predict>=<weight>")
+    return name, int(weight)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="load an already running server (e.g. behind nginx) instead of booting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the server with --url, for CPU/RSS")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--gunicorn-args", nargs=argparse.REMAINDER, default=[],
+                        help="extra gunicorn arguments (last option)")
+    parser.add_argument("--no-seed", dest="seed_data", action="store_false",
+                        help="do not add users and expenses (e.g. --url of a server seeded by an earlier run)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--friends", type=int, default=5, help="friends per user")
+    parser.add_argument("--expenses-per-user", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8, help="simulated users sending requests back to back")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before measuring")
+    parser.add_argument("--mix", type=mix_argument, nargs="+",
+                        default=[("search", 40), ("add", 20), ("stats", 30), ("predict", 10)])
+    parser.add_argument("--no-revalidate", dest="revalidate", action="store_false",
+                        help="do not send If-None-Match for repeated GETs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the server logs")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+    args.mix = dict(args.mix)
+    if args.duration <= 0:
+        parser.error("--duration must be positive")
+
+    server = None
+    if args.url:
+        url, pid = args.url.rstrip("/"), args.server_pid
+    else:
+        server, url = boot(args)
+        pid = server.pid
+    try:
+        if args.seed_data:
+            start = time.perf_counter()
+            users = seed(url, args)
+            print(f"Seeded {len(users)} users and {len(users) * args.expenses_per_user} expenses "
+                  f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        else:
+            users = [f"load{i}@greevil" for i in range(args.users)]
+
+        # Results of the warmup are dropped
+        for duration in (args.warmup, args.duration):
+            if duration <= 0:
+                continue
+            results = {name: [] for name in args.mix}
+            sampler = Sampler(pid) if pid else None
+            if sampler is not None:
+                sampler.start()
+            start = time.perf_counter()
+            deadline = time.monotonic() + duration
+            threads = [
+                threading.Thread(target=simulate, args=(url, users, args, results, deadline, args.seed + i))
+                for i in range(args.concurrency)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            cpu = sampler.stop() if sampler is not None else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    rows = [row for row in (summarize(name, samples, elapsed) for name, samples in results.items()) if row]
+    rows.append(summarize("all", [sample for samples in results.values() for sample in samples], elapsed))
+    server_row = {
+        "concurrency": args.concurrency,
+        "seconds": elapsed,
+        "cpu_s": cpu,
+        "cpu_percent": cpu / elapsed * 100 if cpu is not None else None,
+        "peak_rss_mb": sampler.peak_rss / 2 ** 20 if sampler is not None else None,
+        "processes": sampler.processes if sampler is not None else None,
+    }
+
+    if args.json:
+        report(rows, as_json=True)
+        report([{"request": "server", **server_row}], as_json=True)
+        return
+
+    histograms = [row.pop("histogram") for row in rows]
+    report(rows)
+    print()
+    columns = [f"le_{bound:g}ms" for bound in HISTOGRAM_MS[:-1]] + [f"gt_{HISTOGRAM_MS[-2]:g}ms"]
+    report([{"request": row["request"], **{column: histogram.get(column, 0) for column in columns}}
+            for row, histogram in zip(rows, histograms)])
+    print()
+    report([server_row])
+
+
+if __name__ == "__main__":
+    main()
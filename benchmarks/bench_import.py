@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Boot cost of a worker: import time (python -X importtime), wall time and RSS of "import run",
+and the heavy analytics modules loaded at boot. Exits with status 1 when one of them is
+imported eagerly, or when the import time exceeds --budget-ms, so regressions can be caught in CI.
+"""
+import os
+import subprocess
+import sys
+import time
+
+from common import APP_DIR, parser, report
+
+# Must only be imported on first use of the stats/predict endpoints
+HEAVY_MODULES = ["pandas", "numpy", "fbprophet", "prophet", "pystan"]
+
+PROBE = (
+    "import resource, sys; import run; "
+    "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss); "
+    "print(','.join(m for m in {modules!r} if m in sys.modules))"
+)
+
+
+def boot(env):
+    """
+    Imports the app in a fresh interpreter
+    :return: dict - import_ms, wall_ms, rss_mb, heavy (list), modules (cumulative us of the outer imports)
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(modules=HEAVY_MODULES)],
+        cwd=APP_DIR, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise SystemExit(process.stderr)
+
+    modules = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nesting is shown by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if cumulative.strip().isdigit() and depth <= 2:
+            modules[name.strip()] = int(cumulative)
+
+    rss, heavy = process.stdout.splitlines()[-2:]
+    return {
+        "import_ms": modules.get("run", 0) / 1000,
+        "wall_ms": wall * 1000,
+        # ru_maxrss is in KiB on Linux
+        "rss_mb": int(rss) / 1024,
+        "heavy": [module for module in heavy.split(",") if module],
+        "modules": modules,
+    }
+
+
+def main():
+    arguments = parser(__doc__, repeat=5)
+    arguments.add_argument("--budget-ms", type=float, default=None, help="maximum import time of run")
+    arguments.add_argument("--top", type=int, default=10, help="slowest top level imports to list")
+    args = arguments.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("REPOSITORY_NAME", "memory")
+
+    runs = [boot(env) for _ in range(args.repeat)]
+    best = min(runs, key=lambda run: run["import_ms"])
+
+    results = [{
+        "import_ms": best["import_ms"],
+        "wall_ms": min(run["wall_ms"] for run in runs),
+        "rss_mb": best["rss_mb"],
+        "heavy_modules": ",".join(best["heavy"]) or "-",
+    }]
+    report(results, args.json)
+    if not args.json:
+        print()
+        slowest = sorted(best["modules"].items(), key=lambda item: -item[1])
+        slowest = [(name, us) for name, us in slowest if name != "run"][:args.top]
+        report([{"module": name, "cumulative_ms": us / 1000} for name, us in slowest])
+
+    if best["heavy"]:
+        print(f"Imported at boot: {', '.join(best['heavy'])}", file=sys.stderr)
+        sys.exit(1)
+    if args.budget_ms is not None and best["import_ms"] > args.budget_ms:
+        print(f"Import time {best['import_ms']:.1f}ms exceeds {args.budget_ms}ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
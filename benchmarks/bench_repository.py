@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Throughput and latency of the repository backends (db/factory.py) at growing expense counts:
+add_expense, get_user, bulk get_expenses and the stats of a user (rollup and first page).
+Reports ops/s, p50 and p99 per operation; with --baseline (the --json output of an earlier run)
+exits with status 1 when a p50 got slower than --tolerance allows.
+
+mongodb runs on mongomock and dynamodb on moto unless --mongodb-uri / --dynamodb-endpoint point
+to a server (e.g. mongod, DynamoDB Local); both mocks scan their data, keep them to small sizes.
+"""
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from common import parser, report
+from db import User, Expense
+from db.factory import create_repository
+from db.rollup import rollup_stats
+
+BACKENDS = ["memory", "sqlite", "mongodb", "dynamodb"]
+# Expenses loaded per add_expenses call
+LOAD_CHUNK = 1000
+# Ids per get_expenses call, and expenses of the first page of the stats
+BULK_SIZE = 100
+PAGE_SIZE = 50
+
+
+@contextlib.contextmanager
+def backend(name, args):
+    """
+    An empty repository
+    :param name: str, one of BACKENDS
+    :param args: argparse.Namespace
+    :return: repository
+    """
+    suffix = uuid.uuid4().hex[:8]
+    if name == "memory":
+        from db.memory import Repository
+        # The factory keeps a single in-memory repository per process
+        yield Repository({})
+
+    elif name == "sqlite":
+        directory = tempfile.mkdtemp()
+        try:
+            yield create_repository("sqlite", {"SQLITE_FILE": os.path.join(directory, "bench.sqlite3")})
+        finally:
+            shutil.rmtree(directory)
+
+    elif name == "mongodb":
+        settings = {"MONGODB_URI": args.mongodb_uri, "MONGODB_DATABASE": f"bench-{suffix}"}
+        repository = create_repository("mongodb", settings)
+        try:
+            yield repository
+        finally:
+            repository.database.client.drop_database(settings["MONGODB_DATABASE"])
+
+    elif name == "dynamodb":
+        settings = {
+            "DYNAMODB_USER_TABLE": f"bench-users-{suffix}",
+            "DYNAMODB_EXPENSE_TABLE": f"bench-expenses-{suffix}",
+            "DYNAMODB_ROLLUP_TABLE": f"bench-rollups-{suffix}",
+            "DYNAMODB_EXPENSE_MODE": args.dynamodb_mode,
+            "DYNAMODB_ENDPOINT_URL": args.dynamodb_endpoint,
+        }
+        if args.dynamodb_endpoint:
+            mock = contextlib.nullcontext()
+        else:
+            from moto import mock_aws
+            for key in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+                os.environ.setdefault(key, "testing")
+            mock = mock_aws()
+        with mock:
+            repository = create_repository("dynamodb", settings)
+            repository.create_tables()
+            try:
+                yield repository
+            finally:
+                if args.dynamodb_endpoint:
+                    for table in (repository.user_index, repository.expense_index, repository.rollup_index):
+                        table.delete()
+
+    else:
+        raise SystemExit(f"Unknown backend {name}")
+
+
+def random_expense(rng, users, id=None):
+    payee = rng.choice(users)
+    # A third of the expenses are paid by the payee
+    payor = payee if rng.random() < 0.33 else rng.choice(users)
+    return Expense(
+        id=id or uuid.UUID(int=rng.getrandbits(128)).hex,
+        user_id=payee,
+        payor=payor,
+        amount=f"{rng.randint(100, 50000) / 100:.2f}",
+        description="Benchmark",
+        comments="",
+        date=f"{rng.choice((2025, 2026))}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+    )
+
+
+def load(repository, size, users, rng):
+    """
+    Adds the users and size expenses
+    :return: (list of expense ids, seconds)
+    """
+    start = time.perf_counter()
+    for user_id in users:
+        repository.add_user(User(id=user_id, name=user_id))
+
+    ids = []
+    for offset in range(0, size, LOAD_CHUNK):
+        expenses = [random_expense(rng, users) for _ in range(min(LOAD_CHUNK, size - offset))]
+        errors = repository.add_expenses(expenses)
+        if any(errors):
+            raise SystemExit(f"Load failed: {next(err for err in errors if err)!r}")
+        ids.extend(exp.id for exp in expenses)
+    return ids, time.perf_counter() - start
+
+
+def percentile(latencies, fraction):
+    """Nearest-rank percentile of sorted latencies"""
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def run(operation, count):
+    """
+    Calls operation count times
+    :return: dict - ops_per_s, p50_ms, p99_ms
+    """
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "ops_per_s": count / sum(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def benchmark(repository, size, args):
+    """
+    Loads size expenses and measures every operation
+    :return: list of dict
+    """
+    rng = random.Random(args.seed)
+    users = [f"user{i}@greevil" for i in range(max(2, size // args.expenses_per_user))]
+    ids, load_s = load(repository, size, users, rng)
+
+    def add_expense(i):
+        repository.add_expense(random_expense(rng, users, id=f"bench-{i}"))
+
+    def get_user(i):
+        repository.get_user(rng.choice(users))
+
+    def get_expenses(i):
+        repository.get_expenses(rng.sample(ids, min(BULK_SIZE, len(ids))))
+
+    def stats(i):
+        user_id = rng.choice(users)
+        rollup_stats(repository.get_rollup(user_id))
+        repository.page_expenses(user_id, limit=PAGE_SIZE)
+
+    operations = {"add_expense": add_expense, "get_user": get_user, "get_expenses": get_expenses, "stats": stats}
+    results = []
+    for name in args.operations:
+        row = {"backend": repository.name, "expenses": size, "users": len(users), "op": name}
+        row.update(run(operations[name], args.ops))
+        row["load_s"] = load_s
+        results.append(row)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Operations whose p50 is more than tolerance slower than in the baseline
+    :param results:   list of dict
+    :param baseline:  path of a file with the --json output of an earlier run
+    :param tolerance: float, e.g. 0.25 for 25%
+    :return: list of str
+    """
+    with open(baseline) as f:
+        before = {(row["backend"], row["expenses"], row["op"]): row for row in map(json.loads, filter(str.strip, f))}
+
+    slower = []
+    for row in results:
+        old = before.get((row["backend"], row["expenses"], row["op"]))
+        if old is not None and row["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+            slower.append(f"{row['backend']} {row['op']} at {row['expenses']} expenses: "
+                          f"p50 {old['p50_ms']:.3f}ms -> {row['p50_ms']:.3f}ms")
+    return slower
+
+
+def main():
+    arguments = parser(__doc__, sizes=[1000, 100000])
+    arguments.add_argument("--backends", nargs="+", choices=BACKENDS, default=["memory", "sqlite"])
+    arguments.add_argument("--operations", nargs="+", choices=["add_expense", "get_user", "get_expenses", "stats"],
+                           default=["add_expense", "get_user", "get_expenses", "stats"])
+    arguments.add_argument("--ops", type=int, default=1000, help="calls per operation")
+    arguments.add_argument("--expenses-per-user", type=int, default=100)
+    arguments.add_argument("--seed", type=int, default=0)
+    arguments.add_argument("--mongodb-uri", default="mongomock://localhost")
+    arguments.add_argument("--dynamodb-endpoint", default="", help="e.g. http://localhost:8000, moto when empty")
+    arguments.add_argument("--dynamodb-mode", choices=["list", "index"], default="index")
+    arguments.add_argument("--baseline", help="--json output of an earlier run to compare with")
+    arguments.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown against the baseline")
+    args = arguments.parse_args()
+
+    results = []
+    for name in args.backends:
+        for size in args.sizes:
+            with backend(name, args) as repository:
+                results.extend(benchmark(repository, size, args))
+    report(results, args.json)
+
+    if args.baseline:
+        slower = regressions(results, args.baseline, args.tolerance)
+        for line in slower:
+            print(f"Regression: {line}", file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
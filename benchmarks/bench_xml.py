@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+XML representation of a stats response with a growing exp_list: the minidom XmlTransformer
+(before) vs the streaming XmlStream, compact and pretty (after). Peak memory is traced separately.
+"""
+import random
+import tracemalloc
+
+from common import arguments, measure, report
+from core.transformer import XmlTransformer, XmlStream
+
+
+def payload(size, seed=0):
+    """A /expenses/stats/ response document with size expenses"""
+    rng = random.Random(seed)
+    exp_list = [{
+        "id": f"{i:032x}",
+        "user_id": "user@greevil",
+        "amount": float(rng.randint(1, 5000)),
+        "description": "Dinner & drinks <shared>",
+        "comments": "",
+        "payor": rng.choice(["user@greevil", "friend@greevil"]),
+        "date": f"2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+    } for i in range(size)]
+    data = {
+        "exp_list": exp_list,
+        "area_chart": {f"2020-01-{day:02d}": float(day) for day in range(1, 29)},
+        "bar_chart": {str(month): float(month) for month in range(1, 13)},
+        "pie_chart": {"friend@greevil": 10.0},
+        "new_expenses": 0,
+        "monthly_expenses": 0,
+        "friends_amount": 0,
+        "owed_amount": 0,
+    }
+    return {"data": data, "status": "success"}
+
+
+def before(data):
+    return str(XmlTransformer(data))
+
+
+def streamed(data, pretty):
+    """Consumes the stream like the WSGI server does, chunk by chunk"""
+    for _ in XmlStream(data, pretty):
+        pass
+
+
+def peak_memory(func):
+    """Peak traced allocation of func, in MiB"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    args = arguments(__doc__, sizes=[100, 1000, 10000])
+    results = []
+    for size in args.sizes:
+        data = payload(size)
+        old = measure(lambda: before(data), args.repeat)
+        compact = measure(lambda: streamed(data, False), args.repeat)
+        pretty = measure(lambda: streamed(data, True), args.repeat)
+        results.append({
+            "rows": size,
+            "before_s": old,
+            "stream_s": compact,
+            "stream_pretty_s": pretty,
+            "speedup": round(old / compact, 2),
+            "before_peak_mib": peak_memory(lambda: before(data)),
+            "stream_peak_mib": peak_memory(lambda: streamed(data, False)),
+        })
+    report(results, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Shared helpers for the benchmark scripts.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+# The app modules import each other as top level packages (core, db, settings)
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+
+def arguments(description, **defaults):
+    """
+    Common command line arguments
+    :param description: str
+    :param defaults:    default values, e.g. sizes=[1000, 10000]
+    :return: argparse.Namespace
+    """
+    return parser(description, **defaults).parse_args()
+
+
+def parser(description, **defaults):
+    """
+    Parser of the common command line arguments, for scripts adding their own
+    :param description: str
+    :param defaults:    default values, e.g. sizes=[1000, 10000]
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--sizes", type=int, nargs="+", default=defaults.get("sizes", [1000, 10000, 100000]),
+                        help="input sizes to benchmark")
+    parser.add_argument("--repeat", type=int, default=defaults.get("repeat", 5),
+                        help="runs per measurement (the best one is reported)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    return parser
+
+
+def measure(func, repeat=5):
+    """
+    Runs func repeat times
+    :param func:   callable without arguments
+    :param repeat: int
+    :return: best wall time in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(results, as_json=False):
+    """
+    Prints the results of a benchmark
+    :param results: list of dict (same keys in every row)
+    :param as_json: bool, one JSON object per line instead of a table
+    :return: None
+    """
+    if as_json:
+        for row in results:
+            print(json.dumps(row))
+        return
+
+    columns = list(results[0])
+    widths = [max(len(str(column)), *(len(_format(row[column])) for row in results)) for column in columns]
+    print("  ".join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in results:
+        print("  ".join(_format(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return str(value)
@@ -0,0 +1,242 @@
+"""
+Read-through repository cache (db/cache.py) over the in-memory backend: invalidation of both tiers
+on every write, hit/miss counters, and users with lazily loaded expense ids.
+"""
+import pytest
+
+from db import User, Expense, UserNotFound
+from db.cache import CachingRepository, SharedCache, USER, EXPENSE, ROLLUP, VERSION
+from db.memory import Repository
+
+
+class DictCache(SharedCache):
+    """Shared tier kept in a dict, standing for redis"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl):
+        self.data[key] = value
+
+    def delete(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def expense(id, user_id, payor, amount="10", date="2026-03-01"):
+    return Expense(id=id, user_id=user_id, payor=payor, amount=amount, date=date, description="", comments="")
+
+
+@pytest.fixture
+def shared():
+    return DictCache()
+
+
+@pytest.fixture
+def cache(shared):
+    repository = Repository({})
+    for user_id in ("a@x", "b@x", "c@x"):
+        repository.add_user(User(id=user_id, name=user_id[0]))
+    repository.add_expense(expense("e1", "a@x", "b@x", "12.50"))
+    repository.add_expense(expense("e2", "c@x", "c@x", "3"))
+    return CachingRepository(repository, max_size=100, ttl=60, shared=shared)
+
+
+def warm(cache):
+    """Caches every user, rollup and expense in both tiers"""
+    for user_id in ("a@x", "b@x", "c@x"):
+        cache.get_user(user_id)
+        cache.get_rollup(user_id)
+    for expense_id in ("e1", "e2"):
+        cache.get_expense(expense_id)
+
+
+def cached(cache, shared):
+    """Keys held by both tiers"""
+    local = set(cache.local.entries)
+    assert local == set(shared.data)
+    return local
+
+
+def keys(users=(), expenses=()):
+    return {kind + id for id in users for kind in (USER, ROLLUP)} | {EXPENSE + id for id in expenses}
+
+
+ALL = keys(["a@x", "b@x", "c@x"], ["e1", "e2"])
+
+
+def total(rollup):
+    return sum(float(amount) for bucket, amount in rollup.items() if bucket.startswith("day#"))
+
+
+def test_counters(cache):
+    cache.get_user("a@x")
+    cache.get_user("a@x")
+    cache.get_expense("e1")
+    cache.get_rollup("a@x")
+    cache.get_rollup("a@x")
+    cache.get_rollup("a@x")
+    with pytest.raises(UserNotFound):
+        cache.get_user("missing@x")
+
+    stats = cache.cache_stats()
+    assert stats["user"] == {"hits": 1, "shared_hits": 0, "misses": 2}
+    assert stats["expense"] == {"hits": 0, "shared_hits": 0, "misses": 1}
+    # get_rollup of the memory backend reads the user itself, not through the cache
+    assert stats["rollup"] == {"hits": 2, "shared_hits": 0, "misses": 1}
+    assert stats["size"] == 3
+    assert stats["max_size"] == 100
+
+
+def test_shared_tier_serves_other_workers(cache, shared):
+    warm(cache)
+    other = CachingRepository(cache.repository, max_size=100, ttl=60, shared=shared)
+    user = other.get_user("a@x")
+    assert (user.name, user.expense_ids) == ("a", ["e1"])
+    assert other.get_expense("e1").amount == cache.get_expense("e1").amount
+    assert other.cache_stats()["user"] == {"hits": 0, "shared_hits": 1, "misses": 0}
+    assert other.cache_stats()["expense"] == {"hits": 0, "shared_hits": 1, "misses": 0}
+
+
+def test_not_found_is_not_cached(cache, shared):
+    with pytest.raises(UserNotFound):
+        cache.get_user("missing@x")
+    assert cached(cache, shared) == set()
+
+
+def test_add_expense_invalidates(cache, shared):
+    warm(cache)
+    before = total(cache.get_rollup("a@x"))
+    cache.add_expense(expense("e3", "a@x", "c@x", "5"))
+
+    assert cached(cache, shared) == ALL - keys(["a@x", "c@x"])
+    assert total(cache.get_rollup("a@x")) == before + 5
+    assert "e3" in cache.get_user("c@x").expense_ids
+
+
+def test_add_expenses_invalidates(cache, shared):
+    warm(cache)
+    cache.add_expenses([expense("e3", "a@x", "a@x"), expense("e4", "b@x", "a@x")])
+    assert cached(cache, shared) == ALL - keys(["a@x", "b@x"])
+
+
+@pytest.mark.parametrize("field, data, users", [
+    ("amount", "20", ["a@x", "b@x"]),
+    ("description", "dinner", ["a@x", "b@x"]),
+    # The new participant is invalidated as well as the old ones
+    ("payor", "c@x", ["a@x", "b@x", "c@x"]),
+    ("user_id", "c@x", ["a@x", "b@x", "c@x"]),
+])
+def test_update_expense_invalidates(cache, shared, field, data, users):
+    warm(cache)
+    cache.update_expense("e1", field, data)
+
+    assert cached(cache, shared) == ALL - keys(users, ["e1"])
+    assert getattr(cache.get_expense("e1"), field) == data
+
+
+def test_update_expense_rollups(cache, shared):
+    warm(cache)
+    cache.update_expense("e1", "amount", "20")
+    assert total(cache.get_rollup("a@x")) == 20
+
+
+def test_delete_expense_invalidates(cache, shared):
+    warm(cache)
+    cache.delete_expense("e1")
+
+    assert cached(cache, shared) == ALL - keys(["a@x", "b@x"], ["e1"])
+    assert total(cache.get_rollup("a@x")) == 0
+    assert "e1" not in cache.get_user("b@x").expense_ids
+
+
+def test_update_user_invalidates(cache, shared):
+    warm(cache)
+    cache.update_user("a@x", "name", "Alice")
+
+    assert cached(cache, shared) == ALL - keys(["a@x"])
+    assert cache.get_user("a@x").name == "Alice"
+
+
+def test_add_friend_invalidates(cache, shared):
+    warm(cache)
+    cache.add_friend("a@x", "b@x")
+
+    assert cached(cache, shared) == ALL - keys(["a@x", "b@x"])
+    assert "b@x" in cache.get_user("a@x").friend_ids
+
+
+def test_rebuild_rollups_clears_local_tier(cache, shared):
+    warm(cache)
+    cache.rebuild_rollups()
+    assert cache.local.entries == {}
+
+
+def test_version_revalidates_writes_of_other_workers(cache, shared):
+    other = CachingRepository(cache.repository, max_size=100, ttl=60, shared=shared)
+    version = cache.get_version("a@x")
+    before = total(cache.get_rollup("a@x"))
+    other.add_expense(expense("e3", "a@x", "b@x", "5"))
+
+    # The local tier is only invalidated by writes of its own worker, until ttl
+    assert total(cache.get_rollup("a@x")) == before
+    # Reads following the new version (e.g. the body under its ETag) are as recent
+    assert cache.get_version("a@x") != version
+    assert total(cache.get_rollup("a@x")) == before + 5
+    assert "e3" in cache.get_user("a@x").expense_ids
+
+
+def test_version_keys_the_shared_tier(cache, shared):
+    version = cache.get_version("a@x")
+    before = total(cache.get_rollup("a@x"))
+    assert ROLLUP + f"a@x@{version}" in shared.data
+
+    # A write the shared tier missed, like one racing with the caching of the old rollup
+    cache.repository.add_expense(expense("e3", "a@x", "b@x", "5"))
+    other = CachingRepository(cache.repository, max_size=100, ttl=60, shared=shared)
+    assert other.get_version("a@x") != version
+    assert total(other.get_rollup("a@x")) == before + 5
+
+
+def test_own_writes_drop_the_version(cache, shared):
+    cache.get_version("a@x")
+    before = total(cache.get_rollup("a@x"))
+    cache.add_expense(expense("e3", "a@x", "b@x", "5"))
+
+    assert VERSION + "a@x" not in cache.local.entries
+    assert not any(key.startswith(ROLLUP + "a@x") for key in shared.data)
+    assert total(cache.get_rollup("a@x")) == before + 5
+
+
+class LazyRepository(object):
+    """Backend whose users load their expense ids on first access, like sqlite and mongodb"""
+    name = "Lazy"
+
+    def __init__(self):
+        self.loads = 0
+
+    def get_user(self, id):
+        def expense_ids():
+            self.loads += 1
+            return ["e1", "e2"]
+
+        return User(id=id, name="lazy", expense_ids=expense_ids)
+
+
+def test_lazy_expense_ids_are_not_loaded(shared):
+    backend = LazyRepository()
+    cache = CachingRepository(backend, shared=shared)
+    cache.get_user("a@x")
+    assert backend.loads == 0
+
+    # Another worker gets the user from the shared tier, its expense ids are loaded on first access
+    other = CachingRepository(backend, shared=shared)
+    user = other.get_user("a@x")
+    assert other.cache_stats()["user"]["shared_hits"] == 1
+    assert backend.loads == 0
+    assert user.expense_ids == ["e1", "e2"]
+    assert backend.loads == 1
+
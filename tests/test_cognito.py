@@ -0,0 +1,184 @@
+"""
+Local verification of Cognito tokens (core/cognito.py) against a generated RSA key set.
+"""
+import base64
+import json
+import time
+
+import pytest
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from flask import Flask, g
+    from jose import jwt
+
+    from core.cognito import CognitoPool, TokenVerificationError
+except ImportError as err:
+    pytest.skip(f"Cognito dependencies unavailable: {err}", allow_module_level=True)
+
+POOL_ID = "us-east-1_TestPool"
+CLIENT_ID = "test-client"
+REGION = "us-east-1"
+ISSUER = f"https://cognito-idp.{REGION}.amazonaws.com/{POOL_ID}"
+
+
+def b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class SigningKey(object):
+    """An RSA key pair with its JWK"""
+
+    def __init__(self, kid):
+        self.kid = kid
+        private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.pem = private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                         serialization.NoEncryption()).decode("ascii")
+        numbers = private.public_key().public_numbers()
+        self.jwk = {"kid": kid, "kty": "RSA", "alg": "RS256", "use": "sig", "n": b64(numbers.n), "e": b64(numbers.e)}
+
+    def token(self, token_use="access", **claims):
+        now = int(time.time())
+        body = {"iss": ISSUER, "sub": "user-1", "token_use": token_use, "iat": now, "exp": now + 3600}
+        if token_use == "access":
+            body["client_id"] = CLIENT_ID
+        else:
+            body["aud"] = CLIENT_ID
+        body.update(claims)
+        return jwt.encode(body, self.pem, algorithm="RS256", headers={"kid": self.kid})
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return SigningKey("key-1"), SigningKey("key-2")
+
+
+@pytest.fixture
+def jwks_file(tmp_path, keys):
+    path = tmp_path / "jwks.json"
+    path.write_text(json.dumps({"keys": [keys[0].jwk]}))
+    return path
+
+
+@pytest.fixture
+def pool(jwks_file):
+    pool = CognitoPool(POOL_ID, CLIENT_ID, REGION, str(jwks_file))
+    refresh = pool.jwks.refresh
+    pool.refreshes = 0
+
+    def counting_refresh():
+        pool.refreshes += 1
+        refresh()
+
+    pool.jwks.refresh = counting_refresh
+    return pool
+
+
+def test_valid_tokens(pool, keys):
+    claims = pool.verify_token(keys[0].token("access"), "access")
+    assert claims["sub"] == "user-1"
+    assert claims["client_id"] == CLIENT_ID
+    assert pool.verify_token(keys[0].token("id"), "id")["aud"] == CLIENT_ID
+
+
+def test_expired_token(pool, keys):
+    token = keys[0].token(iat=int(time.time()) - 7200, exp=int(time.time()) - 3600)
+    with pytest.raises(TokenVerificationError):
+        pool.verify_token(token, "access")
+
+
+@pytest.mark.parametrize("token_use, claims", [
+    ("id", {"aud": "another-client"}),
+    ("access", {"client_id": "another-client"}),
+])
+def test_token_of_another_client(pool, keys, token_use, claims):
+    with pytest.raises(TokenVerificationError):
+        pool.verify_token(keys[0].token(token_use, **claims), token_use)
+
+
+def test_token_of_another_pool(pool, keys):
+    with pytest.raises(TokenVerificationError):
+        pool.verify_token(keys[0].token(iss=ISSUER + "-other"), "access")
+
+
+@pytest.mark.parametrize("token_use, expected", [("id", "access"), ("access", "id")])
+def test_wrong_token_use(pool, keys, token_use, expected):
+    with pytest.raises(TokenVerificationError):
+        pool.verify_token(keys[0].token(token_use), expected)
+
+
+def test_token_signed_by_another_key(pool, keys):
+    # The kid of the pool, but the signature of another key
+    token = jwt.encode({"iss": ISSUER, "token_use": "access", "client_id": CLIENT_ID,
+                        "exp": int(time.time()) + 60}, keys[1].pem, algorithm="RS256", headers={"kid": "key-1"})
+    with pytest.raises(TokenVerificationError):
+        pool.verify_token(token, "access")
+
+
+def test_unknown_kid_refreshes_the_keys(pool, keys, jwks_file):
+    pool.verify_token(keys[0].token(), "access")
+    assert pool.refreshes == 1
+
+    # Cognito rotated its keys: a token signed by the new key triggers a refresh once the interval has passed
+    jwks_file.write_text(json.dumps({"keys": [keys[0].jwk, keys[1].jwk]}))
+    pool.jwks.fetched -= pool.jwks.REFRESH_INTERVAL + 1
+    assert pool.verify_token(keys[1].token(), "access")["sub"] == "user-1"
+    assert pool.refreshes == 2
+
+
+def test_refresh_at_most_once_a_minute(pool, keys, jwks_file):
+    pool.verify_token(keys[0].token(), "access")
+    jwks_file.write_text(json.dumps({"keys": [keys[0].jwk, keys[1].jwk]}))
+
+    # Unknown key ids within the interval do not reload the key set, whatever their number
+    unknown = SigningKey("key-3")
+    for _ in range(5):
+        for key in (keys[1], unknown):
+            with pytest.raises(TokenVerificationError):
+                pool.verify_token(key.token(), "access")
+    assert pool.refreshes == 1
+
+
+def test_authenticated(pool, keys):
+    app = Flask(__name__)
+
+    @app.route("/private")
+    @pool.authenticated
+    def private():
+        return {"sub": g.claims["sub"]}
+
+    client = app.test_client()
+    assert client.get("/private").status_code == 401
+    assert client.get("/private", headers={"Authorization": "Basic abc"}).status_code == 401
+    assert client.get("/private", headers={"Authorization": f"Bearer {keys[0].token('id')}"}).status_code == 401
+
+    response = client.get("/private", headers={"Authorization": f"Bearer {keys[0].token()}"})
+    assert response.status_code == 200
+    assert response.get_json() == {"sub": "user-1"}
+
+
+@pytest.mark.parametrize("content", [None, "not json"])
+def test_unavailable_keys(tmp_path, keys, content):
+    path = tmp_path / "jwks.json"
+    if content is not None:
+        path.write_text(content)
+    pool = CognitoPool(POOL_ID, CLIENT_ID, REGION, str(path))
+
+    with pytest.raises(TokenVerificationError, match="unavailable"):
+        pool.verify_token(keys[0].token(), "access")
+    # The warrant user of the login endpoint reads the same keys
+    user = pool.user(username="user-1")
+    with pytest.raises(TokenVerificationError, match="unavailable"):
+        user.get_key("key-1")
+    with pytest.raises(TokenVerificationError, match="unavailable"):
+        user.get_keys()
+
+
+def test_pooled_user_keys(pool, keys):
+    user = pool.user(username="user-1")
+    assert user.get_key("key-1") == keys[0].jwk
+    assert user.get_keys() == {"keys": [keys[0].jwk]}
+    with pytest.raises(TokenVerificationError, match="Unknown"):
+        user.get_key("key-3")
@@ -0,0 +1,95 @@
+"""
+JSON encoding of responses (core/encoding.py): orjson and the standard library encoder give the same documents.
+"""
+import datetime
+import decimal
+import json
+
+import pytest
+
+from core import encoding
+from core.encoding import dumps
+
+requires_orjson = pytest.mark.skipif(encoding.orjson is None, reason="orjson is not installed")
+
+DOCUMENTS = [
+    {"data": "text", "status": "success", "next_cursor": None},
+    {"amount": decimal.Decimal("12.50"), "count": decimal.Decimal("3"), "ratio": 0.1, "flag": True},
+    {"date": datetime.date(2026, 1, 5), "time": datetime.time(8, 30, 15),
+     "datetime": datetime.datetime(2026, 1, 5, 10, 0, 0, 123),
+     "aware": datetime.datetime(2026, 1, 5, 10, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))},
+    # Non-str keys, like the months of bar_chart
+    {"bar_chart": {1: 2.0, 12: 3.5}, "floats": {2.5: 1}, "bools": {True: 1}, "none": {None: 0},
+     "dates": {datetime.date(2026, 1, 5): 1.0}},
+    {"nan": float("nan"), "inf": [float("inf"), -float("inf")]},
+    {"set": {1}, "tuple": (1, "a"), "text": "Café & <€> \"quoted\"\n", "nested": [{"a": [{"b": []}]}, {}]},
+]
+
+
+def decoded(data, encoder, indent=False):
+    body = dumps(data, encoder, indent)
+    assert isinstance(body, bytes)
+    assert body.endswith(b"\n")
+    return json.loads(body)
+
+
+@requires_orjson
+@pytest.mark.parametrize("data", DOCUMENTS)
+@pytest.mark.parametrize("indent", [False, True])
+def test_encoders_agree(data, indent):
+    assert decoded(data, "orjson", indent) == decoded(data, "json", indent)
+
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_conversions(encoder):
+    assert decoded(DOCUMENTS[1], encoder)["amount"] == 12.5
+    assert decoded(DOCUMENTS[2], encoder) == {"date": "2026-01-05", "time": "08:30:15",
+                                              "datetime": "2026-01-05T10:00:00.000123",
+                                              "aware": "2026-01-05T10:00:00+02:00"}
+    assert decoded(DOCUMENTS[3], encoder)["bar_chart"] == {"1": 2.0, "12": 3.5}
+    assert decoded(DOCUMENTS[3], encoder)["dates"] == {"2026-01-05": 1.0}
+    # Invalid JSON otherwise
+    assert decoded(DOCUMENTS[4], encoder) == {"nan": None, "inf": [None, None]}
+
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_analytics_types(encoder):
+    np = pytest.importorskip("numpy")
+    pd = pytest.importorskip("pandas")
+    data = {
+        "scalars": [np.int64(3), np.float64(1.5), np.bool_(True), np.float64("nan")],
+        "array": np.arange(3),
+        "timestamp": pd.Timestamp("2026-01-05 10:00"),
+        "nat": pd.NaT,
+        "series": pd.Series([1.0, 2.0]),
+        "frame": pd.DataFrame({"ds": ["2026-01-05"], "y": [1.0]}),
+    }
+    assert decoded(data, encoder) == {
+        "scalars": [3, 1.5, True, None],
+        "array": [0, 1, 2],
+        "timestamp": "2026-01-05T10:00:00",
+        "nat": None,
+        "series": [1.0, 2.0],
+        "frame": [{"ds": "2026-01-05", "y": 1.0}],
+    }
+
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_unknown_type(encoder):
+    with pytest.raises(TypeError):
+        dumps({"value": object()}, encoder)
+
+
+def test_responses_match(client, monkeypatch):
+    """The responses of the API are the same with either encoder"""
+    import apis
+
+    client.post("/user/add/", json={"email": "encoding@x", "name": "E"})
+    client.post("/expenses/add/", json={"email": "encoding@x", "amount": "12.50", "date": "2026-01-05",
+                                        "description": "Café", "comments": "", "payor": "encoding@x"})
+    bodies = []
+    for encoder in ("orjson", "json"):
+        monkeypatch.setattr(apis, "JSON_ENCODER", encoder)
+        bodies.append(json.loads(client.get("/expenses/stats/encoding@x").get_data()))
+    assert bodies[0] == bodies[1]
+    assert bodies[0]["data"]["bar_chart"] == {"1": 12.5}
@@ -0,0 +1,104 @@
+"""
+Background forecasting (core/forecast_jobs.py): coalescing, status transitions and recovery of the pool.
+"""
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from core.forecast_cache import ForecastCache
+from core.forecast_jobs import ForecastJobs
+
+HISTORY = [{"id": str(i), "amount": 10 + i, "date": f"2025-{i % 12 + 1:02d}-01"} for i in range(24)]
+
+
+class ManualExecutor(object):
+    """Executor whose futures are completed by the test"""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.futures.append(future)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+@pytest.fixture
+def jobs():
+    jobs = ForecastJobs(ForecastCache(), workers=1)
+    jobs.executor = ManualExecutor()
+    return jobs
+
+
+def wait_for(jobs, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while jobs.status(job_id)[0] == "pending":
+        assert time.monotonic() < deadline, "the forecast did not finish"
+        time.sleep(0.05)
+    return jobs.status(job_id)
+
+
+def test_unknown_job(jobs):
+    assert jobs.status("missing") == (None, None)
+
+
+def test_submit_coalesces_running_job(jobs):
+    job_id = jobs.submit("a@x", "v1", HISTORY)
+    assert jobs.submit("a@x", "v1", HISTORY) == job_id
+    assert jobs.running_job("a@x", "v1") == job_id
+    assert len(jobs.executor.futures) == 1
+
+    # A changed history gets its own job, as does another user
+    assert jobs.submit("a@x", "v2", HISTORY) != job_id
+    assert jobs.running_job("a@x", "v1") is None
+    assert jobs.submit("b@x", "v1", HISTORY) != job_id
+    assert len(jobs.executor.futures) == 3
+
+
+def test_done_job(jobs):
+    job_id = jobs.submit("a@x", "v1", HISTORY)
+    assert jobs.status(job_id) == ("pending", None)
+
+    jobs.executor.futures[0].set_result({"data": "chart"})
+    assert jobs.status(job_id) == ("done", {"xml": {"data": "chart"}})
+    assert jobs.cache.get("a@x", "v1") == {"xml": {"data": "chart"}}
+    # Finished jobs are no longer coalesced onto
+    assert jobs.running_job("a@x", "v1") is None
+    assert jobs.submit("a@x", "v1", HISTORY) != job_id
+
+
+def test_failed_job(jobs):
+    job_id = jobs.submit("a@x", "v1", HISTORY)
+    jobs.executor.futures[0].set_exception(ValueError("bad history"))
+
+    status, error = jobs.status(job_id)
+    assert status == "error"
+    assert isinstance(error, ValueError)
+    assert jobs.cache.get("a@x", "v1") is None
+    assert jobs.running_job("a@x", "v1") is None
+
+
+def test_broken_pool_is_replaced():
+    jobs = ForecastJobs(ForecastCache(), workers=1)
+    status, result = wait_for(jobs, jobs.submit("a@x", "v1", HISTORY))
+    assert status == "done"
+
+    # A worker process dying breaks the whole pool
+    broken = jobs.executor
+    for process in list(broken._processes.values()):
+        process.kill()
+    deadline = time.monotonic() + 30
+    while not broken._broken:
+        assert time.monotonic() < deadline, "the pool did not notice the dead worker"
+        time.sleep(0.05)
+
+    status, result = wait_for(jobs, jobs.submit("a@x", "v2", HISTORY))
+    assert status == "done"
+    assert result == jobs.cache.get("a@x", "v2")
+    assert jobs.executor is not broken
+    jobs.executor.shutdown()
@@ -0,0 +1,221 @@
+"""
+Expense files (core/expense_import.py, core/expense_export.py): parsing, line-numbered error reports,
+and export -> import round trips through the repositories and the HTTP endpoints.
+"""
+import gzip
+import io
+import json
+
+import pytest
+
+from core.expense_export import export_chunks, gzip_chunks
+from core.expense_import import CSV, NDJSON, RowError, import_format, read_rows, row_to_expense
+from db import Expense, User
+from db.memory import Repository
+
+
+def stream(text):
+    return io.BytesIO(text.encode("utf-8"))
+
+
+def parsed(text, format):
+    """Rows of a file, errors as their message"""
+    return [(line, row.__str__() if isinstance(row, RowError) else row) for line, row in read_rows(stream(text), format)]
+
+
+def fields(expenses):
+    return sorted((exp.user_id, exp.payor, float(exp.amount), exp.date, exp.description, exp.comments)
+                  for exp in expenses)
+
+
+HISTORY = [
+    Expense(id="e1", user_id="a@x", payor="b@x", amount="12.50", date="2026-01-05", description="Dinner, \"late\"",
+            comments="split\nin two"),
+    Expense(id="e2", user_id="a@x", payor="a@x", amount="3", date="2026-02-10T08:30:00", description="Café",
+            comments=""),
+    Expense(id="e3", user_id="b@x", payor="a@x", amount="0.10", date="2026-03-01", description="", comments=""),
+]
+
+
+def test_import_format():
+    assert import_format("text/csv") == CSV
+    assert import_format("application/x-ndjson") == NDJSON
+    assert import_format("application/json", "csv") == CSV
+    for mimetype, name in (("application/json", None), ("text/csv", "xlsx")):
+        with pytest.raises(ValueError):
+            import_format(mimetype, name)
+
+
+def test_read_csv():
+    text = ("﻿email,amount,date,description,comments,payor\n"
+            "a@x,10,2026-01-01,Lunch,,b@x\n"
+            "a@x,5,2026-01-02,\"Two\nlines\",,\n"
+            "a@x,1,2026-01-03,x,y,z,extra\n"
+            "a@x,2,2026-01-04\n")
+    rows = parsed(text, CSV)
+    # Line numbers are those of the file (header on line 1), the last line of a multi-line row
+    assert [line for line, _ in rows] == [2, 4, 5, 6]
+    assert rows[0][1] == {"email": "a@x", "amount": "10", "date": "2026-01-01", "description": "Lunch",
+                          "comments": "", "payor": "b@x"}
+    assert rows[1][1]["description"] == "Two\nlines"
+    assert rows[2][1] == "Too many columns"
+    assert rows[3][1]["description"] is None
+
+
+def test_read_ndjson():
+    text = ('{"email": "a@x", "amount": "10", "date": "2026-01-01"}\n'
+            '\n'
+            '{"email": "a@x", \n'
+            '[1, 2]\n'
+            '{"email": "b@x", "amount": 5, "date": "2026-01-02"}')
+    assert parsed(text, NDJSON) == [
+        (1, {"email": "a@x", "amount": "10", "date": "2026-01-01"}),
+        (3, "Invalid JSON"),
+        (4, "Not a JSON object"),
+        (5, {"email": "b@x", "amount": 5, "date": "2026-01-02"}),
+    ]
+
+
+def test_row_to_expense():
+    exp = row_to_expense({"email": " a@x ", "amount": " 12.50", "date": "2026-01-05T10:00:00",
+                          "description": "Dinner", "comments": None})
+    assert (exp.user_id, exp.payor, exp.amount, exp.date, exp.description, exp.comments) == \
+        ("a@x", "a@x", "12.50", "2026-01-05T10:00:00", "Dinner", "")
+    assert row_to_expense({"email": "a@x", "amount": 5, "date": "2026-01-05", "payor": "b@x"}).payor == "b@x"
+
+    # Every row gets its own id
+    row = {"email": "a@x", "amount": "1", "date": "2026-01-05"}
+    assert row_to_expense(row).id != row_to_expense(row).id
+
+
+@pytest.mark.parametrize("row, message", [
+    ({"amount": "1", "date": "2026-01-05"}, "Missing email"),
+    ({"email": " ", "amount": "1", "date": "2026-01-05"}, "Missing email"),
+    ({"email": "a@x", "amount": "ten", "date": "2026-01-05"}, "Invalid amount"),
+    ({"email": "a@x", "amount": "0", "date": "2026-01-05"}, "Invalid amount"),
+    ({"email": "a@x", "amount": "-3", "date": "2026-01-05"}, "Invalid amount"),
+    ({"email": "a@x", "amount": "NaN", "date": "2026-01-05"}, "Invalid amount"),
+    ({"email": "a@x", "date": "2026-01-05"}, "Invalid amount"),
+    ({"email": "a@x", "amount": "1", "date": "05/01/2026"}, "Invalid date (yyyy-mm-dd)"),
+    ({"email": "a@x", "amount": "1"}, "Invalid date (yyyy-mm-dd)"),
+])
+def test_invalid_rows(row, message):
+    with pytest.raises(RowError, match=message.replace("(", r"\(").replace(")", r"\)")):
+        row_to_expense(row)
+
+
+@pytest.mark.parametrize("format", [CSV, NDJSON])
+def test_export_chunks(format):
+    pages = [HISTORY[:2], [], HISTORY[2:]]
+    chunks = list(export_chunks(pages, format))
+    # One chunk per page, the CSV header comes with the first one
+    assert len(chunks) == 3
+    assert chunks[1] == ""
+    if format == CSV:
+        assert chunks[0].startswith("id,email,amount,date,description,comments,payor\r\n")
+    else:
+        assert [json.loads(line)["id"] for line in chunks[0].splitlines()] == ["e1", "e2"]
+
+    text = "".join(chunks)
+    assert b"".join(gzip_chunks(iter(chunks))) != text.encode("utf-8")
+    assert gzip.decompress(b"".join(gzip_chunks(iter(chunks)))).decode("utf-8") == text
+
+
+@pytest.mark.parametrize("format", [CSV, NDJSON])
+def test_round_trip(repository, format):
+    """Exported files import back to the same expenses, on every backend"""
+    for user_id in ("a@x", "b@x"):
+        repository.add_user(User(id=user_id, name=user_id))
+    for exp in HISTORY:
+        repository.add_expense(exp)
+
+    exported = "".join(export_chunks([repository.list_expenses("a@x")], format))
+    imported = []
+    for line, row in read_rows(stream(exported), format):
+        assert not isinstance(row, RowError), (line, row)
+        imported.append(row_to_expense(row))
+    assert fields(imported) == fields(HISTORY)
+
+    target = Repository({})
+    for user_id in ("a@x", "b@x"):
+        target.add_user(User(id=user_id, name=user_id))
+    assert target.add_expenses(imported) == [None] * len(imported)
+    assert fields(target.list_expenses("a@x")) == fields(repository.list_expenses("a@x"))
+
+
+# Endpoints ############################################################################################################
+
+
+def add_user(client, email):
+    assert client.post("/user/add/", json={"email": email, "name": email}).get_json()["status"] == "done"
+
+
+def import_file(client, text, format):
+    response = client.post(f"/expenses/import/?format={format}", data=text.encode("utf-8"))
+    return response.get_json()
+
+
+def test_import_reports_errors_by_line(client):
+    add_user(client, "import-1@x")
+    text = ("email,amount,date,description,comments,payor\n"
+            "import-1@x,10,2026-01-01,,,\n"
+            "import-1@x,ten,2026-01-02,,,\n"
+            "missing-user@x,5,2026-01-03,,,\n"
+            "import-1@x,5,2026-01-04,,,\n"
+            ",5,2026-01-05,,,\n")
+    document = import_file(client, text, CSV)
+    assert document["status"] == "success"
+    report = document["data"]
+    assert (report["imported"], report["failed"]) == (2, 3)
+    # Validation and repository errors, in line order
+    assert [error["line"] for error in report["errors"]] == [3, 4, 6]
+    assert report["errors"][0]["error"] == "Invalid amount"
+    assert "User" in report["errors"][1]["error"]
+    assert report["errors"][2]["error"] == "Missing email"
+
+
+def test_import_caps_the_error_report(client):
+    add_user(client, "import-2@x")
+    rows = ['{"email": "import-2@x", "amount": "1", "date": "2026-01-01"}']
+    rows += ['{"email": "import-2@x", "amount": "x", "date": "2026-01-01"}'] * 1200
+    rows += ['{"email": "import-2@x", "amount": "2", "date": "2026-01-02"}']
+    report = import_file(client, "\n".join(rows), NDJSON)["data"]
+
+    assert (report["imported"], report["failed"]) == (2, 1200)
+    assert len(report["errors"]) == 1000
+    assert [error["line"] for error in report["errors"]] == list(range(2, 1002))
+
+
+def test_import_rejects_unknown_format_and_encoding(client):
+    assert client.post("/expenses/import/", data=b"x", content_type="application/json").get_json()["status"] == "error"
+    document = client.post("/expenses/import/?format=csv", data=b"email,amount\n\xff\xfe,1\n").get_json()
+    assert document["status"] == "error"
+    assert document["data"]["error"] == "File is not UTF-8"
+
+
+@pytest.mark.parametrize("format, gzipped", [(CSV, False), (NDJSON, False), (CSV, True)])
+def test_export_import_round_trip(client, format, gzipped):
+    source, target = f"export-{format}-{gzipped}@x", f"import-{format}-{gzipped}@x"
+    add_user(client, source)
+    add_user(client, target)
+    rows = "\n".join(json.dumps({"email": source, "amount": f"{i + 1}.25", "date": f"2026-01-{i % 28 + 1:02d}",
+                                 "description": f"Row {i}, \"quoted\"", "comments": "", "payor": source})
+                     for i in range(1203))
+    assert import_file(client, rows, NDJSON)["data"]["imported"] == 1203
+
+    response = client.get(f"/user/export/expenses/{source}?format={format}&gzip={str(gzipped).lower()}")
+    assert response.status_code == 200
+    body = response.get_data()
+    if gzipped:
+        assert response.headers["Content-Encoding"] == "gzip"
+        body = gzip.decompress(body)
+    text = body.decode("utf-8").replace(source, target)
+
+    report = import_file(client, text, format)["data"]
+    assert (report["imported"], report["failed"]) == (1203, 0)
+
+    def history(email):
+        return sorted((row["amount"], row["date"], row["description"]) for row in
+                      client.post("/expenses/stats/", json={"email": email, "limit": 5000}).get_json()["data"]["exp_list"])
+
+    assert history(target) == history(source)
@@ -0,0 +1,107 @@
+"""
+Prometheus metrics (core/metrics.py): the text exposition format and the /metrics endpoint of the app.
+"""
+import math
+import re
+
+import pytest
+
+from core.metrics import CONTENT_TYPE, Registry, CallbackMetric
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+
+def parse(text):
+    """
+    Parses the text exposition format, checking that every sample follows the HELP and TYPE of its metric
+    :param text: str
+    :return: dict of (name, frozenset of label pairs) -> value, dict of metric name -> type
+    """
+    assert text.endswith("\n")
+    samples, types, helped = {}, {}, set()
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            helped.add(line.split(" ")[2])
+        elif line.startswith("# TYPE "):
+            _, _, name, type = line.split(" ")
+            assert name in helped and type in ("counter", "gauge", "histogram")
+            types[name] = type
+        else:
+            match = SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            assert re.sub(r"_(bucket|sum|count)$", "", name) in types or name in types, line
+            pairs = LABEL.findall(labels or "")
+            assert ",".join(f'{key}="{val}"' for key, val in pairs) == (labels or ""), line
+            samples[(name, frozenset(pairs))] = math.inf if value == "+Inf" else float(value)
+    return samples, types
+
+
+def value(samples, name, **labels):
+    return samples.get((name, frozenset(labels.items())), 0)
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.counter("test_total", "A counter.", ("kind",))
+    histogram = registry.histogram("test_seconds", "A histogram.", ("op",), buckets=(0.1, 1))
+    registry.register(CallbackMetric("test_cache_total", "A callback.", ("result",), "counter",
+                                     lambda: [(("hits",), 3)]))
+    # Registering a name again returns the registered metric
+    assert registry.counter("test_total", "Again.") is counter
+
+    counter.inc(("a\"b\\c\nd",), 2)
+    for seconds in (0.05, 0.5, 0.5, 5):
+        histogram.observe(("get",), seconds)
+    samples, types = parse(registry.render())
+
+    assert types == {"test_total": "counter", "test_seconds": "histogram", "test_cache_total": "counter"}
+    assert value(samples, "test_total", kind='a\\"b\\\\c\\nd') == 2
+    # Buckets are cumulative, +Inf counts every observation
+    assert [value(samples, "test_seconds_bucket", op="get", le=le) for le in ("0.1", "1", "+Inf")] == [1, 3, 4]
+    assert value(samples, "test_seconds_count", op="get") == 4
+    assert value(samples, "test_seconds_sum", op="get") == pytest.approx(6.05)
+    assert value(samples, "test_cache_total", result="hits") == 3
+
+
+def test_failing_callback_is_skipped():
+    registry = Registry()
+    registry.register(CallbackMetric("test_total", "Fails.", (), "counter", lambda: 1 / 0))
+    assert parse(registry.render())[0] == {}
+
+
+def test_scrape(client):
+    before, _ = parse(client.get("/metrics").get_data(as_text=True))
+
+    client.post("/user/add/", json={"email": "metrics@x", "name": "M"})
+    client.post("/expenses/add/", json={"email": "metrics@x", "amount": "5", "date": "2026-01-05",
+                                        "description": "", "comments": "", "payor": "metrics@x"})
+    for _ in range(3):
+        client.get("/user/search/metrics@x")
+    client.get("/missing/")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == CONTENT_TYPE
+    after, types = parse(response.get_data(as_text=True))
+
+    def delta(name, **labels):
+        return value(after, name, **labels) - value(before, name, **labels)
+
+    assert types["greevil_http_request_duration_seconds"] == "histogram"
+    # Requests by URL rule, not by path
+    requests = "greevil_http_request_duration_seconds_count"
+    assert delta(requests, method="GET", endpoint="/user/search/<email>", status="200") == 3
+    assert delta(requests, method="POST", endpoint="/user/add/", status="200") == 1
+    assert delta(requests, method="GET", endpoint="unmatched", status="404") == 1
+
+    calls = "greevil_repository_call_duration_seconds_count"
+    assert delta(calls, backend="In-Memory", operation="add_user") == 1
+    assert delta(calls, backend="In-Memory", operation="add_expense") == 1
+    assert delta(calls, backend="In-Memory", operation="get_version") == 3
+
+    # The user is read from the backend once, then from the cache
+    assert types["greevil_repository_cache_total"] == "counter"
+    assert delta("greevil_repository_cache_total", kind="user", result="misses") == 1
+    assert delta("greevil_repository_cache_total", kind="user", result="hits") == 2
@@ -0,0 +1,64 @@
+"""
+Paging of the expense listings of the API: /expenses/stats/ and /user/view/expenses/ return EXPENSE_PAGE_SIZE
+expenses unless a limit is given, with a next_cursor to the following page.
+"""
+import json
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def page_size(app):
+    # settings is read once the app fixture has configured the environment
+    from settings import EXPENSE_PAGE_SIZE
+    return EXPENSE_PAGE_SIZE
+
+
+@pytest.fixture(scope="module")
+def total(page_size):
+    return page_size + 30
+
+
+@pytest.fixture(scope="module")
+def email(app, total):
+    """A user with more expenses than a page"""
+    client = app.test_client()
+    email = "paging@x"
+    assert client.post("/user/add/", json={"email": email, "name": "P"}).get_json()["status"] == "done"
+    rows = "\n".join(json.dumps({"email": email, "amount": "1", "date": f"2026-01-{i % 28 + 1:02d}"})
+                     for i in range(total))
+    report = client.post("/expenses/import/?format=ndjson", data=rows.encode("utf-8")).get_json()["data"]
+    assert report["imported"] == total
+    return email
+
+
+def stats(client, email, **body):
+    document = client.post("/expenses/stats/", json={"email": email, **body}).get_json()
+    return document["data"]["exp_list"], document.get("next_cursor")
+
+
+def view(client, email, **body):
+    document = client.post("/user/view/expenses/", json={"email": email, "to_date": "2026-12-31", **body}).get_json()
+    return document["data"], document.get("next_cursor")
+
+
+@pytest.mark.parametrize("read", [stats, view])
+def test_default_page(client, email, read, page_size, total):
+    page, cursor = read(client, email)
+    assert len(page) == page_size
+    assert cursor is not None
+
+    rest, cursor = read(client, email, cursor=cursor)
+    assert len(rest) == total - page_size
+    assert cursor is None
+    assert len({exp["id"] for exp in page + rest}) == total
+
+
+@pytest.mark.parametrize("read", [stats, view])
+def test_limit(client, email, read, total):
+    page, cursor = read(client, email, limit=total)
+    assert (len(page), cursor) == (total, None)
+    assert [exp["date"] for exp in page] == sorted(exp["date"] for exp in page)
+
+    page, cursor = read(client, email, limit=7)
+    assert len(page) == 7 and cursor is not None
@@ -0,0 +1,351 @@
+"""
+Conformance of the repositories: every backend must behave the same through the Repository interface.
+"""
+from datetime import datetime
+
+import pytest
+
+from db import User, Expense, RepositoryException, UserNotFound, UserExists, ExpenseNotFound, InvalidCursor
+from db.rollup import expense_buckets, rollup_stats
+
+NOW = datetime(2026, 3, 15)
+
+
+def add_users(repository, *user_ids):
+    for user_id in user_ids:
+        repository.add_user(User(id=user_id, name=user_id.split("@")[0]))
+
+
+def expense(id, user_id, payor, amount="10", date="2026-03-01", description="", comments=""):
+    return Expense(id=id, user_id=user_id, payor=payor, amount=amount, date=date, description=description,
+                   comments=comments)
+
+
+def fields(expenses):
+    """Comparable fields of expenses, amounts are Decimals or strings depending on the backend"""
+    return [(exp.id, exp.user_id, exp.payor, float(exp.amount), exp.date, exp.description, exp.comments)
+            for exp in expenses]
+
+
+def expected_stats(expenses, user_id):
+    """Stats of a user computed from the expenses themselves"""
+    buckets = {}
+    for exp in expenses:
+        for participant, bucket, amount in expense_buckets(exp):
+            if participant == user_id:
+                buckets[bucket] = buckets.get(bucket, 0) + amount
+    return rollup_stats(buckets, NOW)
+
+
+def all_pages(repository, user_id, limit, **kwargs):
+    expenses, cursor = repository.page_expenses(user_id, limit=limit, **kwargs)
+    while cursor is not None:
+        assert len(expenses) % limit == 0
+        page, cursor = repository.page_expenses(user_id, limit=limit, cursor=cursor, **kwargs)
+        expenses += page
+    return expenses
+
+
+@pytest.fixture
+def history(repository):
+    """Three users and their expenses, in (date, id) order"""
+    add_users(repository, "a@x", "b@x", "c@x")
+    expenses = [
+        expense("e1", "a@x", "b@x", "12.50", "2026-01-05"),
+        expense("e2", "a@x", "a@x", "3", "2026-02-10T08:30:00"),
+        expense("e3", "b@x", "a@x", "7.25", "2026-03-01"),
+        expense("e4", "c@x", "b@x", "100", "2026-03-15"),
+        expense("e5", "a@x", "c@x", "0.10", "2026-03-15"),
+        expense("e6", "a@x", "b@x", "0.20", "2025-12-31"),
+    ]
+    for exp in expenses:
+        repository.add_expense(exp)
+    return sorted(expenses, key=lambda exp: (exp.date, exp.id))
+
+
+# Users ################################################################################################################
+def test_add_and_get_user(repository):
+    assert repository.add_user(User(id="a@x", name="Ann")) == "a@x"
+
+    user = repository.get_user("a@x")
+    assert isinstance(user, User)
+    assert (user.id, user.name, list(user.expense_ids), list(user.friend_ids)) == ("a@x", "Ann", [], [])
+
+
+def test_add_existing_user(repository):
+    add_users(repository, "a@x")
+    with pytest.raises(UserExists):
+        repository.add_user(User(id="a@x", name="Other"))
+    assert repository.get_user("a@x").name == "a"
+
+
+def test_get_missing_user(repository):
+    with pytest.raises(UserNotFound):
+        repository.get_user("nobody@x")
+    with pytest.raises(UserNotFound):
+        repository.get_version("nobody@x")
+
+
+def test_get_all_users(repository):
+    assert list(repository.get_all_users()) == []
+    add_users(repository, "a@x", "b@x")
+    repository.add_friend("a@x", "b@x")
+
+    users = repository.get_all_users()
+    assert all(isinstance(user, User) for user in users)
+    assert sorted((user.id, list(user.friend_ids)) for user in users) == [("a@x", ["b@x"]), ("b@x", ["a@x"])]
+
+
+def test_add_friend(repository):
+    add_users(repository, "a@x", "b@x", "c@x")
+    repository.add_friend("a@x", "b@x")
+    repository.add_friend("a@x", "c@x")
+    # Adding twice, or from the other side, does not duplicate
+    repository.add_friend("b@x", "a@x")
+
+    assert sorted(repository.get_user("a@x").friend_ids) == ["b@x", "c@x"]
+    assert repository.get_user("b@x").friend_ids == ["a@x"]
+    assert repository.get_user("c@x").friend_ids == ["a@x"]
+
+    with pytest.raises(UserNotFound):
+        repository.add_friend("a@x", "nobody@x")
+    with pytest.raises(UserNotFound):
+        repository.add_friend("nobody@x", "a@x")
+    assert sorted(repository.get_user("a@x").friend_ids) == ["b@x", "c@x"]
+
+
+def test_update_user(repository):
+    add_users(repository, "a@x", "b@x")
+    repository.update_user("a@x", "name", "Ann")
+    repository.update_user("a@x", "friend_ids", ["b@x"])
+
+    user = repository.get_user("a@x")
+    assert (user.name, user.friend_ids) == ("Ann", ["b@x"])
+
+    with pytest.raises(ValueError):
+        repository.update_user("a@x", "unknown", 1)
+    with pytest.raises(UserNotFound):
+        repository.update_user("nobody@x", "name", "Nobody")
+
+
+def test_versions(repository):
+    add_users(repository, "a@x", "b@x", "c@x")
+
+    def versions():
+        return [repository.get_version(user_id) for user_id in ("a@x", "b@x", "c@x")]
+
+    changes = [
+        lambda: repository.add_friend("a@x", "b@x"),
+        lambda: repository.update_user("c@x", "name", "Cid"),
+        lambda: repository.add_expense(expense("e1", "a@x", "c@x")),
+        lambda: repository.update_expense("e1", "amount", "11"),
+        lambda: repository.update_expense("e1", "payor", "b@x"),
+        lambda: repository.delete_expense("e1"),
+        lambda: repository.add_expenses([expense("e2", "b@x", "b@x")]),
+    ]
+    # Users whose version must change
+    changed = [{0, 1}, {2}, {0, 2}, {0, 2}, {0, 1, 2}, {0, 1}, {1}]
+
+    before = versions()
+    for change, users in zip(changes, changed):
+        change()
+        after = versions()
+        assert {i for i in range(3) if after[i] != before[i]} == users
+        before = after
+
+
+# Expenses #############################################################################################################
+def test_add_and_get_expense(repository):
+    add_users(repository, "a@x", "b@x")
+    repository.add_expense(expense("e1", "a@x", "b@x", "12.50", "2026-01-05", "Dinner", "split"))
+
+    assert fields([repository.get_expense("e1")]) == [
+        ("e1", "a@x", "b@x", 12.5, "2026-01-05", "Dinner", "split")
+    ]
+    assert repository.get_expense("e1").to_dict()["amount"] == 12.5
+    assert sorted(repository.get_user("a@x").expense_ids) == ["e1"]
+    assert sorted(repository.get_user("b@x").expense_ids) == ["e1"]
+
+
+def test_get_missing_expense(repository):
+    with pytest.raises(ExpenseNotFound):
+        repository.get_expense("missing")
+    with pytest.raises(ExpenseNotFound):
+        repository.update_expense("missing", "amount", "1")
+    with pytest.raises(ExpenseNotFound):
+        repository.delete_expense("missing")
+
+
+def test_add_expense_of_missing_user(repository):
+    add_users(repository, "a@x")
+    with pytest.raises(UserNotFound):
+        repository.add_expense(expense("e1", "a@x", "nobody@x"))
+    with pytest.raises(ExpenseNotFound):
+        repository.get_expense("e1")
+    assert list(repository.get_user("a@x").expense_ids) == []
+
+
+def test_get_expenses(repository, history):
+    found = repository.get_expenses(["e4", "missing", "e1", "e6"])
+    assert [exp.id for exp in found] == ["e4", "e1", "e6"]
+    assert repository.get_expenses([]) == []
+
+
+def test_list_expenses(repository, history):
+    for user_id in ("a@x", "b@x", "c@x"):
+        mine = [exp for exp in history if user_id in (exp.user_id, exp.payor)]
+        assert fields(repository.list_expenses(user_id)) == fields(mine)
+        assert sorted(repository.get_user(user_id).expense_ids) == sorted(exp.id for exp in mine)
+
+
+def test_list_expenses_by_date(repository, history):
+    # Both ends are inclusive, a time on the last day is within the range
+    assert [exp.id for exp in repository.list_expenses("a@x", "2026-01-05", "2026-02-10")] == ["e1", "e2"]
+    assert [exp.id for exp in repository.list_expenses("a@x", from_date="2026-03-01")] == ["e3", "e5"]
+    assert [exp.id for exp in repository.list_expenses("a@x", to_date="2025-12-31")] == ["e6"]
+    assert repository.list_expenses("a@x", "2027-01-01") == []
+
+
+@pytest.mark.parametrize("limit", [1, 2, 5, 100])
+def test_page_expenses(repository, history, limit):
+    mine = [exp for exp in history if "a@x" in (exp.user_id, exp.payor)]
+    assert fields(all_pages(repository, "a@x", limit)) == fields(mine)
+
+    in_range = [exp for exp in mine if "2026-01-01" <= exp.date <= "2026-03-01"]
+    assert fields(all_pages(repository, "a@x", limit, from_date="2026-01-01", to_date="2026-03-01")) == fields(in_range)
+
+
+def test_page_expenses_last_page(repository, history):
+    page, cursor = repository.page_expenses("c@x", limit=2)
+    assert [exp.id for exp in page] == ["e4", "e5"]
+    assert cursor is None
+
+
+def test_invalid_cursor(repository, history):
+    with pytest.raises(InvalidCursor):
+        repository.page_expenses("a@x", limit=2, cursor="not a cursor")
+
+
+def test_update_expense(repository, history):
+    updated = repository.update_expense("e1", "amount", "20")
+    assert float(updated.amount) == 20
+    repository.update_expense("e1", "description", "Lunch")
+    repository.update_expense("e1", "date", "2026-03-02")
+
+    exp = repository.get_expense("e1")
+    assert (float(exp.amount), exp.description, exp.date) == (20, "Lunch", "2026-03-02")
+    assert [exp.id for exp in repository.list_expenses("b@x", "2026-03-02", "2026-03-02")] == ["e1"]
+
+    with pytest.raises(ValueError):
+        repository.update_expense("e1", "unknown", 1)
+
+
+def test_update_expense_participants(repository, history):
+    repository.update_expense("e1", "payor", "c@x")
+
+    assert "e1" not in [exp.id for exp in repository.list_expenses("b@x")]
+    assert "e1" in [exp.id for exp in repository.list_expenses("c@x")]
+    assert "e1" not in repository.get_user("b@x").expense_ids
+    assert "e1" in repository.get_user("c@x").expense_ids
+
+    with pytest.raises(UserNotFound):
+        repository.update_expense("e1", "user_id", "nobody@x")
+    assert repository.get_expense("e1").user_id == "a@x"
+
+
+def test_delete_expense(repository, history):
+    repository.delete_expense("e1")
+
+    with pytest.raises(ExpenseNotFound):
+        repository.get_expense("e1")
+    assert "e1" not in [exp.id for exp in repository.list_expenses("a@x")]
+    assert "e1" not in repository.get_user("b@x").expense_ids
+
+
+def test_add_expenses(repository):
+    add_users(repository, "a@x", "b@x")
+    errors = repository.add_expenses([
+        expense("e1", "a@x", "b@x"),
+        expense("e2", "nobody@x", "b@x"),
+        expense("e3", "b@x", "b@x"),
+    ])
+
+    assert errors[0] is None and errors[2] is None
+    assert isinstance(errors[1], UserNotFound) and isinstance(errors[1], RepositoryException)
+    assert [exp.id for exp in repository.list_expenses("b@x")] == ["e1", "e3"]
+    with pytest.raises(ExpenseNotFound):
+        repository.get_expense("e2")
+    assert repository.add_expenses([]) == []
+
+
+def test_add_expense_with_taken_id(repository):
+    add_users(repository, "a@x", "b@x", "c@x")
+    repository.add_expense(expense("e1", "a@x", "b@x", "12.50"))
+    before = [repository.get_version(user_id) for user_id in ("a@x", "b@x", "c@x")]
+
+    with pytest.raises(RepositoryException):
+        repository.add_expense(expense("e1", "c@x", "c@x", "5"))
+
+    # The expense, the listings and the rollups of its participants are untouched
+    assert fields([repository.get_expense("e1")]) == fields([expense("e1", "a@x", "b@x", "12.50")])
+    expenses = [expense("e1", "a@x", "b@x", "12.50")]
+    for user_id in ("a@x", "b@x", "c@x"):
+        assert [exp.id for exp in repository.list_expenses(user_id)] == ([] if user_id == "c@x" else ["e1"])
+        assert rollup_stats(repository.get_rollup(user_id), NOW) == expected_stats(expenses, user_id)
+    assert [repository.get_version(user_id) for user_id in ("a@x", "b@x", "c@x")] == before
+
+
+def test_add_expenses_with_taken_ids(repository):
+    add_users(repository, "a@x", "b@x", "c@x")
+    repository.add_expense(expense("e1", "a@x", "a@x"))
+    before = [repository.get_version(user_id) for user_id in ("a@x", "b@x", "c@x")]
+
+    errors = repository.add_expenses([
+        expense("e2", "a@x", "b@x"),
+        expense("e1", "c@x", "c@x"),
+        expense("e3", "nobody@x", "b@x"),
+        # Taken by the row above
+        expense("e2", "b@x", "b@x"),
+        expense("e4", "a@x", "a@x"),
+    ])
+
+    # Rows failing do not fail the batch
+    assert [err is None for err in errors] == [True, False, False, False, True]
+    assert all(isinstance(err, RepositoryException) for err in errors if err is not None)
+    assert isinstance(errors[2], UserNotFound)
+    expenses = [expense("e1", "a@x", "a@x"), expense("e2", "a@x", "b@x"), expense("e4", "a@x", "a@x")]
+    assert fields(repository.get_expenses(["e1", "e2", "e4"])) == fields(expenses)
+    for user_id in ("a@x", "b@x", "c@x"):
+        assert sorted(exp.id for exp in repository.list_expenses(user_id)) == \
+            sorted(exp.id for exp in expenses if user_id in (exp.user_id, exp.payor))
+        assert rollup_stats(repository.get_rollup(user_id), NOW) == expected_stats(expenses, user_id)
+    # Only the users of the expenses added get a new version
+    after = [repository.get_version(user_id) for user_id in ("a@x", "b@x", "c@x")]
+    assert [after[i] != before[i] for i in range(3)] == [True, True, False]
+
+
+# Stats ################################################################################################################
+def test_rollups(repository, history):
+    for user_id in ("a@x", "b@x", "c@x"):
+        assert rollup_stats(repository.get_rollup(user_id), NOW) == expected_stats(history, user_id)
+
+
+def test_rollups_follow_writes(repository, history):
+    repository.update_expense("e1", "payor", "c@x")
+    repository.update_expense("e4", "amount", "50.5")
+    repository.update_expense("e3", "date", "2026-03-15")
+    repository.delete_expense("e5")
+    repository.add_expenses([expense("e7", "c@x", "a@x", "1.5", "2026-03-15")])
+
+    expenses = repository.get_expenses(["e1", "e2", "e3", "e4", "e6", "e7"])
+    for user_id in ("a@x", "b@x", "c@x"):
+        assert rollup_stats(repository.get_rollup(user_id), NOW) == expected_stats(expenses, user_id)
+
+    before = {user_id: rollup_stats(repository.get_rollup(user_id), NOW) for user_id in ("a@x", "b@x", "c@x")}
+    repository.rebuild_rollups()
+    assert {user_id: rollup_stats(repository.get_rollup(user_id), NOW) for user_id in before} == before
+
+
+def test_rollups_of_user_without_expenses(repository):
+    add_users(repository, "a@x")
+    assert rollup_stats(repository.get_rollup("a@x"), NOW) == expected_stats([], "a@x")
@@ -0,0 +1,68 @@
+"""
+XML representation (core/transformer.py): the streamed XmlStream against the minidom XmlTransformer.
+"""
+import pytest
+
+from core.transformer import XmlTransformer, XmlStream
+
+DOCUMENTS = [
+    {"data": "text", "status": "success"},
+    {"data": {"name": "A", "amount": 12.5, "count": 3, "comments": None, "description": ""}, "status": "success"},
+    # Nested dicts, lists of values and of dicts, empty lists and dicts of empty lists
+    {"data": {
+        "exp_list": [{"id": "e1", "amount": 1.0, "tags": ["a", "b"]}, {"id": "e2", "amount": 2.0, "tags": []}],
+        "friend_ids": [],
+        "charts": {"pie_chart": {"b@x": 10.0}, "empty": {"items": []}, "bar_chart": {"m1": [1, 2]}},
+    }, "status": "success"},
+    # Text escaped like minidom
+    {"data": {"description": "Dinner & drinks <shared> \"quoted\" 'single' ]]> é€"}, "status": "error"},
+    # Single root element
+    {"expense": {"id": "e1", "user": {"id": "a@x", "friend_ids": ["b@x", "c@x"]}}},
+]
+
+
+def compact(transformer):
+    """minidom output without indentation, the declaration on its own line like XmlStream"""
+    return transformer.doc.toxml().replace("?>", "?>\n", 1)
+
+
+@pytest.mark.parametrize("data", DOCUMENTS)
+def test_pretty_matches_transformer(data):
+    assert str(XmlStream(data, pretty=True)) == str(XmlTransformer(data))
+
+
+@pytest.mark.parametrize("data", DOCUMENTS)
+def test_compact_matches_transformer(data):
+    assert str(XmlStream(data)) == compact(XmlTransformer(data))
+
+
+def test_non_string_keys():
+    # The minidom writer raises on them, XmlStream converts them with str()
+    assert str(XmlStream({"bar_chart": {1: 2.0, 2: 3.0}})) == str(XmlStream({"bar_chart": {"1": 2.0, "2": 3.0}}))
+
+
+@pytest.mark.parametrize("pretty", [False, True])
+def test_streamed_in_chunks(pretty):
+    data = {"data": {"exp_list": [{"id": f"{i:032x}", "description": "Dinner & drinks"} for i in range(2000)]},
+            "status": "success"}
+    chunks = list(XmlStream(data, pretty))
+
+    assert len(chunks) > 1
+    # Every chunk but the last is at least CHUNK_SIZE, and not much more
+    assert all(XmlStream.CHUNK_SIZE <= len(chunk) < XmlStream.CHUNK_SIZE + 200 for chunk in chunks[:-1])
+    assert "".join(chunks) == str(XmlStream(data, pretty))
+    assert "".join(chunks) == (str(XmlTransformer(data)) if pretty else compact(XmlTransformer(data)))
+
+
+def test_xml_representation(client):
+    assert client.post("/user/add/", json={"email": "xml@x", "name": "X & Y"}).get_json()["status"] == "done"
+
+    response = client.post("/user/search/", json={"email": "xml@x"}, headers={"Accept": "application/xml"})
+    assert response.mimetype == "application/xml"
+    assert response.is_streamed
+    body = response.get_data(as_text=True)
+    assert body.startswith('<?xml version="1.0" ?>\n<response><data>')
+    assert "<name>X &amp; Y</name>" in body
+
+    pretty = client.post("/user/search/?pretty=true", json={"email": "xml@x"}, headers={"Accept": "application/xml"})
+    assert "\t\t<name>X &amp; Y</name>\n" in pretty.get_data(as_text=True)